@@ -0,0 +1,349 @@
+"""This module contains functions for aggregating detected windows by blocks"""
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fiona
+import numpy as np
+import rtree
+import tqdm
+from shapely import wkb
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from aplatam.stats import file_digest, get_cache_dir
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_COVERAGE = 0.8
+DEFAULT_BLOCKS_PER_TILE = 1000
+
+# Ways of measuring coverage of a block by its windows (see +aggregate_block+)
+COVERAGE_MODES = ('union', 'block')
+DEFAULT_COVERAGE = 'union'
+
+
+def aggregate_blocks(blocks_file,
+                     windows_file,
+                     output_file,
+                     min_coverage=DEFAULT_MIN_COVERAGE,
+                     workers=1,
+                     blocks_per_tile=DEFAULT_BLOCKS_PER_TILE,
+                     coverage=DEFAULT_COVERAGE):
+    """
+    Select blocks covered by detected windows
+
+    A block is selected if its coverage by the windows that intersect it is
+    more than +min_coverage+.  By default, coverage is the area of the union
+    of those windows divided by the block area, as in the original
+    dissolve_with_blocks.py script.  If +coverage+ is 'block', only the area
+    of the block covered by windows is counted (see +aggregate_block+).
+    Selected blocks are written to +output_file+ with their properties, plus
+    the mean probability of the intersecting windows ("prob") and their
+    coverage ("coverage").
+
+    Blocks are partitioned spatially into tiles of about +blocks_per_tile+
+    blocks, which are processed on a pool of +workers+ processes.  Windows
+    are read from a persistent R-Tree index (see +windows_index+), so they
+    are never loaded into memory all at once.  Selected blocks are written
+    as each tile is done.  Blocks are identified by their position in
+    +blocks_file+, so any kind of feature id is supported.
+
+    """
+    if coverage not in COVERAGE_MODES:
+        raise ValueError('coverage must be one of {}, but was {}'.format(
+            COVERAGE_MODES, coverage))
+
+    with fiona.open(windows_file) as src:
+        windows_crs = src.crs
+    with fiona.open(blocks_file) as src:
+        driver, crs, schema = src.driver, src.crs, src.schema.copy()
+        bounds = _read_bounds(src)
+    _logger.info('Blocks: %d', len(bounds))
+
+    if crs != windows_crs:
+        raise ValueError(
+            'Blocks and windows must have the same CRS ({} != {})'.format(
+                crs, windows_crs))
+
+    tiles = partition_tiles(np.arange(len(bounds)), bounds, blocks_per_tile)
+    _logger.info('Blocks partitioned into %d tiles', len(tiles))
+
+    properties = OrderedDict(schema['properties'])
+    properties['prob'] = 'float'
+    properties['coverage'] = 'float'
+    schema['properties'] = properties
+
+    with windows_index(windows_file) as index_path:
+        tasks = [(tile, min_coverage, coverage) for tile in tiles]
+        initargs = (index_path, blocks_file)
+        with fiona.open(
+                output_file, 'w', driver=driver, crs=crs,
+                schema=schema) as dst:
+            count = 0
+            for features in tqdm.tqdm(
+                    _map_tiles(tasks, workers, initargs), total=len(tasks)):
+                dst.writerecords(features)
+                count += len(features)
+    _logger.info('%d blocks written to %s', count, output_file)
+
+
+def aggregate_block(block, index, coverage=DEFAULT_COVERAGE):
+    """
+    Aggregate windows of +index+ that intersect +block+
+
+    Only windows whose intersection with +block+ has a positive area are
+    considered.  Returns a tuple with the coverage of +block+ by those
+    windows and their mean probability, or None if there are no such
+    windows.
+
+    If +coverage+ is 'union', coverage is the area of the union of the
+    windows divided by the area of +block+, so parts of windows outside the
+    block are counted too, and it can be more than 1.  If it is 'block',
+    coverage is the fraction of +block+ covered by the windows.
+
+    """
+    prepared_block = prep(block)
+    windows, probs, rects = [], [], []
+    for window_wkb, prob, is_rect in index.intersection(
+            block.bounds, objects='raw'):
+        window = wkb.loads(window_wkb)
+        if not prepared_block.contains(window):
+            if not prepared_block.intersects(window):
+                continue
+            if block.intersection(window).area <= 0:
+                continue
+        windows.append(window)
+        probs.append(prob)
+        rects.append(is_rect)
+
+    if not windows:
+        return None
+
+    if all(rects):
+        bounds = np.array([w.bounds for w in windows], dtype=np.float64)
+        if coverage == 'block':
+            covered_area = _covered_area_of_boxes(
+                bounds, block=block, prepared_block=prepared_block)
+        else:
+            covered_area = _covered_area_of_boxes(bounds)
+    else:
+        covered_area = unary_union(windows)
+        if coverage == 'block':
+            covered_area = block.intersection(covered_area)
+        covered_area = covered_area.area
+    return covered_area / block.area, float(np.mean(probs))
+
+
+def partition_tiles(ids, bounds, blocks_per_tile):
+    """
+    Partition blocks into tiles of about +blocks_per_tile+ blocks
+
+    Blocks are assigned to the cell of a regular grid over their extent
+    where their center falls.  Returns a list of arrays of block ids, one
+    for each non-empty tile, in row-major order.
+
+    """
+    if not len(ids):
+        return []
+    ids, bounds = np.asarray(ids), np.asarray(bounds, dtype=np.float64)
+    side = max(1, int(math.ceil(math.sqrt(len(ids) / blocks_per_tile))))
+
+    xs = (bounds[:, 0] + bounds[:, 2]) / 2
+    ys = (bounds[:, 1] + bounds[:, 3]) / 2
+    cols = _bin_coords(xs, side)
+    rows = _bin_coords(ys, side)
+    tile_ids = rows * side + cols
+
+    order = np.argsort(tile_ids, kind='mergesort')
+    tile_ids = tile_ids[order]
+    splits = np.nonzero(np.diff(tile_ids))[0] + 1
+    return np.split(ids[order], splits)
+
+
+@contextmanager
+def windows_index(windows_file):
+    """
+    Return path of a disk-based R-Tree index of windows of +windows_file+
+
+    The index stores each window geometry and probability, and it is keyed
+    by a hash of the contents of +windows_file+, so it is built once and
+    reused until windows change.  It is stored in the "index" subdirectory
+    of the cache directory, or in a temporary directory if cache is
+    disabled.
+
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory(prefix='aplatam_index') as tmpdir:
+            index_path = os.path.join(tmpdir, 'windows')
+            _build_index(windows_file, index_path)
+            yield index_path
+        return
+
+    index_dir = os.path.join(cache_dir, 'index')
+    index_path = os.path.join(index_dir, file_digest(windows_file))
+    if os.path.exists(index_path + '.dat'):
+        _logger.info('Reuse index of windows at %s', index_path)
+    else:
+        os.makedirs(index_dir, exist_ok=True)
+        tmp_path = '{}-{}'.format(index_path, uuid.uuid4().hex)
+        _build_index(windows_file, tmp_path)
+        # Data file is moved last, as it is the one checked for existence
+        os.replace(tmp_path + '.idx', index_path + '.idx')
+        os.replace(tmp_path + '.dat', index_path + '.dat')
+    yield index_path
+
+
+def _build_index(windows_file, index_path):
+    _logger.info('Create index of windows from %s at %s', windows_file,
+                 index_path)
+
+    with fiona.open(windows_file) as src:
+
+        def entries():
+            for i, feature in enumerate(src):
+                window = shape(feature['geometry'])
+                obj = (window.wkb, float(feature['properties']['prob']),
+                       _is_rectangle(window))
+                yield (i, window.bounds, obj)
+
+        properties = rtree.index.Property()
+        properties.overwrite = True
+        index = rtree.index.Index(
+            index_path, entries(), properties=properties)
+        index.close()
+
+
+def _is_rectangle(geom):
+    """Return True if +geom+ is an axis-aligned rectangle"""
+    return (geom.geom_type == 'Polygon' and not geom.interiors
+            and len(geom.exterior.coords) == 5
+            and geom.area == box(*geom.bounds).area)
+
+
+def _covered_area_of_boxes(bounds, block=None, prepared_block=None):
+    """
+    Return area of the union of axis-aligned boxes, or only the area of
+    +block+ covered by them if +block+ is not None
+
+    Boxes are painted on a grid of cells given by their unique coordinates,
+    and each row of cells is split into runs of covered cells, which are
+    disjoint rectangles.  Only rectangles on the boundary of +block+ need an
+    actual intersection.
+
+    """
+    if block is not None and prepared_block is None:
+        prepared_block = prep(block)
+
+    xs = np.unique(bounds[:, [0, 2]])
+    ys = np.unique(bounds[:, [1, 3]])
+    c0, c1 = np.searchsorted(xs, bounds[:, 0]), np.searchsorted(xs, bounds[:, 2])
+    r0, r1 = np.searchsorted(ys, bounds[:, 1]), np.searchsorted(ys, bounds[:, 3])
+
+    diff = np.zeros((len(ys), len(xs)), dtype=np.int32)
+    np.add.at(diff, (r0, c0), 1)
+    np.add.at(diff, (r0, c1), -1)
+    np.add.at(diff, (r1, c0), -1)
+    np.add.at(diff, (r1, c1), 1)
+    covered = diff.cumsum(axis=0).cumsum(axis=1)[:-1, :-1] > 0
+
+    area = 0.
+    for row, row_cells in enumerate(covered):
+        edges = np.diff(np.concatenate([[0], row_cells.astype(np.int8), [0]]))
+        starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+        for start, end in zip(starts, ends):
+            rect = box(xs[start], ys[row], xs[end], ys[row + 1])
+            if block is None or prepared_block.contains(rect):
+                area += rect.area
+            elif prepared_block.intersects(rect):
+                area += block.intersection(rect).area
+    return area
+
+
+def _read_bounds(src):
+    """Return an array of bounds of all features of +src+, in order"""
+    bounds = [shape(feature['geometry']).bounds for feature in src]
+    return np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+
+def _read_features(src, positions):
+    """
+    Generate features of +src+ at +positions+, in ascending order
+
+    Features are read by position instead of by feature id, which may not
+    be an integer or match the position of the feature on every driver.
+    Each run of consecutive positions is read with a single iterator.
+
+    """
+    positions = np.sort(np.asarray(positions, dtype=np.int64))
+    splits = np.nonzero(np.diff(positions) != 1)[0] + 1
+    for run in np.split(positions, splits):
+        if len(run):
+            yield from src[int(run[0]):int(run[-1]) + 1]
+
+
+def _bin_coords(coords, side):
+    lo, hi = coords.min(), coords.max()
+    if hi <= lo:
+        return np.zeros(len(coords), dtype=np.int64)
+    bins = ((coords - lo) / (hi - lo) * side).astype(np.int64)
+    return np.clip(bins, 0, side - 1)
+
+
+def _map_tiles(tasks, workers, initargs):
+    """Generate results of +tasks+, on a pool of +workers+ if more than 1"""
+    if workers > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(
+                workers, initializer=_init_worker,
+                initargs=initargs) as pool:
+            yield from pool.imap(_aggregate_tile, tasks)
+    else:
+        _init_worker(*initargs)
+        try:
+            yield from map(_aggregate_tile, tasks)
+        finally:
+            _close_worker()
+
+
+_worker_index = None
+_worker_blocks = None
+
+
+def _init_worker(index_path, blocks_file):
+    """Open index and blocks file on a worker of +aggregate_blocks+"""
+    global _worker_index, _worker_blocks  # pylint: disable=global-statement
+    _worker_index = rtree.index.Index(index_path)
+    _worker_blocks = fiona.open(blocks_file)
+
+
+def _close_worker():
+    global _worker_index, _worker_blocks  # pylint: disable=global-statement
+    _worker_index.close()
+    _worker_blocks.close()
+    _worker_index, _worker_blocks = None, None
+
+
+def _aggregate_tile(task):
+    ids, min_coverage, coverage_mode = task
+    features = []
+    for feature in _read_features(_worker_blocks, ids):
+        res = aggregate_block(
+            shape(feature['geometry']), _worker_index, coverage=coverage_mode)
+        if res is None:
+            continue
+        coverage, prob = res
+        if coverage > min_coverage:
+            properties = OrderedDict(feature['properties'])
+            properties['prob'] = prob
+            properties['coverage'] = coverage
+            features.append(
+                dict(geometry=feature['geometry'], properties=properties))
+    return features
@@ -1,23 +1,44 @@
 """This module contains classes for building trainsets"""
 import logging
+import multiprocessing
 import os
+import tempfile
+from contextlib import contextmanager
 
-import dask_rasterio
 import fiona
 import numpy as np
 import rasterio
 import rasterio.mask
+import tqdm
 from shapely.geometry import box, shape
-from skimage import exposure
+from shapely.ops import unary_union
+from skimage import exposure, img_as_ubyte
 from skimage.io import imsave
 
 from aplatam import __version__
 from aplatam.class_balancing import split_dataset
-from aplatam.util import (create_index, get_raster_crs, reproject_shape,
-                          sliding_windows, write_metadata)
+from aplatam.grid import WindowGrid, contour_window_mask
+from aplatam.packed_dataset import PackedDatasetWriter, is_packed_dataset
+from aplatam.stats import (HistogramBuilder, calculate_percentiles,
+                           file_digest, get_raster_digest)
+from aplatam.util import (METADATA_FILENAME, create_index, crs_key,
+                          read_metadata, reproject_coords, reproject_shape,
+                          reproject_shapes, write_metadata)
+from aplatam.window_reader import StripReader, scan_raster
 
 _logger = logging.getLogger(__name__)
 
+# Maximum number of windows extracted on each task of the worker pool
+EXTRACT_BATCH_SIZE = 256
+
+# Output formats of trainsets
+OUTPUT_FORMATS = ('jpeg', 'packed')
+
+# Points per edge of raster bounds when reprojecting them, and margin
+# (as a fraction of the extent) added to reprojected bounds
+BOUNDS_DENSIFY_POINTS = 21
+BOUNDS_MARGIN = 0.01
+
 
 class CnnTrainsetBuilder:
     """
@@ -30,8 +51,27 @@ class CnnTrainsetBuilder:
     it is stored in the directory for "true" samples. Otherwise, it is
     stored in the directory corresponding to "false" samples.
 
+    Builds are incremental: metadata of the trainset includes a manifest
+    with the build parameters, and a hash and the list of emitted tiles of
+    each raster.  When building on an existing trainset with the same
+    parameters, only new or changed rasters are processed, and tiles of
+    changed or removed rasters are deleted.  If parameters changed, the
+    trainset is built again from scratch.  Packed datasets cannot be
+    updated, so on the packed format the build is skipped if no raster
+    changed, and otherwise the trainset is built again from scratch.
+
+    If +min_overlap+ is greater than 0, a tile is a "true" sample only if
+    polygon shapes cover at least that fraction of its area.  Tiles that
+    intersect with shapes but are covered less than that are ambiguous, so
+    they are not used as "false" samples either.
+
     Both directories are stored in the output directory.
 
+    If +output_format+ is "packed", images are not stored as JPEG files.
+    Instead, there is a packed dataset (see +PackedDatasetWriter+) in each
+    of the "train" and "test" directories, with labels 1 for "true" samples
+    and 0 for "false" samples.
+
     Arguments:
         rasters {iterable} -- list of paths to rasters
         vector {string} -- path to vector file of shapes
@@ -48,6 +88,19 @@ class CnnTrainsetBuilder:
         lower_cut {float} -- lower cut of intensity rescale (default: {2})
         upper_cut {float} -- upper cut of intensity rescale (default: {98})
         block_size {int} -- block size multiplier (default: {1})
+        stats_decimation {int} -- decimation factor of reads when
+            calculating percentiles, for faster but approximate results
+            (default: {1})
+        workers {int} -- number of processes that extract and save images
+            (default: {1})
+        output_format {str} -- "jpeg" or "packed" (default: {"jpeg"})
+        min_overlap {float} -- minimum fraction of a tile covered by shapes
+            for a "true" sample (default: {0})
+        tmp_dir {str} -- directory for temporary files, e.g. images of
+            samples read while calculating the histogram of a raster
+            (default: the output directory)
+        seed {int} -- seed of the random number generator used for
+            splitting samples, stored in the manifest (default: {None})
 
     """
 
@@ -63,10 +116,19 @@ class CnnTrainsetBuilder:
                  lower_cut=2,
                  upper_cut=98,
                  block_size=1,
+                 stats_decimation=1,
                  rasters_contour=None,
+                 workers=1,
+                 output_format='jpeg',
+                 min_overlap=0,
+                 tmp_dir=None,
+                 seed=None,
                  *,
                  size,
                  step_size):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format: {}'.format(output_format))
+
         self.rasters = rasters
         self.vector = vector
         self.test_size = test_size
@@ -78,7 +140,17 @@ class CnnTrainsetBuilder:
         self.lower_cut = lower_cut
         self.upper_cut = upper_cut
         self.block_size = block_size
+        self.stats_decimation = stats_decimation
         self.rasters_contour = rasters_contour
+        self.workers = workers
+        self.output_format = output_format
+        self.min_overlap = min_overlap
+        self.tmp_dir = tmp_dir
+        self.seed = seed
+
+        self._packed_writers = None
+        self._shapes_index = None
+        self._projected_shapes = None
 
     def build(self, output_dir):
         """
@@ -88,44 +160,183 @@ class CnnTrainsetBuilder:
             output_dir {string} -- output directory path
 
         """
+        keys = [os.path.abspath(raster) for raster in self.rasters]
+        params = self._manifest_params()
+        manifest = trainset_manifest(output_dir)
+        if manifest and manifest['params'] != params:
+            _logger.info('Parameters changed, rebuild whole trainset')
+            for entry in manifest['rasters'].values():
+                _remove_tiles(output_dir, entry['tiles'])
+            manifest = None
+
+        if manifest and self.output_format == 'packed':
+            if self._is_packed_trainset_current(output_dir, manifest, keys):
+                _logger.info('Rasters did not change, skip build')
+                return
+            _logger.info('Rasters changed, rebuild whole packed trainset')
+            manifest = None
+
         shapes, vector_crs = self._read_shapes()
         _logger.info('Total shapes: %d', len(shapes))
         _logger.info('Vector CRS is %s', vector_crs)
 
         contour_shape, contour_crs = self._load_raster_contour_polygon()
 
+        # Index of shapes on the vector CRS, and reprojected shapes by CRS
+        self._shapes_index = create_index(shapes)
+        self._projected_shapes = {}
+
         self._create_dataset_directories(output_dir)
 
+        # Delete tiles of rasters that were removed
+        entries = manifest['rasters'] if manifest else {}
+        for key in set(entries) - set(keys):
+            _logger.info('Raster %s was removed, delete its tiles', key)
+            _remove_tiles(output_dir, entries.pop(key)['tiles'])
+
+        if self.output_format == 'packed':
+            self._packed_writers = {
+                dirname: PackedDatasetWriter(os.path.join(output_dir, dirname))
+                for dirname in self.DATASET_DIRNAMES
+            }
+
+        with _extract_map(self.workers) as map_func:
+            for raster, key in zip(self.rasters, keys):
+                digest = get_raster_digest(raster)
+                entry = entries.get(key)
+                if entry and entry['digest'] == digest:
+                    _logger.info('Raster %s did not change, skip it', raster)
+                    continue
+                if entry:
+                    _logger.info('Raster %s changed, delete its tiles',
+                                 raster)
+                    _remove_tiles(output_dir, entries.pop(key)['tiles'])
+
+                tiles = self._build_raster(raster, output_dir, shapes,
+                                           vector_crs, contour_shape,
+                                           contour_crs, map_func)
+                entries[key] = dict(digest=digest, tiles=tiles)
+                # Write manifest after each raster, so that an interrupted
+                # build can be resumed.  Packed datasets are written when
+                # closed, so they cannot be resumed.
+                if not self._packed_writers:
+                    self._write_metadata(
+                        output_dir, dict(params=params, rasters=entries))
+
+        if self._packed_writers:
+            for writer in self._packed_writers.values():
+                writer.close()
+            self._packed_writers = None
+
+        self._write_metadata(output_dir,
+                             dict(params=params, rasters=entries))
+
+    def _is_packed_trainset_current(self, output_dir, manifest, keys):
+        """
+        Return True if packed trainset in +output_dir+ is complete and it
+        was built from the same rasters, with the same contents
+
+        """
+        entries = manifest['rasters']
+        if set(entries) != set(keys):
+            return False
+        if not all(
+                is_packed_dataset(os.path.join(output_dir, dirname))
+                for dirname in self.DATASET_DIRNAMES):
+            return False
+        return all(entries[key]['digest'] == get_raster_digest(raster)
+                   for raster, key in zip(self.rasters, keys))
+
+    def partition(self):
+        """
+        Partition windows of all rasters into true and false samples
+
+        Windows are partitioned as in +build+, but no image is extracted
+        (e.g. for training directly from rasters).  Returns a tuple with a
+        list of true samples and a list of false samples, as (raster,
+        window) tuples, and a dictionary of percentiles for rescaling the
+        intensity of each raster (None if intensity is not rescaled).
+
+        """
+        shapes, vector_crs = self._read_shapes()
+        contour_shape, contour_crs = self._load_raster_contour_polygon()
+        self._shapes_index = create_index(shapes)
+        self._projected_shapes = {}
+
+        true_samples, false_samples, percentiles = [], [], {}
         for raster in self.rasters:
             _logger.info('Processing raster %s', raster)
+            with rasterio.open(raster) as src:
+                new_shapes, new_contour_shape = self._raster_shapes(
+                    src, shapes, vector_crs, contour_shape, contour_crs)
+                grid, mask = self._sliding_windows(src, new_contour_shape)
+                matching, non_matching = self._partition_windows(
+                    grid, mask, new_shapes)
+            true_samples.extend((raster, w) for w in matching)
+            false_samples.extend((raster, w) for w in non_matching)
+            percentiles[raster] = self._calculate_percentiles(raster, None)
+
+        _logger.info('Total true samples: %d, false samples: %d',
+                     len(true_samples), len(false_samples))
+        return true_samples, false_samples, percentiles
+
+    def _build_raster(self, raster, output_dir, shapes, vector_crs,
+                      contour_shape, contour_crs, map_func):
+        """
+        Extract samples of +raster+, and return a list of paths of emitted
+        tiles, relative to +output_dir+
 
-            raster_crs = get_raster_crs(raster)
-            _logger.info('Raster CRS is %s', raster_crs)
-
-            percentiles = self._calculate_percentiles(raster)
+        Raster is opened only once, and all metadata is taken from it.  If
+        intensity is rescaled and the histogram of the raster is not cached,
+        it is calculated on the same pass that reads samples (see
+        +_scan_raster+), so the raster is read only once.
 
-            if contour_shape:
-                new_contour_shape = self._reproject_contour_shape(
-                    contour_shape, contour_crs, raster_crs)
-            else:
-                new_contour_shape = None
+        """
+        _logger.info('Processing raster %s', raster)
 
-            new_shapes = self._reproject_shapes(shapes, vector_crs, raster_crs)
-            new_shapes = self._apply_buffer(new_shapes)
-            new_shapes = self._intersection_with_raster_extent(
-                new_shapes, raster)
+        with rasterio.open(raster) as src:
+            new_shapes, new_contour_shape = self._raster_shapes(
+                src, shapes, vector_crs, contour_shape, contour_crs)
 
-            self._extract_samples(
-                raster=raster,
+            samples = self._samples(
+                src,
                 shapes=new_shapes,
                 output_dir=output_dir,
-                percentiles=percentiles,
                 contour_polygon=new_contour_shape)
 
-        self._write_metadata(output_dir)
+            # Spill file has all samples of the raster, so it is not stored
+            # on the system temporary directory, which may be small
+            with tempfile.TemporaryDirectory(
+                    prefix='aplatam_scan',
+                    dir=self.tmp_dir or output_dir) as tmpdir:
+                spill_path = os.path.join(tmpdir, 'samples.npy')
+
+                def scan():
+                    return self._scan_raster(src, samples, spill_path)
+
+                percentiles = self._calculate_percentiles(raster, scan)
+                # Read samples from the spill file if raster was scanned
+                source = spill_path if os.path.exists(spill_path) else raster
+                saved = self._extract_images(samples, source, percentiles,
+                                             src.block_shapes[0][0], map_func)
+        return [os.path.relpath(path, output_dir) for path in saved]
+
+    def _raster_shapes(self, src, shapes, vector_crs, contour_shape,
+                       contour_crs):
+        """Return shapes and contour shape for dataset +src+, on its CRS"""
+        _logger.info('Raster CRS is %s', src.crs)
+        if contour_shape:
+            new_contour_shape = self._reproject_contour_shape(
+                contour_shape, contour_crs, src.crs)
+        else:
+            new_contour_shape = None
+        new_shapes = self._shapes_in_raster(shapes, vector_crs, src.crs,
+                                            src.bounds)
+        return new_shapes, new_contour_shape
 
     def _reproject_contour_shape(self, contour_shape, contour_crs, raster_crs):
-        if self.rasters_contour and contour_crs != raster_crs:
+        if self.rasters_contour and crs_key(contour_crs) != crs_key(
+                raster_crs):
             _logger.info('Reproject raster contour shape from %s to %s',
                          contour_crs, raster_crs)
             return reproject_shape(contour_shape, contour_crs, raster_crs)
@@ -153,9 +364,36 @@ class CnnTrainsetBuilder:
                 rasters_contour_crs = src.crs
         return rasters_contour_shape, rasters_contour_crs
 
-    def _intersection_with_raster_extent(self, shapes, raster):
-        with rasterio.open(raster) as src:
-            raster_bbox = box(*src.bounds)
+    def _shapes_in_raster(self, shapes, vector_crs, raster_crs, bounds):
+        """
+        Return +shapes+ inside +bounds+, reprojected to +raster_crs+ and
+        buffered
+
+        Shapes are first filtered with an R-Tree index by the extent of the
+        raster on the vector CRS, so that only shapes near the raster are
+        reprojected.  Reprojected and buffered shapes are memoized by CRS,
+        so each shape is reprojected at most once for all rasters on the
+        same CRS.
+
+        """
+        vector_bounds = _reproject_bounds(bounds, raster_crs, vector_crs)
+        ids = sorted(self._shapes_index.intersection(vector_bounds))
+        _logger.info('There are %d shapes near current raster extent',
+                     len(ids))
+
+        projected = self._projected_shapes.setdefault(crs_key(raster_crs), {})
+        new_ids = [i for i in ids if i not in projected]
+        if new_ids:
+            new_shapes = self._reproject_shapes([shapes[i] for i in new_ids],
+                                                vector_crs, raster_crs)
+            new_shapes = self._apply_buffer(new_shapes)
+            projected.update(zip(new_ids, new_shapes))
+
+        return self._intersection_with_raster_extent(
+            [projected[i] for i in ids], bounds)
+
+    def _intersection_with_raster_extent(self, shapes, bounds):
+        raster_bbox = box(*bounds)
         filtered_shapes = [
             shape for shape in shapes if raster_bbox.contains(shape)
         ]
@@ -164,27 +402,18 @@ class CnnTrainsetBuilder:
             len(filtered_shapes), len(shapes))
         return filtered_shapes
 
-    def _extract_samples(self,
-                         raster,
-                         shapes,
-                         output_dir,
-                         percentiles=None,
-                         contour_polygon=None):
-
-        index = create_index(shapes)
+    def _samples(self, src, shapes, output_dir, contour_polygon=None):
+        """
+        Return a list of samples of dataset +src+, as (window, image path)
 
-        windows_and_boxes = self._sliding_windows(raster)
-        _logger.info('Total windows: %d', len(windows_and_boxes))
+        Samples are sorted by window, so that they are read in row-major
+        order.
 
-        if contour_polygon:
-            windows_and_boxes = [(w, b) for w, b in windows_and_boxes
-                                 if contour_polygon.intersection(b)]
-            _logger.info(
-                'Total windows (after filtering with raster contour shape): %d',
-                len(windows_and_boxes))
+        """
+        grid, mask = self._sliding_windows(src, contour_polygon)
 
         matching_windows, non_matching_windows = self._partition_windows(
-            windows_and_boxes, shapes, index)
+            grid, mask, shapes)
 
         _logger.info('Total matching windows: %d', len(matching_windows))
         _logger.info('Total non-matching windows: %d',
@@ -197,46 +426,153 @@ class CnnTrainsetBuilder:
             test_size=self.test_size,
             balancing_multiplier=self.balancing_multiplier)
 
-        # Extract and store images
+        samples = []
         for i, windows in enumerate(datasets):
             dirname = self.DATASET_DIRNAMES[i]
             for j, cls_name in enumerate(('t', 'f')):
-                # Create directory
-                os.makedirs(
-                    os.path.join(output_dir, dirname, cls_name), exist_ok=True)
-                # Extract image
-                self._extract_images_from_windows(
-                    windows[j], raster, percentiles,
-                    os.path.join(output_dir, dirname, cls_name))
-
-    def _sliding_windows(self, raster):
-        with rasterio.open(raster) as src:
-            windows = sliding_windows(
-                self.size, self.step_size, height=src.height, width=src.width)
-            return [(win, box(*src.window_bounds(win))) for win in windows]
-
-    def _partition_windows(self, windows_and_boxes, shapes, index):
-        matching_windows = []
-        non_matching_windows = []
-        for win, wbox in windows_and_boxes:
-            matching_shapes = [
-                shapes[i] for i in index.intersection(wbox.bounds)
-            ]
-            if matching_shapes and any(
-                    shape.intersection(wbox) for shape in matching_shapes):
-                matching_windows.append(win)
+                img_dir = os.path.join(output_dir, dirname, cls_name)
+                if not self._packed_writers:
+                    os.makedirs(img_dir, exist_ok=True)
+                samples.extend((window,
+                                os.path.join(img_dir,
+                                             self._prepare_img_filename(
+                                                 src.name, window)))
+                               for window in windows[j])
+        return sorted(samples, key=lambda s: (s[0].row_off, s[0].col_off))
+
+    def _sliding_windows(self, src, contour_polygon=None):
+        """Return grid of windows of +src+ and a mask of windows to use"""
+        grid = WindowGrid.from_dataset(
+            src, size=self.size, step_size=self.step_size)
+        _logger.info('Total windows: %d', len(grid))
+
+        mask = np.ones(grid.shape, dtype=bool)
+        if contour_polygon:
+            mask = contour_window_mask(src.name, grid, self.rasters_contour,
+                                       lambda: contour_polygon)
+            _logger.info(
+                'Total windows (after filtering with raster contour shape): %d',
+                mask.sum())
+        return grid, mask
+
+    def _partition_windows(self, grid, mask, shapes):
+        """
+        Partition windows of +grid+ in +mask+ into matching and non-matching
+
+        All shapes are rasterized at once on the grid (see
+        +WindowGrid.intersects+ and +WindowGrid.coverage+), instead of
+        testing each window against each shape.
+
+        """
+        union = unary_union(shapes)
+        intersects = grid.intersects(union) & mask
+        matching = intersects
+        if self.min_overlap > 0:
+            coverage = grid.coverage(union, mask=intersects)
+            matching = intersects & (coverage >= self.min_overlap)
+            _logger.info(
+                '%d windows ignored, as they are covered less than %f',
+                (intersects & ~matching).sum(), self.min_overlap)
+        return grid.windows(matching), grid.windows(mask & ~intersects)
+
+    def _extract_images(self, samples, source, percentiles, block_height,
+                        map_func):
+        """
+        Extract and save images of +samples+, a list of (window, image path)
+
+        Samples are split into batches of windows on the same rows of blocks
+        of height +block_height+, which are extracted with +map_func+ (e.g.
+        on a pool of workers) from +source+, either the raster or a spill
+        file written by +_scan_raster+.  File names only depend on windows,
+        so output is the same regardless of the number of workers.
+
+        On packed format, workers send images back, and they are written to
+        the packed dataset in the same order as batches.
+
+        Returns a list of paths of saved images.
+
+        """
+        packed = bool(self._packed_writers)
+        tasks = [(source, percentiles, self.rescale_intensity, batch, packed)
+                 for batch in self._batches(samples, block_height)]
+        saved = []
+        for res in tqdm.tqdm(
+                map_func(_extract_batch, tasks), total=len(tasks)):
+            if packed:
+                for img_path, rgb in res:
+                    self._write_packed(img_path, rgb)
+                    saved.append(img_path)
             else:
-                non_matching_windows.append(win)
-        return matching_windows, non_matching_windows
+                saved.extend(res)
+        _logger.info('%d images saved (%d low contrast images skipped)',
+                     len(saved),
+                     len(samples) - len(saved))
+        return saved
+
+    def _write_packed(self, img_path, rgb):
+        img_dir, name = os.path.split(img_path)
+        dirname, cls_name = os.path.split(img_dir)
+        label = 1 if cls_name == 't' else 0
+        self._packed_writers[os.path.basename(dirname)].write(
+            rgb, label, name)
+
+    def _batches(self, samples, block_height):
+        """
+        Split +samples+ into batches of windows on the same block rows
 
-    def _extract_images_from_windows(self, windows, raster, percentiles,
-                                     output_dir):
-        with rasterio.open(raster) as src:
-            for window in windows:
-                fname = self._prepare_img_filename(raster, window)
-                rgb = self._extract_img(src, window, percentiles=percentiles)
-                if not exposure.is_low_contrast(rgb):
-                    self._save_jpg(output_dir, fname, rgb)
+        Each item of a batch is a tuple (index, window, image path), where
+        index is the position of the sample in +samples+.
+
+        """
+        batch, batch_block_row = [], None
+        for i, (window, img_path) in enumerate(samples):
+            block_row = window.row_off // block_height
+            if batch and (block_row != batch_block_row
+                          or len(batch) >= EXTRACT_BATCH_SIZE):
+                yield batch
+                batch = []
+            batch.append((i, window, img_path))
+            batch_block_row = block_row
+        if batch:
+            yield batch
+
+    def _scan_raster(self, src, samples, spill_path):
+        """
+        Calculate histogram of dataset +src+ while reading its +samples+
+
+        All rows of the raster are read once, in strips of +block_size+
+        times its block height (see +scan_raster+).  Images of samples are
+        copied to a spill file at +spill_path+, which is local and can be
+        memory-mapped by workers, so that they do not read the raster again.
+        Returns a +Histogram+.
+
+        """
+        _logger.info('Calculate histogram of %s and read samples', src.name)
+        dtype = src.dtypes[0]
+        builder = HistogramBuilder(dtype, 3)
+        images = None
+        if samples:
+            images = np.lib.format.open_memmap(
+                spill_path,
+                mode='w+',
+                dtype=dtype,
+                shape=(len(samples), self.size, self.size, 3))
+
+        i = 0
+        strip_height = self.block_size * src.block_shapes[0][0]
+        scan = scan_raster(
+            src, [w for w, _ in samples], strip_height=strip_height)
+        for data, strip_images in tqdm.tqdm(
+                scan, total=-(-src.height // strip_height)):
+            builder.add(data)
+            for img in strip_images:
+                images[i] = img
+                i += 1
+
+        if images is not None:
+            images.flush()
+            del images
+        return builder.histogram()
 
     def _read_shapes(self):
         """Read features from the vector file and return their geometry shapes"""
@@ -250,9 +586,10 @@ class CnnTrainsetBuilder:
 
     def _reproject_shapes(self, shapes, src_crs, dst_crs):
         """Reproject shapes from CRS +src_crs+ to +dst_crs+"""
-        if dict(src_crs) != dict(dst_crs):
-            _logger.info('Reproject shapes from %s to %s', src_crs, dst_crs)
-            return [reproject_shape(s, src_crs, dst_crs) for s in shapes]
+        if crs_key(src_crs) != crs_key(dst_crs):
+            _logger.info('Reproject %d shapes from %s to %s', len(shapes),
+                         src_crs, dst_crs)
+            return reproject_shapes(shapes, src_crs, dst_crs)
         else:
             return shapes
 
@@ -265,20 +602,25 @@ class CnnTrainsetBuilder:
         else:
             return shapes
 
-    def _calculate_percentiles(self, raster):
+    def _calculate_percentiles(self, raster, scan):
+        """
+        Calculate percentiles of +raster+ for intensity rescaling
+
+        If histogram is not cached and it is calculated on the full
+        resolution raster, +scan+ is called to calculate it.
+
+        """
         if self.rescale_intensity:
-            rgb_img = dask_rasterio.read_raster(
-                raster, band=(1, 2, 3), block_size=self.block_size)
-            return tuple(
-                np.percentile(rgb_img, (self.lower_cut, self.upper_cut)))
+            return calculate_percentiles(
+                raster,
+                block_size=self.block_size,
+                decimation=self.stats_decimation,
+                lower_cut=self.lower_cut,
+                upper_cut=self.upper_cut,
+                compute_histogram=scan if self.stats_decimation == 1 else None)
         else:
             return None
 
-    def _save_jpg(self, img_dir, win_fname, rgb):
-        """Save .jpg image from raster"""
-        img_path = os.path.join(img_dir, win_fname)
-        imsave(img_path, rgb)
-
     def _prepare_img_filename(self, raster, window):
         """Prepare img filename"""
         fname, _ = os.path.splitext(os.path.basename(raster))
@@ -286,14 +628,26 @@ class CnnTrainsetBuilder:
             fname=fname, i=window.row_off, j=window.col_off)
         return win_fname
 
-    def _extract_img(self, src, window, percentiles=None):
-        """Extract image from raster and preprocess"""
-        rgb = np.dstack([src.read(b, window=window) for b in range(1, 4)])
-        if self.rescale_intensity:
-            rgb = exposure.rescale_intensity(rgb, in_range=percentiles)
-        return rgb
+    def _manifest_params(self):
+        """Return parameters of the build that determine emitted tiles"""
+        return dict(
+            vector=file_digest(self.vector),
+            rasters_contour=(file_digest(self.rasters_contour)
+                             if self.rasters_contour else None),
+            size=self.size,
+            step_size=self.step_size,
+            buffer_size=self.buffer_size,
+            rescale_intensity=self.rescale_intensity,
+            lower_cut=self.lower_cut,
+            upper_cut=self.upper_cut,
+            stats_decimation=self.stats_decimation,
+            test_size=self.test_size,
+            balancing_multiplier=self.balancing_multiplier,
+            min_overlap=self.min_overlap,
+            format=self.output_format,
+            seed=self.seed)
 
-    def _write_metadata(self, output_dir):
+    def _write_metadata(self, output_dir, manifest):
         write_metadata(
             output_dir,
             version=__version__,
@@ -302,4 +656,136 @@ class CnnTrainsetBuilder:
             buffer_size=self.buffer_size,
             rescale_intensity=self.rescale_intensity,
             lower_cut=self.lower_cut,
-            upper_cut=self.upper_cut)
+            upper_cut=self.upper_cut,
+            min_overlap=self.min_overlap,
+            format=self.output_format,
+            manifest=manifest)
+
+
+def trainset_manifest(output_dir):
+    """
+    Return the manifest of the trainset in +output_dir+
+
+    Returns None if there is no trainset, or if it was built without a
+    manifest.
+
+    """
+    if not os.path.exists(os.path.join(output_dir, METADATA_FILENAME)):
+        return None
+    return read_metadata(output_dir).get('manifest')
+
+
+def _remove_tiles(output_dir, tiles):
+    """Remove +tiles+, paths relative to +output_dir+, if they exist"""
+    for tile in tiles:
+        try:
+            os.remove(os.path.join(output_dir, tile))
+        except FileNotFoundError:
+            pass
+
+
+def _reproject_bounds(bounds, src_crs, dst_crs):
+    """
+    Return bounds that contain +bounds+ reprojected from +src_crs+ to
+    +dst_crs+
+
+    Edges are densified before reprojecting, and result is grown by a small
+    margin, as edges may be curved on +dst_crs+.
+
+    """
+    if crs_key(src_crs) == crs_key(dst_crs):
+        return tuple(bounds)
+    minx, miny, maxx, maxy = bounds
+    steps = np.linspace(0, 1, BOUNDS_DENSIFY_POINTS)
+    xs = np.concatenate([
+        minx + steps * (maxx - minx),
+        np.full_like(steps, maxx),
+        maxx - steps * (maxx - minx),
+        np.full_like(steps, minx)
+    ])
+    ys = np.concatenate([
+        np.full_like(steps, miny),
+        miny + steps * (maxy - miny),
+        np.full_like(steps, maxy),
+        maxy - steps * (maxy - miny)
+    ])
+    xs, ys = reproject_coords(xs, ys, src_crs=src_crs, dst_crs=dst_crs)
+    margin_x = (np.max(xs) - np.min(xs)) * BOUNDS_MARGIN
+    margin_y = (np.max(ys) - np.min(ys)) * BOUNDS_MARGIN
+    return (np.min(xs) - margin_x, np.min(ys) - margin_y,
+            np.max(xs) + margin_x, np.max(ys) + margin_y)
+
+
+@contextmanager
+def _extract_map(workers):
+    """Return a map function that runs on a pool of +workers+ if more than 1"""
+    if workers > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(workers) as pool:
+            yield pool.imap
+    else:
+        try:
+            yield map
+        finally:
+            _close_worker()
+
+
+# Opened sources of the current process, used by +_extract_batch+
+_worker_readers = {}
+
+
+def _extract_batch(task):
+    """
+    Extract images of a batch of samples and save them as JPEG
+
+    Images with low contrast are skipped.  Images are converted to uint8
+    (e.g. 16-bit images are scaled down) as they are saved.  Returns a list
+    of paths of saved images, or if +packed+ is True, a list of (path,
+    image) tuples instead of saving them.
+
+    """
+    source, percentiles, rescale_intensity, batch, packed = task
+
+    saved = []
+    for (_, _, img_path), rgb in zip(batch, _read_images(source, batch)):
+        if rescale_intensity:
+            rgb = exposure.rescale_intensity(rgb, in_range=percentiles)
+        if not exposure.is_low_contrast(rgb):
+            rgb = img_as_ubyte(rgb)
+            if packed:
+                # Copy image, as it may be a view of the current strip
+                saved.append((img_path, np.array(rgb)))
+            else:
+                imsave(img_path, rgb)
+                saved.append(img_path)
+    return saved
+
+
+def _read_images(source, batch):
+    """
+    Generate images of a +batch+ of samples
+
+    +source+ is either a raster, read by windows, or a spill file with
+    images of all samples, read by index.
+
+    """
+    if source not in _worker_readers:
+        # Keep only one source open per process
+        _close_worker()
+        if source.endswith('.npy'):
+            _worker_readers[source] = (None, np.load(source, mmap_mode='r'))
+        else:
+            src = rasterio.open(source)
+            _worker_readers[source] = (src, StripReader(src))
+    src, reader = _worker_readers[source]
+
+    if src is None:
+        return (reader[i] for i, _, _ in batch)
+    return reader.read_windows([window for _, window, _ in batch])
+
+
+def _close_worker():
+    for src, _ in _worker_readers.values():
+        if src is not None:
+            src.close()
+    _worker_readers.clear()
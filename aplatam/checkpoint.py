@@ -0,0 +1,216 @@
+"""This module contains an append-only checkpoint store for predictions"""
+import glob
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import uuid
+from collections import defaultdict
+
+_logger = logging.getLogger(__name__)
+
+PARAMS_FILENAME = 'params.json'
+MERGED_DIRNAME = 'merged'
+LOG_EXT = '.log'
+
+
+class CheckpointStore:
+    """
+    Append-only store of predicted windows, for resuming detection
+
+    A store is a directory with one or more log files of records.  Each
+    process that writes to the store appends to its own log file, so a pool
+    of workers can write concurrently without any locking.  There are two
+    kinds of records:
+
+    * batch records, with the results of a range of windows of a raster
+      and the time they were written
+    * raster records, which mark a raster as completed
+
+    Window ranges refer to indexes on the list of sliding windows of a raster
+    (after filtering by contour shape), so results are the same no matter
+    how rasters were split among workers.
+
+    Arguments:
+        path {string} -- path to the store directory
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def merged_path(self):
+        """
+        Path where results of all records can be saved once merged
+
+        It is removed whenever a new writer is created, as merged results
+        would become stale.
+
+        """
+        return os.path.join(self.path, MERGED_DIRNAME)
+
+    def exists(self):
+        """Return True if the store has been created before"""
+        return os.path.exists(os.path.join(self.path, PARAMS_FILENAME))
+
+    def create(self, **params):
+        """Create an empty store for a run with parameters +params+"""
+        self.clear()
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, PARAMS_FILENAME), 'w') as dst:
+            json.dump(params, dst)
+
+    def clear(self):
+        """Remove store and all of its records"""
+        if os.path.exists(self.path):
+            _logger.info('Remove checkpoint store at %s', self.path)
+            shutil.rmtree(self.path)
+
+    def read_params(self):
+        """Return parameters of the run that created the store"""
+        with open(os.path.join(self.path, PARAMS_FILENAME)) as src:
+            return json.load(src)
+
+    def writer(self):
+        """Return a new writer that appends to its own log file"""
+        shutil.rmtree(self.merged_path, ignore_errors=True)
+        fname = '{}-{}{}'.format(os.getpid(), uuid.uuid4().hex, LOG_EXT)
+        return CheckpointWriter(os.path.join(self.path, fname))
+
+    def load(self):
+        """Read all records in store and return a +Checkpoint+"""
+        checkpoint = Checkpoint()
+        for log_path in self._log_paths():
+            for record in _read_records(log_path):
+                checkpoint.add(record)
+        return checkpoint
+
+    def discard(self, rasters):
+        """
+        Remove all records of +rasters+, so that they are predicted again
+
+        Log files with records of +rasters+ are rewritten without them.  No
+        writer must be open while discarding.
+
+        """
+        rasters = set(rasters)
+        shutil.rmtree(self.merged_path, ignore_errors=True)
+        for log_path in self._log_paths():
+            records = list(_read_records(log_path))
+            kept = [r for r in records if r['raster'] not in rasters]
+            if len(kept) == len(records):
+                continue
+            _logger.info('Discard %d records of %s', len(records) - len(kept),
+                         log_path)
+            tmp_path = '{}.tmp'.format(log_path)
+            with open(tmp_path, 'wb') as dst:
+                for record in kept:
+                    pickle.dump(
+                        record, dst, protocol=pickle.HIGHEST_PROTOCOL)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, log_path)
+
+    def _log_paths(self):
+        return sorted(glob.glob(os.path.join(self.path, '*' + LOG_EXT)))
+
+
+class CheckpointWriter:
+    """Appends records to a log file of a +CheckpointStore+"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def write_batch(self, raster, start, end, results):
+        """Record +results+ of windows +start+ to +end+ of +raster+"""
+        self._write(
+            dict(
+                type='batch',
+                raster=raster,
+                start=start,
+                end=end,
+                results=results,
+                time=time.time()))
+
+    def write_raster(self, raster):
+        """Record that all windows of +raster+ have been predicted"""
+        self._write(dict(type='raster', raster=raster))
+
+    def flush(self):
+        """Flush written records to disk"""
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, record):
+        pickle.dump(record, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.flush()
+
+
+class Checkpoint:
+    """Records loaded from a +CheckpointStore+"""
+
+    def __init__(self):
+        self.done = set()
+        self.batches = defaultdict(list)
+        # Time of the last batch record of each raster (0 for records
+        # written without a time)
+        self.updated = {}
+
+    def add(self, record):
+        """Add a record"""
+        raster = record['raster']
+        if record['type'] == 'raster':
+            self.done.add(raster)
+        else:
+            self.batches[raster].append(
+                (record['start'], record['end'], record['results']))
+            self.updated[raster] = max(
+                self.updated.get(raster, 0), record.get('time', 0))
+
+    def completed_ranges(self, raster):
+        """Return a sorted list of (start, end) ranges predicted on +raster+"""
+        return sorted((start, end) for start, end, _ in self.batches[raster])
+
+    def results(self, rasters):
+        """
+        Return a list of the results of each batch of all +rasters+
+
+        Batches are sorted by raster (in the same order as +rasters+) and by
+        window range, so they are the same as those of a serial run.
+
+        """
+        results = []
+        for raster in rasters:
+            for _, _, batch_results in sorted(
+                    self.batches.get(raster, []), key=lambda b: b[0]):
+                results.append(batch_results)
+        return results
+
+
+def _read_records(path):
+    """Generate records from a log file, ignoring a truncated last record"""
+    with open(path, 'rb') as src:
+        while True:
+            try:
+                yield pickle.load(src)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError) as err:
+                _logger.warning(
+                    'Ignore truncated record at the end of %s (%s)', path, err)
+                break
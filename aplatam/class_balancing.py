@@ -53,3 +53,34 @@ def split_dataset(true_samples,
     _logger.info('f_train=%d, f_test=%d', len(f_train), len(f_test))
 
     return ((t_train, f_train), (t_test, f_test))
+
+
+def split_samples(true_samples, false_samples, test_size=0.25):
+    """
+    Split all true and false samples into training and test datasets
+
+    Unlike +split_dataset+, no samples are dropped for balancing classes, so
+    they can be balanced later (e.g. on each epoch of training).
+
+    Arguments:
+        true_samples {list(obj)} -- list of true samples
+        false_samples {list(obj)} -- list of false samples
+        test_size {float} -- proportion of test set of each class
+
+    """
+    assert test_size >= 0.0 and test_size <= 1.0, (
+        'test_size should be between 0.0 and 1.0')
+
+    random.shuffle(true_samples)
+    random.shuffle(false_samples)
+
+    n_test_t = round(len(true_samples) * test_size)
+    n_test_f = round(len(false_samples) * test_size)
+
+    t_test, t_train = true_samples[:n_test_t], true_samples[n_test_t:]
+    f_test, f_train = false_samples[:n_test_f], false_samples[n_test_f:]
+
+    _logger.info('t_train=%d, t_test=%d', len(t_train), len(t_test))
+    _logger.info('f_train=%d, f_test=%d', len(f_train), len(f_test))
+
+    return ((t_train, f_train), (t_test, f_test))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Select blocks (e.g. city blocks) covered by detected windows, as an
+alternative to dissolving windows.
+
+"""
+import argparse
+import logging
+import sys
+
+from aplatam import __version__
+from aplatam.aggregate import (COVERAGE_MODES, DEFAULT_BLOCKS_PER_TILE,
+                               DEFAULT_COVERAGE, DEFAULT_MIN_COVERAGE,
+                               aggregate_blocks)
+
+__author__ = "Dymaxion Labs"
+__copyright__ = __author__
+__license__ = "new-bsd"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """
+    Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+
+    """
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Select blocks covered by detected windows")
+
+    # Mandatory arguments
+    parser.add_argument('blocks_file', help='blocks vector file')
+    parser.add_argument(
+        'windows_file', help='detected windows vector file (from ap_detect)')
+    parser.add_argument('output', help='output vector file')
+
+    # Options
+
+    parser.add_argument(
+        "--min-coverage",
+        type=float,
+        default=DEFAULT_MIN_COVERAGE,
+        help="minimum coverage of blocks by windows")
+    parser.add_argument(
+        "--coverage",
+        choices=COVERAGE_MODES,
+        default=DEFAULT_COVERAGE,
+        help="'union' for area of the union of windows divided by block "
+        "area, 'block' for the fraction of block area covered by windows")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to aggregate blocks with")
+    parser.add_argument(
+        "--blocks-per-tile",
+        type=int,
+        default=DEFAULT_BLOCKS_PER_TILE,
+        help="approximate number of blocks processed on each task")
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version='aplatam {ver}'.format(ver=__version__))
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action='store_const',
+        const=logging.INFO)
+    parser.add_argument(
+        '-vv',
+        '--very-verbose',
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action='store_const',
+        const=logging.DEBUG)
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """
+    Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel,
+        stream=sys.stdout,
+        format=logformat,
+        datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """
+    Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    aggregate_blocks(
+        blocks_file=args.blocks_file,
+        windows_file=args.windows_file,
+        output_file=args.output,
+        min_coverage=args.min_coverage,
+        workers=args.workers,
+        blocks_per_tile=args.blocks_per_tile,
+        coverage=args.coverage)
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -10,7 +10,9 @@ import logging
 import sys
 
 from aplatam import __version__
+from aplatam.dense import RESNET50_TOLERANCE
 from aplatam.detect import detect
+from aplatam.pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
 
 __author__ = "Dymaxion Labs"
 __copyright__ = __author__
@@ -36,10 +38,15 @@ def parse_args(args):
         description="...")
 
     # Mandatory arguments
-    parser.add_argument('model_file', help='HDF5 Keras model file path')
+    parser.add_argument(
+        'model_file',
+        help='HDF5 Keras model file path, or model exported by ap_export')
     parser.add_argument(
         'input_dir', help='path where test hi-res images are stored')
-    parser.add_argument('output', help='Shapefile output file')
+    parser.add_argument(
+        'output',
+        help=('output vector file (Shapefile, GeoPackage, GeoJSON or '
+              'newline-delimited GeoJSON, given its extension)'))
 
     # Options
 
@@ -89,6 +96,59 @@ def parse_args(args):
         default=98,
         help=
         "upper cut of percentiles for cumulative count in intensity rescaling")
+    parser.add_argument(
+        "--stats-decimation",
+        type=int,
+        default=1,
+        help=("read rasters at 1/N of their resolution when calculating "
+              "percentiles for intensity rescaling (faster, but approximate)"))
+    parser.add_argument(
+        "--preprocess-workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of threads that preprocess batches while predicting")
+    parser.add_argument(
+        "--prefetch-batches",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="maximum number of batches read and preprocessed ahead of model")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=("number of processes to predict with, each one with its own "
+              "copy of the model"))
+    parser.add_argument(
+        "--resume",
+        dest='resume',
+        default=True,
+        action='store_true',
+        help=("resume from predictions of a previous run with the same "
+              "output, skipping rasters and windows already predicted"))
+    parser.add_argument(
+        "--no-resume",
+        dest='resume',
+        action='store_false',
+        help="discard predictions of a previous run and start over")
+    parser.add_argument(
+        "--dissolve",
+        default=False,
+        action='store_true',
+        help="dissolve overlapping windows into polygons")
+    parser.add_argument(
+        "--probability-dir",
+        help=("directory where a raster with the probability of every "
+              "window is written for each input raster (optional)"))
+    parser.add_argument(
+        "--dense",
+        action='store_true',
+        help=("run the model as a fully convolutional network on regions of "
+              "rasters, sharing computation between overlapping windows. "
+              "Step size must be a multiple of 32. Probabilities are "
+              "approximate: pixels around each window replace its zero "
+              "padding, so they may differ by up to {} from predicting each "
+              "window (measured on ResNet-50 with random weights)").format(
+                  RESNET50_TOLERANCE))
 
     parser.add_argument(
         '--version',
@@ -148,6 +208,14 @@ def main(args):
         rescale_intensity=args.rescale_intensity,
         lower_cut=args.lower_cut,
         upper_cut=args.upper_cut,
+        stats_decimation=args.stats_decimation,
+        preprocess_workers=args.preprocess_workers,
+        prefetch_batches=args.prefetch_batches,
+        workers=args.workers,
+        resume=args.resume,
+        dissolve=args.dissolve,
+        probability_dir=args.probability_dir,
+        dense=args.dense,
         neighbours=args.neighbours,
         threshold=args.threshold,
         mean_threshold=args.mean_threshold)
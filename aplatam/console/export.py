@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export a trained model as a frozen graph, for faster loading and inference
+with ap_detect.
+
+"""
+import argparse
+import logging
+import sys
+
+from aplatam import __version__
+from aplatam.export import QUANTIZE_MODES, export_model
+
+__author__ = "Dymaxion Labs"
+__copyright__ = __author__
+__license__ = "new-bsd"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """
+    Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+
+    """
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Export a trained model for inference")
+
+    # Mandatory arguments
+    parser.add_argument('model_file', help='HDF5 Keras model file path')
+    parser.add_argument(
+        'output', help='output frozen graph file (e.g. model.pb)')
+
+    # Options
+
+    parser.add_argument(
+        "--quantize",
+        choices=QUANTIZE_MODES,
+        help=("store weights with lower precision, for a smaller model "
+              "file. Computation is still in float32"))
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version='aplatam {ver}'.format(ver=__version__))
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action='store_const',
+        const=logging.INFO)
+    parser.add_argument(
+        '-vv',
+        '--very-verbose',
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action='store_const',
+        const=logging.DEBUG)
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """
+    Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel,
+        stream=sys.stdout,
+        format=logformat,
+        datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def main(args):
+    """
+    Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    export_model(args.model_file, args.output, quantize=args.quantize)
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -11,11 +11,11 @@ import random
 import sys
 import warnings
 
-import rasterio
-
 from aplatam import __version__
-from aplatam.build_trainset import CnnTrainsetBuilder
-from aplatam.train_classifier import train
+from aplatam.build_trainset import (OUTPUT_FORMATS, CnnTrainsetBuilder,
+                                    trainset_manifest)
+from aplatam.stats import get_raster_info
+from aplatam.train_classifier import HEADS, train, train_streaming
 from aplatam.util import all_raster_files
 
 __author__ = "Dymaxion Labs"
@@ -77,6 +77,12 @@ def parse_args(args):
         default=0,
         help=
         "if buffer_size > 0, polygons are expanded with a fixed-sized buffer")
+    parser.add_argument(
+        "--min-overlap",
+        type=float,
+        default=0,
+        help=("minimum fraction of a window covered by polygons for a true "
+              "sample. Windows covered less than this are not used"))
     parser.add_argument(
         "--rasters-contour",
         help="path to rasters contour vector file (optional)")
@@ -103,8 +109,54 @@ def parse_args(args):
         default=98,
         help=
         "upper cut of percentiles for cumulative count in intensity rescaling")
+    parser.add_argument(
+        "--stats-decimation",
+        type=int,
+        default=1,
+        help=("read rasters at 1/N of their resolution when calculating "
+              "percentiles for intensity rescaling (faster, but approximate)"))
     parser.add_argument(
         "--block-size", type=int, default=1, help="block size multiplier")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes that extract images of the trainset")
+    parser.add_argument(
+        "--tmp-dir",
+        help=("directory for temporary files while building the trainset "
+              "(default: OUTPUT_DIR)"))
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default='jpeg',
+        help=("format of the trainset: JPEG files, or packed shards of "
+              "arrays that are memory-mapped on training"))
+    parser.add_argument(
+        "--streaming",
+        action='store_true',
+        help=("train reading images directly from rasters, with false "
+              "samples balanced again on each epoch, instead of building a "
+              "trainset on OUTPUT_DIR"))
+    parser.add_argument(
+        "--head",
+        choices=HEADS,
+        default='flatten',
+        help=("layers on top of ResNet-50: flattened activations, or global "
+              "average pooling for a much smaller and faster model"))
+    parser.add_argument(
+        "--dense-units",
+        type=int,
+        help=("number of units of the dense layer of the head (default: 1024 "
+              "for flatten, 256 for gap)"))
+    parser.add_argument(
+        "--cache-embeddings",
+        action='store_true',
+        help=("cache activations of frozen layers for each image of the "
+              "trainset, and train only the trainable layers on them. "
+              "Frozen batch normalization layers use their moving "
+              "statistics (as on detection) instead of batch statistics, "
+              "so the trained model differs slightly"))
     parser.add_argument(
         "--test-size",
         type=float,
@@ -186,13 +238,19 @@ def main(args):
         size=args.size,
         step_size=args.step_size,
         buffer_size=args.buffer_size,
+        min_overlap=args.min_overlap,
         rescale_intensity=args.rescale_intensity,
         lower_cut=args.lower_cut,
         upper_cut=args.upper_cut,
         block_size=args.block_size,
+        stats_decimation=args.stats_decimation,
         test_size=args.test_size,
         balancing_multiplier=args.balancing_multiplier,
-        rasters_contour=args.rasters_contour)
+        rasters_contour=args.rasters_contour,
+        workers=args.workers,
+        output_format=args.output_format,
+        tmp_dir=args.tmp_dir,
+        seed=args.seed)
     _logger.info('Options: %s', opts)
 
     # Set seed number
@@ -201,13 +259,41 @@ def main(args):
         random.seed(args.seed)
 
     _logger.info('Collect all rasters from %s', args.rasters_dir)
-    rasters = all_raster_files(args.rasters_dir)
+    # Sort rasters, so that samples are the same for the same seed
+    rasters = sorted(all_raster_files(args.rasters_dir))
 
     validate_rasters_band_count(rasters)
 
-    if not os.path.exists(args.output_dir):
+    if args.streaming:
+        builder = CnnTrainsetBuilder(rasters, args.vector, **opts)
+        true_samples, false_samples, percentiles = builder.partition()
+        os.makedirs(os.path.dirname(output_model) or '.', exist_ok=True)
+        train_streaming(
+            output_model,
+            true_samples,
+            false_samples,
+            percentiles,
+            trainable_layers=args.trainable_layers,
+            batch_size=args.batch_size,
+            epochs=args.epochs,
+            size=args.size,
+            test_size=args.test_size,
+            balancing_multiplier=args.balancing_multiplier,
+            head=args.head,
+            dense_units=args.dense_units,
+            seed=args.seed)
+        _logger.info('Done')
+        return
+
+    # Trainsets with a manifest are updated incrementally.  Older trainsets
+    # are left as they are.
+    if (not os.path.exists(args.output_dir)
+            or trainset_manifest(args.output_dir)):
         builder = CnnTrainsetBuilder(rasters, args.vector, **opts)
         builder.build(args.output_dir)
+    else:
+        _logger.info('Trainset at %s has no manifest, skip build',
+                     args.output_dir)
 
     # Train and save model
     train(
@@ -216,7 +302,10 @@ def main(args):
         trainable_layers=args.trainable_layers,
         batch_size=args.batch_size,
         epochs=args.epochs,
-        size=args.size)
+        size=args.size,
+        head=args.head,
+        dense_units=args.dense_units,
+        cache_embeddings=args.cache_embeddings)
 
     _logger.info('Done')
 
@@ -245,8 +334,7 @@ def validate_rasters_band_count(rasters):
 
 def get_raster_band_count(raster_path):
     """Return band count of +raster_path+"""
-    with rasterio.open(raster_path) as dataset:
-        return dataset.count
+    return get_raster_info(raster_path)['count']
 
 
 def run():
@@ -0,0 +1,140 @@
+"""This module contains a fully convolutional version of a window classifier"""
+import logging
+
+import numpy as np
+from keras import backend as K
+from keras.layers import (AveragePooling2D, Dense, Dropout, Flatten,
+                          GlobalAveragePooling2D, Input, InputLayer)
+from keras.models import Model
+
+from aplatam.train_classifier import replay_layers
+
+_logger = logging.getLogger(__name__)
+
+# Layers that can be on top of the convolutional trunk of a model
+TAIL_LAYERS = (AveragePooling2D, GlobalAveragePooling2D, Flatten, Dense,
+               Dropout)
+
+# Maximum number of pixels of each tile the trunk is run on
+DEFAULT_TILE_PIXELS = 2**21
+
+# Maximum difference between probabilities of a dense ResNet-50 classifier
+# and predicting each window, measured with random weights
+RESNET50_TOLERANCE = 0.9
+
+
+class DenseModel:
+    """
+    Fully convolutional version of a window classifier
+
+    Layers of +model+ are split into a convolutional trunk and a tail of
+    pooling and dense layers.  The trunk is rebuilt for inputs of any size,
+    so that it runs once on a whole region of a raster, and activations of
+    overlapping windows are calculated once instead of once for each
+    window.  The tail then runs on activations of each window, cropped from
+    activations of the region.
+
+    Windows must be aligned to the stride of the trunk (32 pixels for
+    ResNet-50).  Probabilities are the same as predicting each window with
+    +model+ if convolutions do not pad their inputs.  Otherwise (e.g.
+    ResNet-50), zero padding at the borders of each window is replaced by
+    the pixels around it, so probabilities differ.  The receptive field of
+    ResNet-50 is larger than a window, so every activation is affected: with
+    random weights, probabilities differ by up to +RESNET50_TOLERANCE+.
+
+    Arguments:
+        model {keras.models.Model} -- window classifier
+
+    Keyword Arguments:
+        tile_pixels {int} -- maximum number of pixels of each tile the trunk
+            is run on (default: {DEFAULT_TILE_PIXELS})
+
+    """
+
+    def __init__(self, model, tile_pixels=DEFAULT_TILE_PIXELS):
+        self.model = model
+        self.input_shape = model.input_shape
+        self.size = model.input_shape[1]
+        self.tile_pixels = tile_pixels
+
+        layers = model.layers
+        split = len(layers)
+        while split > 0 and isinstance(layers[split - 1], TAIL_LAYERS):
+            split -= 1
+        if (split == len(layers)
+                or len(K.int_shape(layers[split].get_input_at(0))) != 4):
+            raise ValueError('Model has no convolutional trunk followed by '
+                             'pooling and dense layers')
+        trunk_output = layers[split].get_input_at(0)
+
+        bands = model.input_shape[-1]
+        inputs = Input(shape=(None, None, bands))
+        outputs = replay_layers(
+            [l for l in layers[:split] if not isinstance(l, InputLayer)],
+            {model.input.name: inputs})
+        self._trunk = Model(inputs=inputs, outputs=outputs)
+
+        self.features_size = K.int_shape(trunk_output)[1]
+        inputs = Input(shape=K.int_shape(trunk_output)[1:])
+        outputs = replay_layers(layers[split:], {trunk_output.name: inputs})
+        self._tail = Model(inputs=inputs, outputs=outputs)
+
+        # Trunk activations of a window twice as large span +size+ pixels
+        # more, so their difference is +size+ divided by the stride
+        double_size = self._trunk.compute_output_shape(
+            (1, 2 * self.size, 2 * self.size, bands))[1]
+        self.stride = self.size // (double_size - self.features_size)
+        _logger.info('Dense model has a stride of %d pixels', self.stride)
+
+    def predict(self, images, batch_size=32):
+        """Return an array of predictions for +images+, as +model+"""
+        return self.model.predict(images, batch_size=batch_size)
+
+    def predict_windows(self, image, offsets):
+        """
+        Return an array of predictions of windows of +image+ at +offsets+
+
+        +image+ is a preprocessed image of a region of a raster, and
+        +offsets+ an array of (row, col) pixel offsets of windows on the
+        region, that must be multiples of +stride+.  Region is split into
+        tiles of at most +tile_pixels+ pixels, so that activations of the
+        trunk fit in memory.
+
+        """
+        offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        if np.any(offsets % self.stride):
+            raise ValueError(
+                'Windows must be aligned to a stride of {} pixels'.format(
+                    self.stride))
+
+        preds = np.empty(
+            (len(offsets), ) + self._tail.output_shape[1:], dtype=np.float32)
+        max_width = max(self.size, self.tile_pixels // image.shape[0])
+
+        # Tiles are vertical stripes of the region, each with windows whose
+        # columns are at most +max_width+ pixels apart
+        order = np.argsort(offsets[:, 1], kind='mergesort')
+        sorted_cols = offsets[order, 1]
+        start = 0
+        while start < len(order):
+            col_off = sorted_cols[start]
+            end = np.searchsorted(
+                sorted_cols, col_off + max_width - self.size, side='right')
+            tile_windows = order[start:end]
+
+            row_off = offsets[tile_windows, 0].min()
+            row_end = offsets[tile_windows, 0].max() + self.size
+            col_end = offsets[tile_windows, 1].max() + self.size
+            tile = image[row_off:row_end, col_off:col_end]
+            features = self._trunk.predict(tile[np.newaxis])[0]
+
+            rows = (offsets[tile_windows, 0] - row_off) // self.stride
+            cols = (offsets[tile_windows, 1] - col_off) // self.stride
+            crops = np.array([
+                features[r:r + self.features_size, c:c + self.features_size]
+                for r, c in zip(rows, cols)
+            ])
+            preds[tile_windows] = self._tail.predict(crops)
+            start = end
+
+        return preds
@@ -1,27 +1,46 @@
+import bisect
 import glob
 import logging
+import multiprocessing
+import multiprocessing.util
 import os
-import pickle
+from functools import partial
 
-import dask_rasterio
 import fiona
 import keras
 import numpy as np
 import rasterio as rio
+import tensorflow as tf
 import tqdm
 from keras.applications import resnet50
-from shapely.geometry import box, shape
+from shapely.geometry import shape
+from rasterio.windows import Window
 from skimage import exposure
 
-from aplatam.post_process import filter_features_by_mean_prob
-from aplatam.util import (ShapeWithProps, reproject_shape, sliding_windows,
-                          write_shapefile, grouper)
+from aplatam.checkpoint import CheckpointStore
+from aplatam.dense import DenseModel
+from aplatam.export import FrozenGraphModel, is_exported_model
+from aplatam.grid import WindowGrid, contour_window_mask
+from aplatam.pipeline import (DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS,
+                              BatchPipeline, StageTimer)
+from aplatam.post_process import (DISSOLVED_PROPERTIES, dissolve_predictions,
+                                  filter_predictions_by_mean_prob)
+from aplatam.predictions import Predictions, is_saved_predictions
+from aplatam.probability_raster import (is_probability_raster_current,
+                                        open_probability_raster,
+                                        probability_raster_path)
+from aplatam.stats import calculate_percentiles
+from aplatam.train_classifier import read_model_metadata
+from aplatam.util import reproject_shape, vector_driver, write_vector
+from aplatam.window_reader import StripReader
 
 _logger = logging.getLogger(__name__)
 
-WGS84_CRS = {"init": "epsg:4326"}
 BATCH_SIZE = 100
 
+# Number of rows of windows predicted at once on dense prediction
+DENSE_BAND_ROWS = 4
+
 
 def detect(model_file,
            input_dir,
@@ -31,56 +50,193 @@ def detect(model_file,
            rescale_intensity=True,
            lower_cut=2,
            upper_cut=98,
+           stats_decimation=1,
+           preprocess_workers=DEFAULT_WORKERS,
+           prefetch_batches=DEFAULT_QUEUE_SIZE,
+           workers=1,
+           resume=True,
+           dissolve=False,
+           probability_dir=None,
+           dense=False,
            *,
            neighbours,
            threshold,
            mean_threshold):
 
-    fname, _ = os.path.splitext(output)
-    predictions_path = '{}.pred.pkl'.format(fname)
+    # Fail early on an unknown output format
+    driver = vector_driver(output)
 
-    if os.path.exists(predictions_path):
-        with open(predictions_path, 'rb') as file:
-            shapes_with_props = pickle.load(file)
-        _logger.info(
-            'Going to reuse existing %s predictions file from a previous run',
-            predictions_path)
+    fname, _ = os.path.splitext(output)
+    store = CheckpointStore('{}.pred'.format(fname))
+
+    opts = dict(
+        step_size=step_size,
+        rasters_contour=rasters_contour,
+        rescale_intensity=rescale_intensity,
+        lower_cut=lower_cut,
+        upper_cut=upper_cut,
+        stats_decimation=stats_decimation,
+        threshold=threshold,
+        preprocess_workers=preprocess_workers,
+        prefetch_batches=prefetch_batches)
+
+    rasters = find_rasters(input_dir)
+    _logger.info(rasters)
 
-        shapes_with_props = [
-            s for s in shapes_with_props if s.props['prob'] >= threshold]
-        _logger.info('Filter windows again based on threshold %d: %d remaining',
-                threshold, len(shapes_with_props))
+    probability_paths = None
+    if probability_dir:
+        probability_paths = {
+            raster: probability_raster_path(probability_dir, input_dir, raster)
+            for raster in rasters
+        }
+
+    # Dense predictions differ slightly from sliding-window ones, so they
+    # are not mixed on a resumed run
+    prepare_checkpoint_store(
+        store, model_file, resume=resume, dense=dense, **opts)
+    checkpoint = store.load()
+    if probability_paths:
+        checkpoint = discard_incomplete_probability_rasters(
+            store, checkpoint, probability_paths)
+
+    pending_rasters = [r for r in rasters if r not in checkpoint.done]
+    if pending_rasters:
+        _logger.info('%d of %d rasters pending', len(pending_rasters),
+                     len(rasters))
+        if workers > 1:
+            predict_images_parallel(
+                pending_rasters,
+                model_file,
+                store,
+                checkpoint=checkpoint,
+                workers=workers,
+                probability_paths=probability_paths,
+                dense=dense,
+                **opts)
+        else:
+            model = load_model(model_file, dense=dense)
+            img_size = model.input_shape[1]
+
+            predict_images(
+                pending_rasters,
+                model,
+                img_size,
+                store,
+                checkpoint=checkpoint,
+                probability_paths=probability_paths,
+                **opts)
+
+        checkpoint = store.load()
     else:
-        model = keras.models.load_model(model_file)
-        img_size = model.input_shape[1]
-
-        if not step_size:
-            step_size = img_size
-
-        shapes_with_props = predict_images(
-            input_dir,
-            model,
-            img_size,
-            save_to=predictions_path,
-            step_size=step_size,
-            rasters_contour=rasters_contour,
-            rescale_intensity=rescale_intensity,
-            lower_cut=lower_cut,
-            upper_cut=upper_cut,
-            threshold=threshold)
+        _logger.info(
+            'Going to reuse existing %s predictions from a previous run',
+            store.path)
 
-    _logger.info('Total detected windows: %d', len(shapes_with_props))
+    predictions = load_predictions(store, checkpoint, rasters)
+    predictions = predictions[predictions.prob >= threshold]
+    _logger.info('Total detected windows: %d', len(predictions))
 
     # Filter out polygons with low probablity by calculating
     # mean probability from neighbours.
-    shapes_with_props = filter_features_by_mean_prob(
-        shapes_with_props, neighbours, mean_threshold)
-
-    # Extend polygons with a small buffer, and dissolve overlapping polygons
-    #shapes_with_props = dissolve_overlapping_shapes(shapes_with_props, buffer_size=None)
-
-    write_shapefile(shapes_with_props, output)
-    #write_geojson(shapes_with_props, output)
+    predictions = filter_predictions_by_mean_prob(predictions, neighbours,
+                                                  mean_threshold)
+
+    if dissolve:
+        # Dissolve overlapping windows into polygons
+        write_vector(
+            dissolve_predictions(predictions),
+            output,
+            driver=driver,
+            properties=DISSOLVED_PROPERTIES)
+    else:
+        write_vector(
+            predictions.iter_shapes(),
+            output,
+            driver=driver,
+            properties={
+                'prob': 'float',
+                'prob_mean': 'float'
+            })
+
+
+def load_predictions(store, checkpoint, rasters):
+    """
+    Return predictions of +rasters+ recorded on +store+
+
+    The first time, records are merged into a single set of predictions and
+    saved in columnar format inside the store, which is memory-mapped on
+    following runs.  A partially saved merge (e.g. from an interrupted run
+    of an older version) is merged again.
+
+    """
+    if is_saved_predictions(store.merged_path):
+        predictions = Predictions.load(store.merged_path)
+    else:
+        predictions = Predictions.concatenate(
+            checkpoint.results(sorted(checkpoint.done)))
+        predictions.save(store.merged_path)
+    return predictions.select_rasters(rasters)
+
+
+def discard_incomplete_probability_rasters(store, checkpoint,
+                                           probability_paths):
+    """
+    Discard records of rasters whose probability raster is incomplete
+
+    Records only have windows above the threshold, so probabilities of
+    windows predicted on a previous run cannot be written again from them.
+    Instead, rasters with recorded batches whose probability raster is
+    missing or older than their last batch are predicted again.  Returns
+    the updated checkpoint.
+
+    """
+    incomplete = [
+        raster for raster, updated in checkpoint.updated.items()
+        if raster in probability_paths and not is_probability_raster_current(
+            probability_paths[raster], updated)
+    ]
+    if not incomplete:
+        return checkpoint
+    for raster in incomplete:
+        _logger.warning(
+            ('Probability raster of %s is missing or incomplete, predict '
+             'it again'), raster)
+    store.discard(incomplete)
+    return store.load()
+
+
+def prepare_checkpoint_store(store, model_file, *, resume, threshold,
+                             **kwargs):
+    """
+    Prepare checkpoint +store+ for a detection run
+
+    If +resume+ is True and the store was created by a run with the same
+    parameters, it is kept so that detection continues from where it was
+    left.  Otherwise, a new empty store is created.
+
+    """
+    params = dict(model_file=os.path.abspath(model_file), **kwargs)
+    params.pop('preprocess_workers', None)
+    params.pop('prefetch_batches', None)
+
+    if resume and store.exists():
+        stored_params = store.read_params()
+        stored_threshold = stored_params.pop('threshold')
+        # Stores created before dense prediction are not dense
+        stored_params.setdefault('dense', False)
+        if stored_params != params:
+            raise RuntimeError(
+                ('Predictions at {} were made with different parameters '
+                 '({}). Remove them or disable resuming.').format(
+                     store.path, stored_params))
+        if threshold < stored_threshold:
+            _logger.warning(
+                ('Predictions at %s were made with a threshold of %f, '
+                 'windows below that probability are missing'), store.path,
+                stored_threshold)
+        _logger.info('Resume from predictions at %s', store.path)
+    else:
+        store.create(threshold=threshold, **params)
 
 
 def predict_image(fname,
@@ -91,94 +247,444 @@ def predict_image(fname,
                   rasters_contour=None,
                   rescale_intensity=True,
                   lower_cut=2,
-                  upper_cut=98):
-
+                  upper_cut=98,
+                  stats_decimation=1,
+                  preprocess_workers=DEFAULT_WORKERS,
+                  prefetch_batches=DEFAULT_QUEUE_SIZE,
+                  percentiles=None,
+                  chunk=None,
+                  skip=None,
+                  on_batch=None,
+                  on_probs=None):
+    """
+    Predict all sliding windows of raster +fname+ with +model+
+
+    If +chunk+ is an (index, count) tuple, the rows of windows are split in
+    +count+ contiguous chunks and only windows in chunk +index+ are
+    predicted.
+
+    If +percentiles+ is given, it is used for rescaling intensity instead of
+    calculating it from the raster.
+
+    +skip+ is an optional list of (start, end) ranges of window indexes that
+    were already predicted, and +on_batch+ an optional function that is
+    called with the range and +Predictions+ of each batch as soon as it
+    is predicted.  +on_probs+ is an optional function that is called with
+    the rows and columns (on the +WindowGrid+ of the raster) and
+    probabilities of all windows of each batch, regardless of +threshold+.
+
+    If +model+ is a +DenseModel+, windows are predicted in bands of
+    +DENSE_BAND_ROWS+ rows, each read as a single region and run through
+    the model at once.  +step_size+ must be a multiple of its stride.
+
+    """
     if not step_size:
         step_size = size
 
-    if rescale_intensity:
+    if rescale_intensity and percentiles is None:
         percentiles = calculate_percentiles(
-            fname, lower_cut=lower_cut, upper_cut=upper_cut)
+            fname,
+            decimation=stats_decimation,
+            lower_cut=lower_cut,
+            upper_cut=upper_cut)
 
     with rio.open(fname) as src:
-        matching_windows = []
+        crs = src.crs.to_dict()
+        results = []
 
-        windows = sliding_windows(
-            size, step_size, height=src.shape[0], width=src.shape[1])
-
-        windows_and_boxes = [(w, box(*src.window_bounds(w))) for w in windows]
-        _logger.info('Total windows: %d', len(windows_and_boxes))
+        grid = WindowGrid.from_dataset(src, size=size, step_size=step_size)
+        _logger.info('Total windows: %d', len(grid))
 
+        mask = None
         if rasters_contour:
-            contour_polygon, contour_crs = load_raster_contour_polygon(
-                rasters_contour)
-            contour_polygon = reproject_shape(contour_polygon, contour_crs,
-                                              src.crs)
-            windows_and_boxes = [(w, b) for w, b in windows_and_boxes
-                                 if contour_polygon.intersection(b)]
-            _logger.info(
-                'Total windows (after filtering with raster contour shape): %d',
-                len(windows_and_boxes))
-
-        total = len(windows_and_boxes) // BATCH_SIZE
-        for group in tqdm.tqdm(grouper(windows_and_boxes, BATCH_SIZE), total=total):
-            imgs = []
-            window_boxes = []
-            for pair in group:
-                if pair:
-                    window, window_box = pair
 
-                    img = np.dstack([src.read(b, window=window) for b in range(1, 4)])
+            def load_contour():
+                contour_polygon, contour_crs = load_raster_contour_polygon(
+                    rasters_contour)
+                return reproject_shape(contour_polygon, contour_crs, src.crs)
 
-                    if rescale_intensity:
-                        img = exposure.rescale_intensity(img, in_range=percentiles)
-
-                    img = resnet50.preprocess_input(img)
-
-                    imgs.append(img)
-                    window_boxes.append(window_box)
-
-            preds = model.predict(np.array(imgs))
+            mask = contour_window_mask(fname, grid, rasters_contour,
+                                       load_contour)
+            _logger.info(
+                'Total windows (after filtering with raster contour shape): %d',
+                mask.sum())
+
+        windows = grid.windows(mask)
+        rows, cols = grid.cells(mask)
+        bounds = grid.bounds(rows, cols)
+
+        if chunk:
+            start, end = chunk_range(windows, chunk, size, step_size,
+                                     height=src.shape[0])
+        else:
+            start, end = 0, len(windows)
+
+        dense = isinstance(model, DenseModel)
+        if dense:
+            if step_size % model.stride:
+                raise ValueError(
+                    'step size must be a multiple of {} for dense '
+                    'prediction, but was {}'.format(model.stride, step_size))
+            ranges = list(
+                band_ranges(windows, start, end, skip or [],
+                            DENSE_BAND_ROWS * step_size))
+        else:
+            ranges = list(batch_ranges(start, end, skip or [], BATCH_SIZE))
+        _logger.info('Windows to predict: %d',
+                     sum(end - start for start, end in ranges))
+
+        reader = StripReader(src)
+
+        def read_batch(batch_range):
+            batch = windows[slice(*batch_range)]
+            if dense:
+                batch = [covering_window(batch)]
+            return batch_range, list(reader.read_windows(batch))
+
+        timer = StageTimer()
+        batches = BatchPipeline(
+            (read_batch(r) for r in ranges),
+            partial(
+                preprocess_batch,
+                rescale_intensity=rescale_intensity,
+                percentiles=percentiles),
+            workers=preprocess_workers,
+            queue_size=prefetch_batches,
+            timer=timer)
+
+        for batch_range, imgs in tqdm.tqdm(batches, total=len(ranges)):
+            with timer.measure('predict'):
+                if dense:
+                    batch = windows[slice(*batch_range)]
+                    region = covering_window(batch)
+                    offsets = [(w.row_off - region.row_off,
+                                w.col_off - region.col_off) for w in batch]
+                    preds = model.predict_windows(imgs[0], offsets)
+                else:
+                    preds = model.predict(imgs)
             preds_b = preds[:, 0]
 
-            for i in np.nonzero(preds_b >= threshold)[0]:
-                _logger.info((window, float(preds_b[i])))
-                window_box = window_boxes[i]
-                reproject_window_box = reproject_shape(window_box, src.crs,
-                                                       WGS84_CRS)
-                s = ShapeWithProps(
-                    shape=reproject_window_box, props={})
-                s.props['prob'] = float(preds_b[i])
-                matching_windows.append(s)
-
-        return matching_windows
-
-
-def predict_images(input_dir, model, size, save_to, **kwargs):
-    polygons = []
-
-    rasters = glob.glob(os.path.join(input_dir, '**/*.tif'), recursive=True)
-    _logger.info(rasters)
-
-    for raster in rasters:
-        polygons.extend(predict_image(raster, model, size, **kwargs))
-
-        with open(save_to, 'wb') as file:
-            pickle.dump(polygons, file)
-        _logger.info('%s of predicted windows written')
-
-    _logger.info('Found %d matching windows on all files', (len(polygons)))
-
-    return polygons
+            batch_start = batch_range[0]
+            matching = np.nonzero(preds_b >= threshold)[0]
+            for i in matching:
+                _logger.info((tuple(bounds[batch_start + i]),
+                              float(preds_b[i])))
+
+            batch_results = Predictions.from_windows(
+                fname,
+                crs,
+                windows=[windows[batch_start + i] for i in matching],
+                bounds=bounds[batch_start + matching],
+                probs=preds_b[matching],
+                size=size,
+                step_size=step_size)
+
+            if on_batch:
+                on_batch(batch_range, batch_results)
+            if on_probs:
+                batch_slice = slice(*batch_range)
+                on_probs(rows[batch_slice], cols[batch_slice], preds_b)
+            results.append(batch_results)
+
+        timer.report()
+
+        return Predictions.concatenate(results)
+
+
+def preprocess_batch(batch, *, rescale_intensity, percentiles):
+    """
+    Preprocess a batch of images for prediction
+
+    +batch+ is a tuple of a range of window indexes and an iterable of
+    images.  Returns the range and an array of preprocessed images.
+
+    """
+    batch_range, raw_imgs = batch
+    imgs = []
+    for img in raw_imgs:
+        if rescale_intensity:
+            img = exposure.rescale_intensity(img, in_range=percentiles)
+        else:
+            # Copy image, as it is a view of the current strip
+            # and preprocessing is done in-place
+            img = img.copy()
+
+        img = resnet50.preprocess_input(img)
+
+        imgs.append(img)
+    return batch_range, np.array(imgs)
+
+
+def predict_images(rasters,
+                   model,
+                   size,
+                   store,
+                   checkpoint,
+                   probability_paths=None,
+                   **kwargs):
+    """
+    Predict all +rasters+ with +model+, recording results on +store+
+
+    Windows that were already predicted according to +checkpoint+ are
+    skipped.  If +probability_paths+ is a dictionary of raster to path,
+    probabilities of all windows of each raster are also written to a
+    probability raster at that path.
+
+    """
+    with store.writer() as writer:
+        for raster in rasters:
+            skip = checkpoint.completed_ranges(raster)
+            prob_writer = None
+            if probability_paths:
+                prob_writer = open_probability_raster(
+                    probability_paths[raster],
+                    raster,
+                    size=size,
+                    step_size=kwargs.get('step_size') or size,
+                    resume=bool(skip))
+            predict_image(
+                raster,
+                model,
+                size,
+                skip=skip,
+                on_batch=partial(_write_batch, writer, raster),
+                on_probs=prob_writer.write if prob_writer else None,
+                **kwargs)
+            if prob_writer:
+                prob_writer.close()
+            writer.write_raster(raster)
+            _logger.info('Predictions of %s written to %s', raster,
+                         store.path)
+
+
+def predict_images_parallel(rasters,
+                            model_file,
+                            store,
+                            checkpoint,
+                            workers,
+                            probability_paths=None,
+                            dense=False,
+                            **kwargs):
+    """
+    Predict all +rasters+ on a pool of +workers+ processes
+
+    Each worker process loads its own copy of the model from +model_file+.
+    If there are less rasters than workers, rasters are split into chunks of
+    rows of windows, so that all workers are kept busy.  Each worker records
+    its results on +store+ independently.
+
+    Probability rasters (see +predict_images+) are written by the main
+    process, as each chunk is done.
+
+    """
+    chunks = max(1, -(-workers // max(len(rasters), 1)))
+    _logger.info('Predict %d rasters in %d chunks each with %d workers',
+                 len(rasters), chunks, workers)
+
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(model_file, store, workers, dense, kwargs)) as pool:
+        if kwargs.get('rescale_intensity', True):
+            percentiles = pool.map(
+                partial(
+                    calculate_percentiles,
+                    decimation=kwargs.get('stats_decimation', 1),
+                    lower_cut=kwargs.get('lower_cut', 2),
+                    upper_cut=kwargs.get('upper_cut', 98)), rasters)
+        else:
+            percentiles = [None] * len(rasters)
+
+        tasks = [(raster, (i, chunks), raster_percentiles,
+                  checkpoint.completed_ranges(raster),
+                  bool(probability_paths))
+                 for raster, raster_percentiles in zip(rasters, percentiles)
+                 for i in range(chunks)]
+        results = pool.imap(_predict_chunk, tasks)
+
+        prob_writer = None
+        with store.writer() as writer:
+            for (raster, chunk, _, skip, _), result in zip(
+                    tasks, tqdm.tqdm(results, total=len(tasks))):
+                if probability_paths:
+                    size, rows, cols, probs = result
+                    if chunk[0] == 0:
+                        prob_writer = open_probability_raster(
+                            probability_paths[raster],
+                            raster,
+                            size=size,
+                            step_size=kwargs.get('step_size') or size,
+                            resume=bool(skip))
+                    if prob_writer:
+                        prob_writer.write(rows, cols, probs)
+                if chunk[0] == chunks - 1:
+                    if prob_writer:
+                        prob_writer.close()
+                        prob_writer = None
+                    writer.write_raster(raster)
+                    _logger.info('Predictions of %s written to %s', raster,
+                                 store.path)
+
+        # Let workers exit normally, so that their writers are closed
+        # (exiting the context manager terminates them instead)
+        pool.close()
+        pool.join()
+
+
+def _write_batch(writer, raster, batch_range, results):
+    start, end = batch_range
+    writer.write_batch(raster, start, end, results)
+
+
+_worker_model = None
+_worker_writer = None
+_worker_kwargs = None
+
+
+def _init_worker(model_file, store, workers, dense, kwargs):
+    """Load model on a worker process of +predict_images_parallel+"""
+    global _worker_model, _worker_writer, _worker_kwargs  # pylint: disable=global-statement
+
+    # Share CPU cores between workers, instead of having all TensorFlow
+    # sessions compete for all of them
+    threads = max(1, multiprocessing.cpu_count() // workers)
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+
+    _worker_model = load_model(model_file, config=config, dense=dense)
+    _worker_writer = store.writer()
+    _worker_kwargs = kwargs
+    # Close writer when the worker process exits
+    multiprocessing.util.Finalize(
+        None, _worker_writer.close, exitpriority=10)
+
+
+def _predict_chunk(task):
+    raster, chunk, percentiles, skip, with_probs = task
+    size = _worker_model.input_shape[1]
+
+    probs = []
+    predict_image(
+        raster,
+        _worker_model,
+        size,
+        percentiles=percentiles,
+        chunk=chunk,
+        skip=skip,
+        on_batch=partial(_write_batch, _worker_writer, raster),
+        on_probs=(lambda *args: probs.append(args)) if with_probs else None,
+        **_worker_kwargs)
+    _worker_writer.flush()
+
+    if with_probs:
+        # Probabilities are sent back to the main process, which writes them
+        if not probs:
+            return size, np.empty(0, int), np.empty(0, int), np.empty(0)
+        return (size, ) + tuple(np.concatenate(p) for p in zip(*probs))
+    return None
+
+
+def load_model(model_file, config=None, dense=False):
+    """
+    Load a model saved by +train+, or exported by +export_model+
+
+    Architecture is stored in the model file, so models with any head load
+    the same way.  Exported models are run by a +FrozenGraphModel+, without
+    Keras.  Metadata of the model is only logged.  +config+ is the
+    configuration of the TensorFlow session (optional).  If +dense+ is
+    True, returns a +DenseModel+ of the model.
+
+    """
+    if is_exported_model(model_file):
+        if dense:
+            raise ValueError('Dense prediction needs a Keras model file, '
+                             'not an exported model')
+        model = FrozenGraphModel(model_file, config=config)
+        metadata = model.metadata
+    else:
+        if config is not None:
+            keras.backend.set_session(tf.Session(config=config))
+        model = keras.models.load_model(model_file)
+        metadata = read_model_metadata(model_file)
+    _logger.info('Model %s has a %s head with %d dense units', model_file,
+                 metadata['head'], metadata['dense_units'])
+    if dense:
+        model = DenseModel(model)
+    return model
+
+
+def find_rasters(input_dir):
+    """Return a sorted list of all rasters inside +input_dir+, recursively"""
+    return sorted(
+        glob.glob(os.path.join(input_dir, '**/*.tif'), recursive=True))
+
+
+def chunk_range(windows, chunk, size, step_size, *, height):
+    """
+    Return the range of indexes of +windows+ that belong to a +chunk+
+
+    +chunk+ is an (index, count) tuple.  Rows of windows are split into
+    +count+ contiguous chunks of (roughly) the same number of rows.  As
+    windows are sorted by row, each chunk is a contiguous range of indexes.
+
+    """
+    index, count = chunk
+    total_rows = max((height - size) // step_size + 1, 1)
+    chunk_ids = [(w.row_off // step_size) * count // total_rows
+                 for w in windows]
+    start = bisect.bisect_left(chunk_ids, index)
+    end = bisect.bisect_left(chunk_ids, index + 1)
+    return start, end
+
+
+def batch_ranges(start, end, skip, batch_size):
+    """
+    Split range of indexes from +start+ to +end+ into ranges of +batch_size+
+
+    Indexes inside any of the (start, end) ranges in +skip+ are left out.
+
+    """
+    pos = start
+    for skip_start, skip_end in sorted(skip) + [(end, end)]:
+        skip_start = min(max(skip_start, start), end)
+        skip_end = min(skip_end, end)
+        for i in range(pos, skip_start, batch_size):
+            yield i, min(i + batch_size, skip_start)
+        pos = max(pos, skip_end)
+
+
+def band_ranges(windows, start, end, skip, band_height):
+    """
+    Split range of indexes from +start+ to +end+ into bands of +windows+
+
+    Each band has the windows whose row offset is in the same +band_height+
+    rows.  As windows are sorted by row, each band is a contiguous range of
+    indexes.  Indexes inside any of the (start, end) ranges in +skip+ are
+    left out.
+
+    """
+    band_ids = [int(w.row_off) // band_height for w in windows]
+    for range_start, range_end in batch_ranges(start, end, skip,
+                                               max(end - start, 1)):
+        pos = range_start
+        while pos < range_end:
+            band_end = bisect.bisect_right(band_ids, band_ids[pos], pos,
+                                           range_end)
+            yield pos, band_end
+            pos = band_end
+
+
+def covering_window(windows):
+    """Return the smallest window that contains all +windows+"""
+    row_off = min(int(w.row_off) for w in windows)
+    col_off = min(int(w.col_off) for w in windows)
+    row_end = max(int(w.row_off + w.height) for w in windows)
+    col_end = max(int(w.col_off + w.width) for w in windows)
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
 
 
 def load_raster_contour_polygon(rasters_contour):
     with fiona.open(rasters_contour) as src:
         contour_shape = [shape(feature['geometry']) for feature in src][0]
         return contour_shape, src.crs
-
-
-def calculate_percentiles(raster, block_size=1, *, lower_cut, upper_cut):
-    rgb_img = dask_rasterio.read_raster(
-        raster, band=(1, 2, 3), block_size=block_size)
-    return tuple(np.percentile(rgb_img, (lower_cut, upper_cut)))
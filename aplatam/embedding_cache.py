@@ -0,0 +1,142 @@
+"""This module contains a memory-mapped cache of activations of a model"""
+import json
+import logging
+import os
+
+import numpy as np
+import tqdm
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+
+# Number of flip variants of an image: none, horizontal, vertical and both
+FLIP_VARIANTS = 4
+
+
+def flip_images(images, variant):
+    """
+    Flip a batch of +images+, an array of shape (batch, rows, cols, bands)
+
+    +variant+ is 0 for no flip, 1 for horizontal flip, 2 for vertical flip
+    and 3 for both.
+
+    """
+    if variant & 1:
+        images = images[:, :, ::-1]
+    if variant & 2:
+        images = images[:, ::-1]
+    return images
+
+
+class EmbeddingCache:
+    """
+    Memory-mapped store of activations of a model for a dataset of images
+
+    Activations are calculated once for each image of +dataset+ (and for
+    each of its flip variants, if +variants+ is +FLIP_VARIANTS+) by calling
+    +predict+ on batches of images.  They are stored on +path+ as float16
+    arrays, one for each output of the model.  If +path+ already has a
+    complete cache for the same +key+ and dataset size, it is reused.
+
+    Arguments:
+        path {str} -- cache directory
+        dataset {object} -- dataset with +read(indexes)+ and +len+, e.g. a
+            +PackedDataset+
+        predict {function} -- returns a list of arrays of activations for a
+            batch of images
+        key {dict} -- parameters that identify the model, stored as JSON
+
+    Keyword Arguments:
+        variants {int} -- 1, or +FLIP_VARIANTS+ for caching activations of
+            flipped images (default: {1})
+        batch_size {int} -- number of images per call to +predict+
+            (default: {32})
+
+    """
+
+    def __init__(self,
+                 path,
+                 dataset,
+                 predict,
+                 key,
+                 variants=1,
+                 batch_size=32):
+        self.path = path
+        self.variants = variants
+
+        index = dict(
+            key=json.loads(json.dumps(key)),
+            count=len(dataset),
+            variants=variants)
+        cached_index = self._read_index()
+        if cached_index and all(cached_index.get(k) == v
+                                for k, v in index.items()):
+            _logger.info('Reuse cached activations at %s', path)
+        else:
+            cached_index = self._build(dataset, predict, index, batch_size)
+
+        self.arrays = [
+            np.load(self._array_path(i), mmap_mode='r')
+            for i in range(cached_index['outputs'])
+        ]
+
+    def __len__(self):
+        return len(self.arrays[0]) if self.arrays else 0
+
+    def read(self, indexes, variants=None):
+        """
+        Return a list of float32 arrays with activations of images at
+        +indexes+, flipped as +variants+ (by default, not flipped)
+
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if variants is None:
+            variants = np.zeros(len(indexes), dtype=np.int64)
+        return [a[indexes, variants].astype(np.float32) for a in self.arrays]
+
+    def _build(self, dataset, predict, index, batch_size):
+        _logger.info('Calculate activations of %d images (%d variants) at %s',
+                     len(dataset), self.variants, self.path)
+        os.makedirs(self.path, exist_ok=True)
+        # Remove index first, so that an interrupted build is not reused
+        if os.path.exists(self._index_path()):
+            os.remove(self._index_path())
+
+        arrays = []
+        count = len(dataset)
+        for start in tqdm.trange(0, count, batch_size):
+            end = min(start + batch_size, count)
+            images = dataset.read(np.arange(start, end))
+            for variant in range(self.variants):
+                outputs = predict(flip_images(images, variant))
+                if not arrays:
+                    arrays = [
+                        np.lib.format.open_memmap(
+                            self._array_path(i),
+                            mode='w+',
+                            dtype=np.float16,
+                            shape=(count, self.variants) + out.shape[1:])
+                        for i, out in enumerate(outputs)
+                    ]
+                for array, out in zip(arrays, outputs):
+                    array[start:end, variant] = out
+
+        for array in arrays:
+            array.flush()
+        index = dict(index, outputs=len(arrays))
+        with open(self._index_path(), 'w') as dst:
+            json.dump(index, dst)
+        return index
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path()):
+            return None
+        with open(self._index_path()) as src:
+            return json.load(src)
+
+    def _index_path(self):
+        return os.path.join(self.path, INDEX_FILENAME)
+
+    def _array_path(self, i):
+        return os.path.join(self.path, '{:02d}.npy'.format(i))
@@ -0,0 +1,207 @@
+"""This module contains functions for exporting models for inference"""
+import json
+import logging
+import os
+
+import keras
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import types_pb2
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from aplatam.train_classifier import read_model_metadata
+
+_logger = logging.getLogger(__name__)
+
+# Extension of exported model files (frozen TensorFlow graphs)
+EXPORTED_MODEL_EXT = '.pb'
+
+QUANTIZE_MODES = ('float16', 'int8')
+
+# Name of the constant node that holds metadata of an exported model
+METADATA_NODE = 'aplatam_metadata'
+
+# Weights with fewer elements than this (e.g. biases) are not quantized
+QUANTIZE_MIN_SIZE = 1024
+
+# Constants are folded twice: batch-norm expressions are constant only
+# after folding, and folding them into convolutions leaves new constants
+TRANSFORMS = [
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order',
+]
+
+
+def export_model(model_file, output_file, quantize=None):
+    """
+    Export Keras model +model_file+ as a frozen graph for inference
+
+    Optimizer state and training-only nodes (e.g. dropout) are stripped,
+    variables are replaced by constants, and batch normalization is folded
+    into the weights of the preceding convolutions.  If +quantize+ is
+    'int8' or 'float16', weights are stored with that precision and
+    converted back to float32 when the graph is loaded, so computation is
+    still in float32.  Metadata of the model is stored in the graph.
+
+    Arguments:
+        model_file {str} -- HDF5 model file saved by +train+
+        output_file {str} -- output frozen graph file
+        quantize {str} -- precision of weights, one of +QUANTIZE_MODES+
+
+    """
+    if quantize is not None and quantize not in QUANTIZE_MODES:
+        raise ValueError('quantize must be one of {}, but was {}'.format(
+            QUANTIZE_MODES, quantize))
+
+    keras.backend.clear_session()
+    keras.backend.set_learning_phase(0)
+    model = keras.models.load_model(model_file, compile=False)
+    input_name = model.input.op.name
+    output_name = model.output.op.name
+
+    session = keras.backend.get_session()
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [output_name])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+
+    transforms = list(TRANSFORMS)
+    if quantize == 'int8':
+        transforms.append(
+            'quantize_weights(minimum_size={})'.format(QUANTIZE_MIN_SIZE))
+    graph_def = TransformGraph(graph_def, [input_name], [output_name],
+                               transforms)
+    if quantize == 'float16':
+        graph_def = _cast_weights_to_float16(graph_def)
+
+    metadata = dict(
+        read_model_metadata(model_file),
+        size=model.input_shape[1],
+        input=input_name,
+        output=output_name,
+        quantize=quantize)
+    graph_def.node.extend(
+        [_string_constant(METADATA_NODE, json.dumps(metadata))])
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with tf.gfile.GFile(output_file, 'wb') as dst:
+        dst.write(graph_def.SerializeToString())
+    _logger.info('Model exported to %s (%d nodes)', output_file,
+                 len(graph_def.node))
+    keras.backend.clear_session()
+
+
+def is_exported_model(path):
+    """Return True if +path+ is a model exported by +export_model+"""
+    return os.path.splitext(path)[1] == EXPORTED_MODEL_EXT
+
+
+class FrozenGraphModel:
+    """
+    Model exported by +export_model+, for inference only
+
+    The frozen graph is run on its own TensorFlow session, without Keras.
+    It has the +input_shape+ and +predict+ of a Keras model, so +detect+
+    can use it in place of one.
+
+    Arguments:
+        path {str} -- exported model file
+        config {tf.ConfigProto} -- configuration of the session (optional)
+
+    """
+
+    def __init__(self, path, config=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as src:
+            graph_def.ParseFromString(src.read())
+        self.metadata = _read_metadata(graph_def)
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._session = tf.Session(graph=graph, config=config)
+        self._input = graph.get_tensor_by_name(
+            '{}:0'.format(self.metadata['input']))
+        self._output = graph.get_tensor_by_name(
+            '{}:0'.format(self.metadata['output']))
+
+        size = self.metadata['size']
+        self.input_shape = (None, size, size, 3)
+
+    def predict(self, images, batch_size=32):
+        """Return an array of predictions for +images+"""
+        preds = [
+            self._session.run(
+                self._output,
+                feed_dict={self._input: images[i:i + batch_size]})
+            for i in range(0, len(images), batch_size)
+        ]
+        if not preds:
+            return np.empty((0, 1), dtype=np.float32)
+        return np.concatenate(preds)
+
+    def close(self):
+        """Close session"""
+        self._session.close()
+
+
+def _cast_weights_to_float16(graph_def):
+    """
+    Store large float32 constants of +graph_def+ as float16
+
+    Each constant is replaced by a float16 constant and a cast back to
+    float32 with the original name, so consumers of the constant are the
+    same.
+
+    """
+    res = tf.GraphDef()
+    res.versions.CopyFrom(graph_def.versions)
+    res.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if (node.op == 'Const' and 'dtype' in node.attr
+                and node.attr['dtype'].type == types_pb2.DT_FLOAT):
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            if value.size >= QUANTIZE_MIN_SIZE:
+                half = res.node.add()
+                half.op = 'Const'
+                half.name = '{}/float16'.format(node.name)
+                half.device = node.device
+                half.attr['dtype'].type = types_pb2.DT_HALF
+                half.attr['value'].tensor.CopyFrom(
+                    tensor_util.make_tensor_proto(value.astype(np.float16)))
+
+                cast = res.node.add()
+                cast.op = 'Cast'
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(half.name)
+                cast.attr['SrcT'].type = types_pb2.DT_HALF
+                cast.attr['DstT'].type = types_pb2.DT_FLOAT
+                continue
+        res.node.extend([node])
+    return res
+
+
+def _string_constant(name, value):
+    node = tf.NodeDef()
+    node.op = 'Const'
+    node.name = name
+    node.attr['dtype'].type = types_pb2.DT_STRING
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    return node
+
+
+def _read_metadata(graph_def):
+    for node in graph_def.node:
+        if node.name == METADATA_NODE:
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            value = value.item() if hasattr(value, 'item') else value
+            if isinstance(value, bytes):
+                value = value.decode()
+            return json.loads(value)
+    raise ValueError('Graph has no {} node, it was not exported by '
+                     'export_model'.format(METADATA_NODE))
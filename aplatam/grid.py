@@ -0,0 +1,264 @@
+"""This module contains helpers for operating on grids of sliding windows"""
+import hashlib
+import json
+import logging
+import os
+from math import gcd
+
+import numpy as np
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from shapely.geometry import box
+from shapely.prepared import prep
+
+from aplatam.stats import get_stats_cache
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of cells to rasterize shapes on.  With more cells than this,
+# windows are tested one by one against a prepared geometry instead.
+MAX_CELLS = 2**24
+
+# Minimum number of samples per side of a window when estimating the
+# fraction of a window covered by a shape
+COVERAGE_SAMPLES = 16
+
+
+class WindowGrid:
+    """
+    Grid of sliding windows of a raster
+
+    Windows are the same as those generated by +sliding_windows+, arranged
+    on a 2D grid: window at (row, col) has its upper-left corner at pixel
+    (row * step_size, col * step_size).
+
+    For rasterizing shapes, the raster is split into square cells whose side
+    is the greatest common divisor of +size+ and +step_size+, so that every
+    window covers a whole number of cells.
+
+    Arguments:
+        transform {Affine} -- affine transform of the raster
+        width {int} -- raster width in pixels
+        height {int} -- raster height in pixels
+        size {int} -- size in pixels of windows
+        step_size {int} -- step size in pixels of windows
+
+    """
+
+    def __init__(self, transform, width, height, *, size, step_size):
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.size = size
+        self.step_size = step_size
+
+        self.shape = (max((height - size) // step_size + 1, 0),
+                      max((width - size) // step_size + 1, 0))
+        self.cell_size = gcd(size, step_size)
+
+    @classmethod
+    def from_dataset(cls, src, *, size, step_size):
+        """Build grid of windows of an opened raster dataset +src+"""
+        return cls(
+            src.transform,
+            src.width,
+            src.height,
+            size=size,
+            step_size=step_size)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def cells(self, mask=None):
+        """
+        Return arrays of rows and columns of all windows, in row-major order
+
+        If +mask+ is given, return only windows whose value in +mask+ is
+        True.
+
+        """
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+        return np.nonzero(mask)
+
+    def windows(self, mask=None):
+        """Return a list of all windows in row-major order (see +cells+)"""
+        rows, cols = self.cells(mask)
+        return [
+            Window(int(c) * self.step_size,
+                   int(r) * self.step_size, self.size, self.size)
+            for r, c in zip(rows, cols)
+        ]
+
+    def bounds(self, rows, cols):
+        """
+        Return an array of shape (n, 4) with bounds of windows at +rows+ and
+        +cols+, as (minx, miny, maxx, maxy)
+
+        Bounds are calculated directly from the affine transform of the
+        raster, without building any shape.
+
+        """
+        col_off = np.asarray(cols, dtype=np.float64) * self.step_size
+        row_off = np.asarray(rows, dtype=np.float64) * self.step_size
+        xs0, ys0 = self.transform * (col_off, row_off)
+        xs1, ys1 = self.transform * (col_off + self.size, row_off + self.size)
+        return np.column_stack([
+            np.minimum(xs0, xs1),
+            np.minimum(ys0, ys1),
+            np.maximum(xs0, xs1),
+            np.maximum(ys0, ys1)
+        ])
+
+    def window_box(self, row, col):
+        """Return a box of the bounds of window at (+row+, +col+)"""
+        return box(*self.bounds([row], [col])[0])
+
+    def intersects(self, shape):
+        """
+        Return a boolean mask of windows that intersect with +shape+
+
+        Shape is rasterized once on the grid of cells, and only windows on
+        its boundary are tested against the actual geometry.  Results are
+        the same as testing every window box with +shape.intersects+.
+
+        """
+        cells_shape = self._cells_shape()
+        if cells_shape[0] * cells_shape[1] > MAX_CELLS:
+            _logger.info('Too many cells, test windows one by one')
+            return self._intersects_windows(shape, np.ones(self.shape, bool))
+
+        # Cells that touch the shape, grown by one cell so that windows that
+        # only touch the shape on their edges are always tested.  Shape is
+        # rasterized with a margin of one cell around the grid, for shapes
+        # that touch its outer edges.
+        touched = self._rasterize(
+            shape, cells_shape, all_touched=True, margin=1)
+        touched = _dilate(touched)[1:-1, 1:-1]
+        # Cells whose center is inside the shape
+        inside = self._rasterize(shape, cells_shape, all_touched=False)
+
+        touched_count = self._window_sums(touched)
+        inside_count = self._window_sums(inside)
+
+        mask = inside_count > 0
+        candidates = (touched_count > 0) & ~mask
+        _logger.debug('%d windows inside shape, %d on its boundary',
+                      mask.sum(), candidates.sum())
+        return mask | self._intersects_windows(shape, candidates)
+
+    def coverage(self, shape, mask=None):
+        """
+        Return an array with the fraction of each window covered by +shape+
+
+        Coverage is estimated by rasterizing +shape+ once on a grid of
+        sub-cells, with about +COVERAGE_SAMPLES+ sub-cells per side of a
+        window (as long as they divide both size and step size), and
+        counting sub-cells whose center is inside +shape+.  With too many
+        sub-cells, the exact area of the intersection is calculated for
+        windows in +mask+ instead, and other windows have zero coverage.
+
+        """
+        sub_size = self._coverage_cell_size()
+        cells_shape = self._cells_shape(sub_size)
+        if cells_shape[0] * cells_shape[1] > MAX_CELLS:
+            _logger.info('Too many cells, calculate coverage one by one')
+            if mask is None:
+                mask = np.ones(self.shape, dtype=bool)
+            coverage = np.zeros(self.shape, dtype=np.float64)
+            for r, c in zip(*np.nonzero(mask)):
+                wbox = self.window_box(r, c)
+                coverage[r, c] = shape.intersection(wbox).area / wbox.area
+            return coverage
+
+        inside = self._rasterize(
+            shape, cells_shape, all_touched=False, cell_size=sub_size)
+        cells_per_window = (self.size // sub_size)**2
+        return self._window_sums(inside, sub_size) / cells_per_window
+
+    def _coverage_cell_size(self):
+        # Halved cells still divide both size and step size
+        cell_size = self.cell_size
+        while cell_size % 2 == 0 and self.size // cell_size < COVERAGE_SAMPLES:
+            cell_size //= 2
+        return cell_size
+
+    def _intersects_windows(self, shape, candidates):
+        prepared_shape = prep(shape)
+        mask = np.zeros(self.shape, dtype=bool)
+        for r, c in zip(*np.nonzero(candidates)):
+            mask[r, c] = prepared_shape.intersects(self.window_box(r, c))
+        return mask
+
+    def _cells_shape(self, cell_size=None):
+        cell_size = cell_size or self.cell_size
+        rows, cols = self.shape
+        k = self.size // cell_size
+        s = self.step_size // cell_size
+        return (max((rows - 1) * s + k, 0), max((cols - 1) * s + k, 0))
+
+    def _rasterize(self,
+                   shape,
+                   cells_shape,
+                   all_touched,
+                   margin=0,
+                   cell_size=None):
+        cell_size = cell_size or self.cell_size
+        out_shape = (cells_shape[0] + 2 * margin, cells_shape[1] + 2 * margin)
+        if not all(cells_shape) or shape.is_empty:
+            return np.zeros(out_shape, dtype=np.uint8)
+        cell_transform = (self.transform * Affine.scale(cell_size) *
+                          Affine.translation(-margin, -margin))
+        return rasterize(
+            [(shape, 1)],
+            out_shape=out_shape,
+            transform=cell_transform,
+            fill=0,
+            all_touched=all_touched,
+            dtype='uint8')
+
+    def _window_sums(self, cells, cell_size=None):
+        """Sum values of +cells+ covered by each window"""
+        cell_size = cell_size or self.cell_size
+        k = self.size // cell_size
+        s = self.step_size // cell_size
+        table = np.zeros((cells.shape[0] + 1, cells.shape[1] + 1),
+                         dtype=np.int64)
+        table[1:, 1:] = cells.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+        r0 = np.arange(self.shape[0])[:, np.newaxis] * s
+        c0 = np.arange(self.shape[1])[np.newaxis, :] * s
+        return (table[r0 + k, c0 + k] - table[r0, c0 + k] -
+                table[r0 + k, c0] + table[r0, c0])
+
+
+def contour_window_mask(raster, grid, rasters_contour, load_contour):
+    """
+    Return a boolean mask of windows of +grid+ that intersect a contour shape
+
+    Masks are stored in the statistics cache, keyed by +raster+, contour
+    file +rasters_contour+ and window size and step size, so they are only
+    calculated once.  +load_contour+ is a function that returns the contour
+    shape on the CRS of +raster+, and it is only called if the mask is not
+    cached.
+
+    """
+    stat = os.stat(rasters_contour)
+    key = json.dumps([
+        os.path.abspath(rasters_contour), stat.st_size, stat.st_mtime_ns,
+        grid.size, grid.step_size
+    ])
+    name = 'contour-{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+    return get_stats_cache().array(raster, name,
+                                   lambda: grid.intersects(load_contour()))
+
+
+def _dilate(cells):
+    """Grow non-zero cells by one cell in every direction"""
+    padded = np.pad(cells, 1, mode='constant')
+    res = np.zeros_like(cells)
+    height, width = cells.shape
+    for dr in range(3):
+        for dc in range(3):
+            res |= padded[dr:dr + height, dc:dc + width]
+    return res
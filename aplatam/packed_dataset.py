@@ -0,0 +1,182 @@
+"""This module contains a packed, memory-mappable format for image datasets"""
+import json
+import logging
+import os
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+
+# Default number of images per shard
+DEFAULT_SHARD_SIZE = 4096
+
+
+class PackedDatasetWriter:
+    """
+    Writes images and labels to a packed dataset in directory +path+
+
+    Images are appended to shards of at most +shard_size+ images.  Each
+    shard is a raw file of uint8 arrays, with its labels and image names
+    next to it, and an index file lists all shards.  Images are written as
+    they are added, so memory usage is constant.  The index is written on
+    +close+, and any previous index in +path+ is removed first, so that an
+    unfinished dataset is never read.
+
+    Arguments:
+        path {str} -- output directory
+        shard_size {int} -- maximum number of images of each shard
+
+    """
+
+    def __init__(self, path, shard_size=DEFAULT_SHARD_SIZE):
+        self.path = path
+        self.shard_size = shard_size
+        self.shape = None
+        self.shards = []
+
+        self._images = None
+        self._labels = []
+        self._names = []
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILENAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def write(self, img, label, name):
+        """
+        Add image +img+ with +label+ (1 for true, 0 for false)
+
+        +img+ must be a uint8 array.  Other types are not cast, as values
+        out of range would wrap around (use e.g. +skimage.img_as_ubyte+).
+
+        """
+        img = np.asarray(img)
+        if img.dtype != np.uint8:
+            raise ValueError('Image {} has type {}, expected uint8'.format(
+                name, img.dtype))
+        if self.shape is None:
+            self.shape = img.shape
+        elif img.shape != self.shape:
+            raise ValueError('Image {} has shape {}, expected {}'.format(
+                name, img.shape, self.shape))
+
+        if self._images is None:
+            self._images = open(self._shard_path('images'), 'wb')
+        self._images.write(np.ascontiguousarray(img).tobytes())
+        self._labels.append(label)
+        self._names.append(name)
+        if len(self._labels) >= self.shard_size:
+            self._close_shard()
+
+    def close(self):
+        """Close current shard and write index"""
+        self._close_shard()
+        index = dict(
+            shape=list(self.shape or ()),
+            dtype='uint8',
+            count=sum(s['count'] for s in self.shards),
+            shards=self.shards)
+        with open(os.path.join(self.path, INDEX_FILENAME), 'w') as dst:
+            json.dump(index, dst)
+        _logger.info('%d images written to %s', index['count'], self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _close_shard(self):
+        if self._images is None:
+            return
+        self._images.close()
+        np.save(
+            self._shard_path('labels.npy'),
+            np.array(self._labels, dtype=np.uint8))
+        with open(self._shard_path('names.txt'), 'w') as dst:
+            dst.write('\n'.join(self._names))
+        self.shards.append(
+            dict(name=self._shard_name(), count=len(self._labels)))
+
+        self._images = None
+        self._labels = []
+        self._names = []
+
+    def _shard_name(self):
+        return '{:05d}'.format(len(self.shards))
+
+    def _shard_path(self, ext):
+        return os.path.join(self.path, '{}.{}'.format(self._shard_name(), ext))
+
+
+class PackedDataset:
+    """
+    Packed dataset written by +PackedDatasetWriter+
+
+    Images of all shards are memory-mapped, so reading a batch of images is
+    a copy from the mapped files, without decoding or opening any file.
+
+    Arguments:
+        path {str} -- dataset directory
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILENAME)) as src:
+            index = json.load(src)
+        self.shape = tuple(index['shape'])
+
+        self._images = []
+        labels = []
+        for shard in index['shards']:
+            shard_path = os.path.join(path, shard['name'])
+            self._images.append(
+                np.memmap(
+                    shard_path + '.images',
+                    dtype=index['dtype'],
+                    mode='r',
+                    shape=(shard['count'], ) + self.shape))
+            labels.append(np.load(shard_path + '.labels.npy'))
+        self.labels = (np.concatenate(labels)
+                       if labels else np.empty(0, dtype=np.uint8))
+        self._offsets = np.cumsum([0] + [len(i) for i in self._images])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def read(self, indexes):
+        """Return an array with images at +indexes+"""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        res = np.empty((len(indexes), ) + self.shape, dtype=np.uint8)
+        shards = np.searchsorted(self._offsets, indexes, side='right') - 1
+        for shard in np.unique(shards):
+            mask = shards == shard
+            res[mask] = self._images[shard][indexes[mask] -
+                                            self._offsets[shard]]
+        return res
+
+    def files(self):
+        """Return a list of paths of the index and all shard files"""
+        paths = [os.path.join(self.path, INDEX_FILENAME)]
+        for i in range(len(self._images)):
+            shard_path = os.path.join(self.path, '{:05d}'.format(i))
+            paths.extend(shard_path + ext
+                         for ext in ('.images', '.labels.npy', '.names.txt'))
+        return paths
+
+    def names(self):
+        """Return a list of names of all images"""
+        names = []
+        for i in range(len(self._images)):
+            shard_path = os.path.join(self.path, '{:05d}'.format(i))
+            with open(shard_path + '.names.txt') as src:
+                names.extend(src.read().split('\n'))
+        return names
+
+
+def is_packed_dataset(path):
+    """Return True if +path+ contains a packed dataset"""
+    return os.path.exists(os.path.join(path, INDEX_FILENAME))
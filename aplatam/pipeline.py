@@ -0,0 +1,182 @@
+"""This module contains a producer/consumer pipeline for batched inference"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+# Default number of batches to prefetch ahead of the consumer
+DEFAULT_QUEUE_SIZE = 4
+
+# Default number of preprocessing threads
+DEFAULT_WORKERS = 2
+
+_DONE = object()
+
+
+class StageTimer:
+    """Accumulate wall-clock time spent on each stage of a pipeline"""
+
+    def __init__(self):
+        self.totals = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage):
+        """Measure time spent inside the context as part of +stage+"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.totals[stage] = self.totals.get(stage, 0.) + elapsed
+
+    def report(self):
+        """Log accumulated time of each stage"""
+        _logger.info('Stage timings: %s', ', '.join(
+            '{}={:.2f}s'.format(stage, total)
+            for stage, total in self.totals.items()))
+
+
+class BatchPipeline:
+    """
+    Bounded producer/consumer pipeline for batched inference
+
+    A reader thread pulls raw batches from +batches+ and puts them on a
+    bounded queue.  A pool of worker threads applies +process+ to each raw
+    batch, and the consumer iterates over processed batches in their original
+    order.  This way, reading and preprocessing of the following batches
+    overlap with whatever the consumer does with the current one (e.g. run
+    a model).
+
+    The reader runs on a single thread, so +batches+ can safely read from a
+    dataset handle that is not thread-safe.
+
+    Arguments:
+        batches {iterable} -- iterable of raw batches
+        process {callable} -- function to apply to each raw batch
+
+    Keyword Arguments:
+        workers {int} -- number of preprocessing threads (default: {2})
+        queue_size {int} -- maximum number of batches waiting on each queue
+            (default: {4})
+        timer {StageTimer} -- timer where time of the "read", "preprocess"
+            and "wait" stages is accumulated (default: {None})
+
+    """
+
+    def __init__(self,
+                 batches,
+                 process,
+                 workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 timer=None):
+        assert workers >= 1, 'workers should be at least 1'
+        assert queue_size >= 1, 'queue_size should be at least 1'
+        self.batches = batches
+        self.process = process
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timer = timer or StageTimer()
+
+    def __iter__(self):
+        in_queue = queue.Queue(maxsize=self.queue_size)
+        out_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        threads = [
+            threading.Thread(
+                target=self._read, args=(in_queue, out_queue, stop))
+        ]
+        threads.extend(
+            threading.Thread(
+                target=self._work, args=(in_queue, out_queue, stop))
+            for _ in range(self.workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            yield from self._consume(out_queue)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _consume(self, out_queue):
+        """Yield processed batches in order, as they become available"""
+        pending = {}
+        next_idx = 0
+        running = self.workers
+        while running:
+            with self.timer.measure('wait'):
+                item = out_queue.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            idx, result, error = item
+            if error is not None:
+                raise error
+            pending[idx] = result
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
+    def _read(self, in_queue, out_queue, stop):
+        try:
+            batches = iter(self.batches)
+            idx = 0
+            while not stop.is_set():
+                with self.timer.measure('read'):
+                    batch = next(batches, _DONE)
+                if batch is _DONE:
+                    break
+                if not _put(in_queue, (idx, batch), stop):
+                    return
+                idx += 1
+        except Exception as err:  # pylint: disable=broad-except
+            _put(out_queue, (None, None, err), stop)
+        finally:
+            for _ in range(self.workers):
+                _put(in_queue, _DONE, stop)
+
+    def _work(self, in_queue, out_queue, stop):
+        while not stop.is_set():
+            item = _get(in_queue, stop)
+            if item is None or item is _DONE:
+                break
+            idx, batch = item
+            try:
+                with self.timer.measure('preprocess'):
+                    result = self.process(batch)
+            except Exception as err:  # pylint: disable=broad-except
+                _put(out_queue, (idx, None, err), stop)
+                return
+            if not _put(out_queue, (idx, result, None), stop):
+                return
+        _put(out_queue, _DONE, stop)
+
+
+def _put(q, item, stop, timeout=0.1):
+    """Put +item+ on queue +q+, unless +stop+ is set while waiting"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop, timeout=0.1):
+    """Get an item from queue +q+, unless +stop+ is set while waiting"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            pass
+    return None
@@ -1,12 +1,25 @@
 import numpy as np
 import logging
 import rtree
+from math import gcd
+from rasterio.features import shapes as raster_shapes
+from rasterio.transform import Affine
+from skimage.measure import label
 from tqdm import tqdm
+from shapely.geometry import shape
 from shapely.ops import unary_union
-from aplatam.util import ShapeWithProps
+from aplatam.util import WGS84_CRS, ShapeWithProps, reproject_shape
 
 _logger = logging.getLogger(__name__)
 
+# Properties of dissolved shapes, and their types in vector files
+DISSOLVED_PROPERTIES = {
+    'prob': 'float',
+    'prob_max': 'float',
+    'prob_mean': 'float',
+    'windows': 'int',
+}
+
 
 def create_index(shapes_with_props):
     """Create an R-Tree index from a set of features"""
@@ -45,3 +58,319 @@ def filter_features_by_mean_prob(shapes_with_props, neigh, mean_threshold):
             shape_id, shapes_with_props, ix, neigh)
 
     return [s for s in shapes_with_props if s.props['prob_mean'] > mean_threshold]
+
+
+def filter_predictions_by_mean_prob(predictions, neigh, mean_threshold):
+    """
+    Filter +predictions+ by mean probability of neighbouring windows
+
+    This is the same filter as +filter_features_by_mean_prob+, but computed
+    for all windows at once on the grid of sliding windows of each raster,
+    instead of querying a spatial index for each window.  Two windows are
+    neighbours if they overlap or touch each other.
+
+    Returns filtered predictions, with a new "prob_mean" column.
+
+    """
+    _logger.info('Calculate mean probability in neighbourhood')
+    prob_mean = neighbours_mean_prob(predictions, neigh)
+    predictions = predictions.with_column('prob_mean', prob_mean)
+    return predictions[prob_mean > mean_threshold]
+
+
+def neighbours_mean_prob(predictions, neigh):
+    """
+    Return mean probability of neighbours of each window in +predictions+
+
+    Mean is 0 for windows with less than +neigh+ neighbours.  Neighbours on
+    the same raster are found on its grid of windows.  Windows of different
+    rasters (e.g. adjacent tiles of a mosaic) are neighbours if their bounds
+    on WGS84 overlap or touch, as in +filter_features_by_mean_prob+.
+
+    """
+    # Windows closer than this number of steps overlap or touch each other
+    radius = predictions.size // predictions.step_size
+
+    counts = np.zeros(len(predictions), dtype=np.int64)
+    sums = np.zeros(len(predictions), dtype=np.float64)
+    for raster_id in np.unique(predictions.raster_id):
+        mask = predictions.raster_id == raster_id
+        counts[mask], sums[mask] = _neighbours_count_and_sum(
+            np.asarray(predictions.row[mask]),
+            np.asarray(predictions.col[mask]),
+            np.asarray(predictions.prob[mask], dtype=np.float64), radius)
+
+    cross_counts, cross_sums = _cross_raster_neighbours_count_and_sum(
+        predictions)
+    counts += cross_counts
+    sums += cross_sums
+
+    prob_mean = np.zeros(len(predictions), dtype=np.float64)
+    valid = (counts >= neigh) & (counts > 0)
+    prob_mean[valid] = sums[valid] / counts[valid]
+    return prob_mean
+
+
+def _neighbours_count_and_sum(rows, cols, probs, radius):
+    """
+    Count and sum probabilities of neighbours in a grid of windows
+
+    Uses summed-area tables of window counts and probabilities, so that the
+    sums over the neighbourhood of each window are computed with four
+    lookups, regardless of +radius+.
+
+    """
+    rows = rows - rows.min()
+    cols = cols - cols.min()
+    shape = (rows.max() + 1, cols.max() + 1)
+
+    count_grid = np.zeros(shape, dtype=np.float64)
+    prob_grid = np.zeros(shape, dtype=np.float64)
+    np.add.at(count_grid, (rows, cols), 1)
+    np.add.at(prob_grid, (rows, cols), probs)
+
+    counts = _window_sums(_summed_area_table(count_grid), rows, cols, radius)
+    sums = _window_sums(_summed_area_table(prob_grid), rows, cols, radius)
+
+    # Exclude the window itself from its neighbourhood
+    return np.rint(counts).astype(np.int64) - 1, sums - probs
+
+
+def _cross_raster_neighbours_count_and_sum(predictions):
+    """
+    Count and sum probabilities of neighbours of each window on other rasters
+
+    Only windows that are inside the extent of windows of another raster
+    are indexed and queried with an R-Tree, so this is cheap for mosaics
+    whose rasters barely overlap.
+
+    """
+    counts = np.zeros(len(predictions), dtype=np.int64)
+    sums = np.zeros(len(predictions), dtype=np.float64)
+    raster_ids = np.asarray(predictions.raster_id)
+    rasters = np.unique(raster_ids)
+    if len(rasters) < 2:
+        return counts, sums
+
+    bounds = predictions.reprojected_bounds(WGS84_CRS)
+    masks = {r: raster_ids == r for r in rasters}
+    extents = {
+        r: (bounds[m, 0].min(), bounds[m, 1].min(), bounds[m, 2].max(),
+            bounds[m, 3].max())
+        for r, m in masks.items()
+    }
+    extents_index = rtree.index.Index()
+    for r, extent in extents.items():
+        extents_index.insert(int(r), extent)
+
+    # Windows that may touch windows of another raster
+    candidates = np.zeros(len(predictions), dtype=bool)
+    for r, mask in masks.items():
+        for other in extents_index.intersection(extents[r]):
+            if other == r:
+                continue
+            minx, miny, maxx, maxy = extents[other]
+            candidates[mask] |= ((bounds[mask, 0] <= maxx) &
+                                 (bounds[mask, 2] >= minx) &
+                                 (bounds[mask, 1] <= maxy) &
+                                 (bounds[mask, 3] >= miny))
+
+    ids = np.nonzero(candidates)[0]
+    index = rtree.index.Index()
+    for i in ids:
+        index.insert(int(i), tuple(bounds[i]))
+    probs = np.asarray(predictions.prob, dtype=np.float64)
+    for i in ids:
+        for j in index.intersection(tuple(bounds[i])):
+            if raster_ids[j] != raster_ids[i]:
+                counts[i] += 1
+                sums[i] += probs[j]
+    return counts, sums
+
+
+def _summed_area_table(grid):
+    table = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1), dtype=grid.dtype)
+    table[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def _window_sums(table, rows, cols, radius):
+    """Sum values of cells inside +radius+ of each (row, col) cell"""
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    r0 = np.clip(rows - radius, 0, height)
+    r1 = np.clip(rows + radius + 1, 0, height)
+    c0 = np.clip(cols - radius, 0, width)
+    c1 = np.clip(cols + radius + 1, 0, width)
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def dissolve_overlapping_shapes(shapes_with_props, buffer_size=None):
+    """
+    Dissolve overlapping shapes into a single shape for each group
+
+    This works on any set of shapes (e.g. read from a vector file).  Groups
+    of overlapping shapes are found with an R-Tree index, and each group is
+    merged with a single union.  For windows predicted by +detect+, use
+    +dissolve_predictions+ instead, which is much faster.
+
+    Properties of dissolved shapes are the mean and max of the "prob"
+    property of their shapes (as "prob" and "prob_max"), and the number of
+    shapes (as "windows").  See +DISSOLVED_PROPERTIES+ for their types.
+
+    """
+    if buffer_size:
+        shapes_with_props = apply_buffer(shapes_with_props, buffer_size)
+
+    _logger.info('Create index for shapes')
+    ix = create_index(shapes_with_props)
+
+    _logger.info('Find groups of overlapping shapes')
+    parents = list(range(len(shapes_with_props)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, shape_with_props in enumerate(tqdm(shapes_with_props)):
+        for j in ix.intersection(shape_with_props.shape.bounds):
+            if j > i and shape_with_props.shape.intersects(
+                    shapes_with_props[j].shape):
+                parents[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(shapes_with_props)):
+        groups.setdefault(find(i), []).append(i)
+
+    _logger.info('Dissolve %d groups of shapes', len(groups))
+    res = []
+    for ids in groups.values():
+        probs = np.array([shapes_with_props[i].props['prob'] for i in ids])
+        res.append(
+            ShapeWithProps(
+                shape=unary_union([shapes_with_props[i].shape for i in ids]),
+                props=_dissolved_props(probs)))
+    return res
+
+
+def dissolve_predictions(predictions, dst_crs=WGS84_CRS):
+    """
+    Dissolve overlapping windows of +predictions+ into polygons
+
+    Windows of each raster are painted on a grid of cells (with the greatest
+    common divisor of window size and step size as cell size), and connected
+    groups of cells are labelled and vectorized, so no geometric union is
+    needed.  Windows of different rasters are dissolved separately.
+
+    Returns a list of +ShapeWithProps+ on +dst_crs+, with the same
+    properties as +dissolve_overlapping_shapes+ (plus "prob_mean", the mean
+    of that column, if present).
+
+    """
+    res = []
+    for raster_id in np.unique(predictions.raster_id):
+        raster_predictions = predictions[predictions.raster_id == raster_id]
+        crs = predictions.crss[raster_id]
+        for shape_, props in _dissolve_grid(raster_predictions):
+            res.append(
+                ShapeWithProps(
+                    shape=reproject_shape(shape_, crs, dst_crs), props=props))
+    _logger.info('%d windows dissolved into %d shapes', len(predictions),
+                 len(res))
+    return res
+
+
+def _dissolve_grid(predictions):
+    """Generate dissolved shapes and properties of windows of one raster"""
+    size, step_size = predictions.size, predictions.step_size
+    cell_size = gcd(size, step_size)
+    k, s = size // cell_size, step_size // cell_size
+
+    rows = np.asarray(predictions.row, dtype=np.int64)
+    cols = np.asarray(predictions.col, dtype=np.int64)
+    transform = _cell_transform(predictions, cell_size)
+    rows, cols = (rows - rows.min()) * s, (cols - cols.min()) * s
+
+    # Paint windows with a 2D difference array, so that each window costs
+    # four updates regardless of its size
+    diff = np.zeros((rows.max() + k + 1, cols.max() + k + 1), dtype=np.int32)
+    np.add.at(diff, (rows, cols), 1)
+    np.add.at(diff, (rows + k, cols), -1)
+    np.add.at(diff, (rows, cols + k), -1)
+    np.add.at(diff, (rows + k, cols + k), 1)
+    covered = diff.cumsum(axis=0).cumsum(axis=1)[:-1, :-1] > 0
+
+    # Windows that touch only at a corner intersect, so they are connected
+    labels = label(covered, connectivity=2).astype(np.int32)
+    window_labels = labels[rows, cols]
+
+    probs = np.asarray(predictions.prob, dtype=np.float64)
+    prob_means = None
+    if 'prob_mean' in predictions.columns:
+        prob_means = np.asarray(predictions.prob_mean, dtype=np.float64)
+
+    geoms = {}
+    for geom, value in raster_shapes(
+            labels, mask=covered, connectivity=8, transform=transform):
+        geom = shape(geom)
+        # Cells that touch only at a corner are vectorized as a polygon
+        # with a self-touching ring, which is split into valid polygons
+        if not geom.is_valid:
+            geom = geom.buffer(0)
+        geoms.setdefault(int(value), []).append(geom)
+
+    order = np.argsort(window_labels, kind='mergesort')
+    starts = np.searchsorted(window_labels[order],
+                             np.arange(1, labels.max() + 2))
+    for i, value in enumerate(range(1, labels.max() + 1)):
+        ids = order[starts[i]:starts[i + 1]]
+        parts = geoms[value]
+        geom = parts[0] if len(parts) == 1 else unary_union(parts)
+        props = _dissolved_props(probs[ids])
+        if prob_means is not None:
+            props['prob_mean'] = float(prob_means[ids].mean())
+        yield geom, props
+
+
+def _cell_transform(predictions, cell_size):
+    """
+    Return the affine transform of the grid of cells of a raster
+
+    Transform is recovered from window bounds, so that cell (0, 0) is the
+    upper-left cell of the window with the lowest row and column.
+
+    """
+    size, step_size = predictions.size, predictions.step_size
+    rows, cols = np.asarray(predictions.row), np.asarray(predictions.col)
+    minx, miny, maxx, maxy = (np.asarray(predictions.columns[c])
+                              for c in ('minx', 'miny', 'maxx', 'maxy'))
+    cell_width = (maxx[0] - minx[0]) * cell_size / size
+    cell_height = (maxy[0] - miny[0]) * cell_size / size
+
+    # Direction of axes, in case raster is not north-up
+    sx = _axis_direction(cols, minx, default=1)
+    sy = _axis_direction(rows, miny, default=-1)
+
+    step_width = cell_width * step_size / cell_size
+    step_height = cell_height * step_size / cell_size
+    x_edge = minx if sx > 0 else maxx
+    y_edge = miny if sy > 0 else maxy
+    x0 = x_edge[0] - sx * step_width * (cols[0] - cols.min())
+    y0 = y_edge[0] - sy * step_height * (rows[0] - rows.min())
+    return Affine(sx * cell_width, 0, x0, 0, sy * cell_height, y0)
+
+
+def _axis_direction(indexes, coords, default):
+    lo, hi = np.argmin(indexes), np.argmax(indexes)
+    if indexes[lo] == indexes[hi]:
+        return default
+    return 1 if coords[hi] > coords[lo] else -1
+
+
+def _dissolved_props(probs):
+    """Aggregate probabilities of dissolved windows"""
+    return dict(
+        prob=float(probs.mean()),
+        prob_max=float(probs.max()),
+        windows=int(len(probs)))
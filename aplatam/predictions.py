@@ -0,0 +1,274 @@
+"""This module contains a columnar representation of predicted windows"""
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+from shapely.geometry import Polygon
+
+from aplatam.util import WGS84_CRS, ShapeWithProps, reproject_coords
+
+_logger = logging.getLogger(__name__)
+
+META_FILENAME = 'meta.json'
+
+# Number of windows whose corners are reprojected together on +iter_shapes+
+SHAPES_CHUNK_SIZE = 10000
+
+# Columns every set of predictions has, with their types
+COLUMNS = OrderedDict([
+    ('minx', 'float64'),
+    ('miny', 'float64'),
+    ('maxx', 'float64'),
+    ('maxy', 'float64'),
+    ('prob', 'float32'),
+    ('raster_id', 'int32'),
+    ('row', 'int32'),
+    ('col', 'int32'),
+])
+
+BOUNDS_COLUMNS = ('minx', 'miny', 'maxx', 'maxy')
+INDEX_COLUMNS = ('raster_id', 'row', 'col')
+
+
+class Predictions:
+    """
+    Columnar set of predicted windows
+
+    As all windows are axis-aligned boxes on the grid of sliding windows of
+    a raster, they are stored as arrays of bounds (on the CRS of their
+    raster), probability, raster id and row and column on the grid of
+    windows, instead of as a list of shapes.  Shapes are only built when
+    needed, with +iter_shapes+.
+
+    Columns other than bounds and indexes (e.g. "prob") are exported as
+    properties of each shape.
+
+    Arguments:
+        rasters {list(str)} -- paths of rasters referenced by raster_id
+        crss {list(dict)} -- CRS of each raster
+        size {int} -- size in pixels of windows
+        step_size {int} -- step size in pixels of sliding windows
+        columns {dict} -- dictionary of column name to array
+
+    """
+
+    def __init__(self, rasters, crss, size, step_size, columns):
+        self.rasters = list(rasters)
+        self.crss = [dict(crs) for crs in crss]
+        self.size = size
+        self.step_size = step_size
+        self.columns = OrderedDict(columns)
+
+    @classmethod
+    def empty(cls, size=None, step_size=None):
+        """Return an empty set of predictions"""
+        columns = OrderedDict(
+            (name, np.empty(0, dtype=dtype))
+            for name, dtype in COLUMNS.items())
+        return cls([], [], size, step_size, columns)
+
+    @classmethod
+    def from_windows(cls, raster, crs, windows, bounds, probs, *, size,
+                     step_size):
+        """
+        Build predictions for +windows+ of a single +raster+
+
+        Arguments:
+            raster {str} -- raster path
+            crs {dict} -- raster CRS
+            windows {list(Window)} -- windows
+            bounds {array} -- array of shape (n, 4) with bounds of windows
+            probs {array} -- probability of each window
+
+        """
+        bounds = np.asarray(bounds, dtype='float64').reshape(-1, 4)
+        columns = OrderedDict(
+            (name, bounds[:, i]) for i, name in enumerate(BOUNDS_COLUMNS))
+        columns['prob'] = np.asarray(probs, dtype='float32')
+        columns['raster_id'] = np.zeros(len(windows), dtype='int32')
+        columns['row'] = np.array(
+            [w.row_off // step_size for w in windows], dtype='int32')
+        columns['col'] = np.array(
+            [w.col_off // step_size for w in windows], dtype='int32')
+        return cls([raster], [crs], size, step_size, columns)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Concatenate a list of predictions into a single one"""
+        parts = list(parts)
+        if not parts:
+            return cls.empty()
+
+        rasters, crss = [], []
+        raster_ids = {}
+        columns = OrderedDict((name, []) for name in parts[0].columns)
+        for part in parts:
+            # Remap raster ids to the new list of rasters
+            id_map = np.empty(len(part.rasters), dtype='int32')
+            for i, (raster, crs) in enumerate(zip(part.rasters, part.crss)):
+                if raster not in raster_ids:
+                    raster_ids[raster] = len(rasters)
+                    rasters.append(raster)
+                    crss.append(crs)
+                id_map[i] = raster_ids[raster]
+            for name in columns:
+                values = part.columns[name]
+                if name == 'raster_id':
+                    values = id_map[values]
+                columns[name].append(values)
+
+        columns = OrderedDict((name, np.concatenate(values))
+                              for name, values in columns.items())
+        size = next((p.size for p in parts if p.size), None)
+        step_size = next((p.step_size for p in parts if p.step_size), None)
+        return cls(rasters, crss, size, step_size, columns)
+
+    def __len__(self):
+        return len(self.columns['prob'])
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        """Return a subset of predictions from a boolean mask or indexes"""
+        columns = OrderedDict(
+            (name, values[key]) for name, values in self.columns.items())
+        return Predictions(self.rasters, self.crss, self.size,
+                           self.step_size, columns)
+
+    @property
+    def bounds(self):
+        """Array of shape (n, 4) with bounds of all windows"""
+        return np.column_stack([self.columns[c] for c in BOUNDS_COLUMNS])
+
+    @property
+    def prop_names(self):
+        """Names of columns that are exported as shape properties"""
+        return [
+            name for name in self.columns
+            if name not in BOUNDS_COLUMNS and name not in INDEX_COLUMNS
+        ]
+
+    def with_column(self, name, values):
+        """Return a copy of predictions with a new (or replaced) column"""
+        columns = OrderedDict(self.columns)
+        columns[name] = np.asarray(values)
+        return Predictions(self.rasters, self.crss, self.size,
+                           self.step_size, columns)
+
+    def select_rasters(self, rasters):
+        """Return predictions of windows that belong to +rasters+"""
+        rasters = set(rasters)
+        raster_mask = np.array([r in rasters for r in self.rasters], dtype=bool)
+        if raster_mask.all():
+            return self
+        return self[raster_mask[self.raster_id]]
+
+    def iter_shapes(self, dst_crs=WGS84_CRS, chunk_size=SHAPES_CHUNK_SIZE):
+        """
+        Generate a +ShapeWithProps+ for each window, on +dst_crs+
+
+        Corners of windows are reprojected in chunks of +chunk_size+ windows,
+        with a single coordinate transform per raster CRS.
+
+        """
+        prop_names = self.prop_names
+        for chunk_start in range(0, len(self), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            xs, ys = self._reprojected_corners(chunk, dst_crs)
+            props = [self.columns[name][chunk] for name in prop_names]
+            for i in range(len(xs)):
+                shape = Polygon(zip(xs[i], ys[i]))
+                yield ShapeWithProps(
+                    shape=shape,
+                    props={
+                        name: float(values[i])
+                        for name, values in zip(prop_names, props)
+                    })
+
+    def reprojected_bounds(self, dst_crs=WGS84_CRS):
+        """Return an array of shape (n, 4) with bounds of windows on +dst_crs+"""
+        xs, ys = self._reprojected_corners(slice(None), dst_crs)
+        return np.column_stack(
+            [xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)])
+
+    def _reprojected_corners(self, chunk, dst_crs):
+        """
+        Return arrays of shape (n, 4) of x and y coordinates of corners of
+        windows in +chunk+, on +dst_crs+
+
+        Corners are in the same order as those of +shapely.geometry.box+.
+
+        """
+        minx, miny, maxx, maxy = (self.columns[c][chunk]
+                                  for c in BOUNDS_COLUMNS)
+        xs = np.column_stack([maxx, maxx, minx, minx])
+        ys = np.column_stack([miny, maxy, maxy, miny])
+        raster_ids = self.raster_id[chunk]
+        for raster_id in np.unique(raster_ids):
+            mask = raster_ids == raster_id
+            new_xs, new_ys = reproject_coords(
+                xs[mask].ravel(),
+                ys[mask].ravel(),
+                src_crs=self.crss[raster_id],
+                dst_crs=dst_crs)
+            xs[mask] = np.reshape(new_xs, (-1, 4))
+            ys[mask] = np.reshape(new_ys, (-1, 4))
+        return xs, ys
+
+    def save(self, path):
+        """
+        Save predictions to directory +path+, one .npy file per column
+
+        Predictions are written to a temporary sibling directory, which then
+        replaces +path+, so an interrupted save never leaves a partial
+        directory at +path+.
+
+        """
+        tmp_path = '{}.tmp'.format(os.path.normpath(path))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, values in self.columns.items():
+            np.save(os.path.join(tmp_path, '{}.npy'.format(name)), values)
+        meta = dict(
+            rasters=self.rasters,
+            crss=self.crss,
+            size=self.size,
+            step_size=self.step_size,
+            columns=list(self.columns))
+        with open(os.path.join(tmp_path, META_FILENAME), 'w') as dst:
+            json.dump(meta, dst)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        _logger.info('%d predictions written to %s', len(self), path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load predictions from directory +path+
+
+        If +mmap+ is True, columns are memory-mapped instead of read into
+        memory.
+
+        """
+        with open(os.path.join(path, META_FILENAME)) as src:
+            meta = json.load(src)
+        mmap_mode = 'r' if mmap else None
+        columns = OrderedDict(
+            (name,
+             np.load(
+                 os.path.join(path, '{}.npy'.format(name)),
+                 mmap_mode=mmap_mode)) for name in meta['columns'])
+        return cls(meta['rasters'], meta['crss'], meta['size'],
+                   meta['step_size'], columns)
+
+
+def is_saved_predictions(path):
+    """Return True if +path+ contains predictions saved completely"""
+    return os.path.exists(os.path.join(path, META_FILENAME))
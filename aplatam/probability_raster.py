@@ -0,0 +1,198 @@
+"""This module contains functions for writing and reading probability rasters"""
+import logging
+import os
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from aplatam.grid import WindowGrid
+from aplatam.predictions import Predictions
+
+_logger = logging.getLogger(__name__)
+
+# Value of pixels of windows that were not predicted
+NODATA = -1
+
+OVERVIEW_FACTORS = (2, 4, 8, 16, 32)
+
+# Maximum difference in seconds between the modification time of a
+# probability raster and the time of the last recorded batch of its raster
+# for it to be considered current, as some filesystems have coarse times
+MTIME_TOLERANCE = 2
+
+PROFILE = dict(
+    driver='GTiff',
+    dtype='float32',
+    count=1,
+    nodata=NODATA,
+    tiled=True,
+    blockxsize=256,
+    blockysize=256,
+    compress='deflate',
+    predictor=3,
+    bigtiff='if_safer')
+
+
+class ProbabilityRasterWriter:
+    """
+    Writes the probability of each sliding window of a raster to a GeoTIFF
+
+    Output raster has one pixel per window step: pixel at (row, col) is the
+    window at (row, col) of a +WindowGrid+, centered on the center of the
+    window.  Windows that are not predicted (e.g. outside a contour shape)
+    are set to +NODATA+.  Probabilities are written as soon as they are
+    known, and overviews are built on +close+, so that output can be used
+    directly as a heat-map layer.
+
+    Arguments:
+        path {str} -- output GeoTIFF path
+        grid {WindowGrid} -- grid of windows of the raster
+        crs {dict} -- raster CRS
+        raster {str} -- raster path, stored as metadata
+        resume {bool} -- if True and +path+ exists, keep its probabilities
+
+    """
+
+    def __init__(self, path, grid, crs, raster=None, resume=False):
+        self.path = path
+        self.grid = grid
+        self.probs = np.full(grid.shape, NODATA, dtype=np.float32)
+
+        if resume and os.path.exists(path):
+            _logger.info('Resume probability raster %s', path)
+            self._dst = rasterio.open(path, 'r+')
+            self.probs[:] = self._dst.read(1)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            height, width = grid.shape
+            profile = dict(
+                PROFILE,
+                width=width,
+                height=height,
+                crs=crs,
+                transform=probability_transform(grid))
+            self._dst = rasterio.open(path, 'w', **profile)
+            self._dst.write(self.probs, 1)
+        self._dst.update_tags(
+            raster=raster or '',
+            size=grid.size,
+            step_size=grid.step_size)
+
+    def write(self, rows, cols, probs):
+        """Write probabilities +probs+ of windows at +rows+ and +cols+"""
+        if not len(rows):
+            return
+        self.probs[rows, cols] = probs
+        row_start, row_end = int(np.min(rows)), int(np.max(rows)) + 1
+        window = Window(0, row_start, self.grid.shape[1], row_end - row_start)
+        self._dst.write(self.probs[row_start:row_end], 1, window=window)
+
+    def close(self):
+        """Build overviews and close output raster"""
+        factors = [
+            f for f in OVERVIEW_FACTORS if min(self.grid.shape) // f >= 2
+        ]
+        if factors:
+            self._dst.build_overviews(factors, Resampling.average)
+            self._dst.update_tags(ns='rio_overview', resampling='average')
+        self._dst.close()
+        _logger.info('Probability raster written to %s', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_probability_raster(path, raster, *, size, step_size, resume=False):
+    """
+    Return a +ProbabilityRasterWriter+ for the windows of +raster+
+
+    Returns None if +raster+ is smaller than a window, as it has no windows
+    and its probability raster would be empty.
+
+    """
+    with rasterio.open(raster) as src:
+        grid = WindowGrid.from_dataset(src, size=size, step_size=step_size)
+        crs = src.crs
+    if not len(grid):
+        _logger.info('%s has no windows, skip its probability raster',
+                     raster)
+        return None
+    return ProbabilityRasterWriter(
+        path, grid, crs, raster=raster, resume=resume)
+
+
+def is_probability_raster_current(path, updated):
+    """
+    Return True if probability raster at +path+ exists and it was modified
+    after +updated+, the time of the last prediction written to it
+
+    A probability raster that is missing or older than that (e.g. it was not
+    flushed when detection was interrupted) lacks some predictions.
+
+    """
+    return (os.path.exists(path)
+            and os.path.getmtime(path) >= updated - MTIME_TOLERANCE)
+
+
+def probability_raster_path(probability_dir, input_dir, raster):
+    """
+    Return path of the probability raster of +raster+ in +probability_dir+
+
+    Path relative to +input_dir+ is kept, so rasters with the same name in
+    different subdirectories do not collide.
+
+    """
+    rel_path = os.path.relpath(raster, input_dir)
+    return os.path.join(probability_dir,
+                        '{}.tif'.format(os.path.splitext(rel_path)[0]))
+
+
+def probability_transform(grid):
+    """Return affine transform of the probability raster of +grid+"""
+    offset = (grid.size - grid.step_size) / 2
+    return (grid.transform * Affine.translation(offset, offset) *
+            Affine.scale(grid.step_size))
+
+
+def read_probability_raster(path, threshold=0.):
+    """
+    Read windows with a probability of at least +threshold+ from +path+
+
+    This is the same as the predictions made by +detect+ with that
+    threshold, so they can be filtered and dissolved again without
+    predicting.  Returns a +Predictions+.
+
+    """
+    with rasterio.open(path) as src:
+        probs = src.read(1)
+        tags = src.tags()
+        transform = src.transform
+        crs = src.crs.to_dict()
+
+    size, step_size = int(tags['size']), int(tags['step_size'])
+    offset = (size - step_size) / 2
+    raster_transform = (transform * Affine.scale(1 / step_size) *
+                        Affine.translation(-offset, -offset))
+    height, width = probs.shape
+    grid = WindowGrid(
+        raster_transform, (width - 1) * step_size + size,
+        (height - 1) * step_size + size,
+        size=size,
+        step_size=step_size)
+
+    mask = (probs != NODATA) & (probs >= threshold)
+    rows, cols = grid.cells(mask)
+    return Predictions.from_windows(
+        tags.get('raster') or path,
+        crs,
+        grid.windows(mask),
+        grid.bounds(rows, cols),
+        probs[mask],
+        size=size,
+        step_size=step_size)
@@ -0,0 +1,475 @@
+"""This module contains functions for calculating raster statistics"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.windows import Window
+
+_logger = logging.getLogger(__name__)
+
+# Number of bins of histograms of non 8-bit/16-bit rasters
+DEFAULT_BINS = 65536
+
+# Default directory of the statistics cache (if APLATAM_CACHE_DIR is not set)
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'aplatam')
+
+# Files that make up a Shapefile, which are all hashed by +file_digest+
+SHAPEFILE_EXTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# Integer types whose values can be counted exactly, and their offsets
+EXACT_DTYPES = {
+    'uint8': (256, 0),
+    'int8': (256, 128),
+    'uint16': (65536, 0),
+    'int16': (65536, 32768),
+}
+
+
+class Histogram:
+    """
+    Per-band histograms of a raster
+
+    Arguments:
+        counts {array} -- array of shape (bands, bins) with counts per bin
+        min_value {float} -- lower edge of the first bin
+        bin_width {float} -- width of each bin
+        exact {bool} -- whether each bin corresponds to a single integer
+            value, in which case percentiles are exact
+
+    """
+
+    def __init__(self, counts, min_value, bin_width, exact):
+        self.counts = counts
+        self.min_value = min_value
+        self.bin_width = bin_width
+        self.exact = exact
+
+    def percentiles(self, qs):
+        """
+        Return percentiles +qs+ of values of all bands together
+
+        Interpolates linearly between values as +np.percentile+ does, so if
+        histogram is exact, results are the same as calling +np.percentile+
+        on all values.
+
+        """
+        counts = self.counts.sum(axis=0)
+        cumcounts = np.cumsum(counts)
+        total = cumcounts[-1]
+        if total == 0:
+            return tuple(float('nan') for _ in qs)
+
+        res = []
+        for q in qs:
+            rank = q / 100. * (total - 1)
+            lo, hi = int(np.floor(rank)), int(np.ceil(rank))
+            v_lo = self._value(np.searchsorted(cumcounts, lo, side='right'))
+            v_hi = self._value(np.searchsorted(cumcounts, hi, side='right'))
+            res.append(v_lo + (rank - lo) * (v_hi - v_lo))
+        return tuple(res)
+
+    def _value(self, i):
+        if self.exact:
+            return self.min_value + i
+        # Approximate value by the center of bin
+        return self.min_value + (i + 0.5) * self.bin_width
+
+
+class HistogramBuilder:
+    """
+    Builds per-band histograms from chunks of raster data
+
+    8-bit and 16-bit values are counted exactly, on one bin per value.
+    Values of other types are counted on +bins+ bins of equal width, whose
+    range is doubled (by merging pairs of adjacent bins) whenever a value
+    falls outside of it.
+
+    Arguments:
+        dtype {str} -- data type of raster
+        count {int} -- number of bands
+        bins {int} -- number of bins of non 8-bit/16-bit rasters
+
+    """
+
+    def __init__(self, dtype, count, bins=DEFAULT_BINS):
+        self.exact = dtype in EXACT_DTYPES
+        if self.exact:
+            nbins, self.offset = EXACT_DTYPES[dtype]
+            self.min_value, self.bin_width = -self.offset, 1
+        else:
+            # Bins are even, so that range can be doubled by merging pairs of
+            # bins
+            nbins = bins + bins % 2
+            self.min_value, self.bin_width = None, None
+        self.counts = np.zeros((count, nbins), dtype=np.int64)
+
+    def add(self, data):
+        """Count values of +data+, an array of shape (bands, rows, cols)"""
+        nbins = self.counts.shape[1]
+        if self.exact:
+            idx = data.astype(np.int64) + self.offset
+        else:
+            data = data.astype(np.float64)
+            vmin, vmax = float(data.min()), float(data.max())
+            if self.min_value is None:
+                self.min_value = vmin
+                self.bin_width = max((vmax - vmin) / nbins,
+                                     np.finfo('float32').eps)
+            while (vmin < self.min_value
+                   or vmax >= self.min_value + nbins * self.bin_width):
+                self.counts, self.min_value, self.bin_width = _expand_range(
+                    self.counts,
+                    self.min_value,
+                    self.bin_width,
+                    downwards=vmin < self.min_value)
+            idx = ((data - self.min_value) / self.bin_width).astype(np.int64)
+            idx = np.clip(idx, 0, nbins - 1)
+        for b in range(len(self.counts)):
+            self.counts[b] += np.bincount(idx[b].ravel(), minlength=nbins)
+
+    def histogram(self):
+        """Return a +Histogram+ of all values added so far"""
+        return Histogram(self.counts, self.min_value or 0, self.bin_width
+                         or 1, self.exact)
+
+
+def calculate_histogram(src,
+                        bands=(1, 2, 3),
+                        block_size=1,
+                        decimation=1,
+                        block_stride=1,
+                        bins=DEFAULT_BINS):
+    """
+    Calculate histograms of +bands+ of dataset +src+ in a single pass
+
+    Raster is read in windows of +block_size+ times its internal block size,
+    so memory usage is bounded regardless of raster size.  See
+    +HistogramBuilder+ for how values are counted.
+
+    The following arguments trade accuracy for speed:
+
+    * +decimation+ reads each window at 1/+decimation+ of its resolution,
+      which uses raster overviews if available.
+    * +block_stride+ reads only one of every +block_stride+ windows.
+
+    Returns a +Histogram+.
+
+    """
+    bands = list(bands)
+    builder = HistogramBuilder(src.dtypes[bands[0] - 1], len(bands), bins)
+    for i, window in enumerate(_read_windows(src, block_size)):
+        if i % block_stride != 0:
+            continue
+        builder.add(_read(src, bands, window, decimation))
+    return builder.histogram()
+
+
+def calculate_percentiles(raster,
+                          block_size=1,
+                          decimation=1,
+                          block_stride=1,
+                          *,
+                          lower_cut,
+                          upper_cut,
+                          compute_histogram=None):
+    """
+    Calculate +lower_cut+ and +upper_cut+ percentiles of RGB bands of +raster+
+
+    Percentiles (and the histograms they are calculated from) are stored in
+    the statistics cache, so they are calculated only once per raster.  See
+    +calculate_histogram+ for the meaning of the rest of the arguments.
+
+    If +compute_histogram+ is given, it is called instead of
+    +calculate_histogram+ when the histogram is not cached (e.g. to build it
+    while reading the raster for something else).
+
+    """
+    return get_stats_cache().percentiles(
+        raster,
+        block_size=block_size,
+        decimation=decimation,
+        block_stride=block_stride,
+        lower_cut=lower_cut,
+        upper_cut=upper_cut,
+        compute_histogram=compute_histogram)
+
+
+def get_raster_info(raster):
+    """
+    Return a dictionary with metadata of +raster+
+
+    Keys are "crs", "bounds", "count", "width", "height" and "dtypes".
+    Metadata is stored in the statistics cache.
+
+    """
+    info = get_stats_cache().info(raster)
+    return dict(info, crs=CRS(info['crs']))
+
+
+def get_raster_digest(raster):
+    """
+    Return a hash of the contents of +raster+
+
+    Hash is stored in the statistics cache, so a raster is only hashed once
+    until it changes.
+
+    """
+    return get_stats_cache().digest(raster)
+
+
+def file_digest(path):
+    """Return hash of contents of +path+ (and its sidecar files)"""
+    paths = [path]
+    stem, ext = os.path.splitext(path)
+    if ext.lower() == '.shp':
+        paths = [
+            stem + e for e in SHAPEFILE_EXTS if os.path.exists(stem + e)
+        ]
+    digest = hashlib.sha1()
+    for p in paths:
+        with open(p, 'rb') as src:
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cache_dir():
+    """
+    Return the cache directory
+
+    It is $APLATAM_CACHE_DIR (by default ~/.cache/aplatam).  Returns None if
+    APLATAM_CACHE_DIR is set to an empty string, which disables the cache.
+
+    """
+    cache_dir = os.environ.get('APLATAM_CACHE_DIR', DEFAULT_CACHE_DIR)
+    if not cache_dir:
+        return None
+    return os.path.expanduser(cache_dir)
+
+
+def get_stats_cache():
+    """
+    Return the statistics cache
+
+    Cache is stored in the "stats" subdirectory of the cache directory (see
+    +get_cache_dir+).
+
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return RasterStatsCache(None)
+    return RasterStatsCache(os.path.join(cache_dir, 'stats'))
+
+
+class RasterStatsCache:
+    """
+    On-disk cache of raster metadata and statistics
+
+    Entries are keyed by raster path, size and modification time, so they are
+    invalidated when the raster changes.  Each entry stores metadata (CRS,
+    bounds, band count), a hash of contents and percentiles as JSON, and
+    histograms as .npz files.  Percentiles for new cuts are calculated from
+    cached histograms, without reading the raster again.
+
+    Arguments:
+        path {str} -- cache directory. If None, nothing is stored.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def info(self, raster):
+        """Return metadata of +raster+"""
+        entry = self._read_entry(raster)
+        if 'info' not in entry:
+            with rasterio.open(raster) as src:
+                entry['info'] = dict(
+                    crs=src.crs.to_dict() if src.crs else {},
+                    bounds=list(src.bounds),
+                    count=src.count,
+                    width=src.width,
+                    height=src.height,
+                    dtypes=list(src.dtypes))
+            self._write_entry(raster, entry)
+        return entry['info']
+
+    def digest(self, raster):
+        """Return a hash of the contents of +raster+"""
+        entry = self._read_entry(raster)
+        if 'digest' not in entry:
+            _logger.info('Calculate hash of %s', raster)
+            entry['digest'] = file_digest(raster)
+            self._write_entry(raster, entry)
+        return entry['digest']
+
+    def histogram(self,
+                  raster,
+                  block_size=1,
+                  decimation=1,
+                  block_stride=1,
+                  compute=None):
+        """
+        Return a +Histogram+ of the RGB bands of +raster+
+
+        If it is not cached, call +compute+ to calculate it (by default, use
+        +calculate_histogram+) and store it.
+
+        """
+        hist_path = self._histogram_path(raster, decimation, block_stride)
+        if hist_path and os.path.exists(hist_path):
+            with np.load(hist_path) as data:
+                return Histogram(data['counts'], float(data['min_value']),
+                                 float(data['bin_width']), bool(data['exact']))
+
+        if compute:
+            hist = compute()
+        else:
+            with rasterio.open(raster) as src:
+                _logger.info('Calculate histogram of %s', raster)
+                hist = calculate_histogram(
+                    src,
+                    block_size=block_size,
+                    decimation=decimation,
+                    block_stride=block_stride)
+
+        if hist_path:
+            with _atomic_write(hist_path) as dst:
+                np.savez(
+                    dst,
+                    counts=hist.counts,
+                    min_value=hist.min_value,
+                    bin_width=hist.bin_width,
+                    exact=hist.exact)
+        return hist
+
+    def percentiles(self,
+                    raster,
+                    block_size=1,
+                    decimation=1,
+                    block_stride=1,
+                    *,
+                    lower_cut,
+                    upper_cut,
+                    compute_histogram=None):
+        """Return +lower_cut+ and +upper_cut+ percentiles of +raster+"""
+        entry = self._read_entry(raster)
+        key = '{},{},{},{}'.format(lower_cut, upper_cut, decimation,
+                                   block_stride)
+        percentiles = entry.setdefault('percentiles', {})
+        if key not in percentiles:
+            hist = self.histogram(
+                raster,
+                block_size=block_size,
+                decimation=decimation,
+                block_stride=block_stride,
+                compute=compute_histogram)
+            percentiles[key] = hist.percentiles((lower_cut, upper_cut))
+            self._write_entry(raster, entry)
+        else:
+            _logger.info('Reuse cached percentiles of %s', raster)
+        return tuple(percentiles[key])
+
+    def array(self, raster, name, compute):
+        """
+        Return an array named +name+ associated with +raster+
+
+        If it is not cached, call +compute+ to calculate it and store it.
+
+        """
+        array_path = None
+        if self.path is not None:
+            array_path = os.path.join(
+                self.path, '{}-{}.npy'.format(self._key(raster), name))
+        if array_path and os.path.exists(array_path):
+            _logger.info('Reuse cached %s of %s', name, raster)
+            return np.load(array_path)
+
+        array = compute()
+        if array_path:
+            with _atomic_write(array_path) as dst:
+                np.save(dst, array)
+        return array
+
+    def _key(self, raster):
+        stat = os.stat(raster)
+        key = json.dumps(
+            [os.path.abspath(raster), stat.st_size, stat.st_mtime_ns])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, raster):
+        if self.path is None:
+            return None
+        return os.path.join(self.path, '{}.json'.format(self._key(raster)))
+
+    def _histogram_path(self, raster, decimation, block_stride):
+        if self.path is None:
+            return None
+        return os.path.join(
+            self.path, '{}-{}-{}.npz'.format(
+                self._key(raster), decimation, block_stride))
+
+    def _read_entry(self, raster):
+        entry_path = self._entry_path(raster)
+        if entry_path and os.path.exists(entry_path):
+            with open(entry_path) as src:
+                return json.load(src)
+        return dict(path=os.path.abspath(raster))
+
+    def _write_entry(self, raster, entry):
+        entry_path = self._entry_path(raster)
+        if entry_path:
+            with _atomic_write(entry_path, 'w') as dst:
+                json.dump(entry, dst)
+
+
+@contextmanager
+def _atomic_write(path, mode='wb'):
+    """Write to a temporary file and move it to +path+ when done"""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as dst:
+            yield dst
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_windows(src, block_size):
+    """Generate windows of +block_size+ times the internal block size"""
+    block_height, block_width = src.block_shapes[0]
+    height, width = block_height * block_size, block_width * block_size
+    for row_off in range(0, src.height, height):
+        for col_off in range(0, src.width, width):
+            yield Window(col_off, row_off, min(width, src.width - col_off),
+                         min(height, src.height - row_off))
+
+
+def _read(src, bands, window, decimation):
+    if decimation > 1:
+        out_shape = (len(bands), max(1, int(window.height) // decimation),
+                     max(1, int(window.width) // decimation))
+        return src.read(bands, window=window, out_shape=out_shape)
+    return src.read(bands, window=window)
+
+
+def _expand_range(counts, min_value, bin_width, downwards):
+    """Double range of histogram by merging pairs of adjacent bins"""
+    nbins = counts.shape[1]
+    merged = counts[:, 0::2] + counts[:, 1::2]
+    new_counts = np.zeros_like(counts)
+    if downwards:
+        new_counts[:, nbins // 2:] = merged
+        min_value -= nbins * bin_width
+    else:
+        new_counts[:, :nbins // 2] = merged
+    return new_counts, min_value, bin_width * 2
@@ -1,32 +1,96 @@
 from glob import glob
+import hashlib
+import json
 import logging
 import os
 
+import h5py
+import numpy as np
+import rasterio
 from keras import applications, optimizers
 from keras.callbacks import EarlyStopping
-from keras.layers import Dense, Dropout, Flatten
+from keras import backend as K
+from keras.layers import (Dense, Dropout, Flatten, GlobalAveragePooling2D,
+                          Input)
 from keras.models import Model
 from keras.preprocessing.image import ImageDataGenerator
+from keras.utils import Sequence
+from skimage import exposure, img_as_ubyte
+from skimage.io import imread
+
+from aplatam import __version__
+from aplatam.build_trainset import trainset_manifest
+from aplatam.class_balancing import split_samples
+from aplatam.embedding_cache import FLIP_VARIANTS, EmbeddingCache
+from aplatam.packed_dataset import PackedDataset, is_packed_dataset
+from aplatam.window_reader import BlockCacheReader
 
 RESNET_50_LAYERS = 174
 
+# Heads of the classifier, on top of ResNet-50: flattened activations or
+# global average pooling of activations, followed by a dense layer
+HEADS = ('flatten', 'gap')
+DEFAULT_DENSE_UNITS = dict(flatten=1024, gap=256)
+
+# Attribute of HDF5 model files with metadata of the model, as JSON
+MODEL_METADATA_ATTR = 'aplatam_metadata'
+
+# Directory of cached activations of frozen layers, inside dataset directory
+EMBEDDINGS_DIRNAME = 'embeddings'
+
 _logger = logging.getLogger(__name__)
 
 
-def train(output_model_file, dataset_dir, *, trainable_layers, batch_size,
-          epochs, size):
+def train(output_model_file,
+          dataset_dir,
+          *,
+          trainable_layers,
+          batch_size,
+          epochs,
+          size,
+          head='flatten',
+          dense_units=None,
+          cache_embeddings=False):
+    """
+    Train a model on the trainset at +dataset_dir+
+
+    +head+ and +dense_units+ select the layers on top of ResNet-50 (see
+    +add_custom_layers+), and are stored as metadata of the model file.
+
+    If +cache_embeddings+ is True, activations of frozen layers are
+    calculated once for each image (and each of its flips) and cached
+    inside +dataset_dir+, so that only trainable layers are run on each
+    epoch (see +train_on_embeddings+).  This does not train exactly the same
+    model: frozen batch normalization layers use their moving statistics,
+    as on inference, instead of statistics of each batch.
+
+    """
 
     img_width, img_height = size, size
 
     assert size >= 197, \
         'image size must be at least 197x197, but was {size}x{size}'.format(size=size)
 
-    dataset_files = find_dataset_files(dataset_dir)
-
-    nb_true_train_samples = len(dataset_files['true_train'])
-    nb_false_train_samples = len(dataset_files['false_train'])
+    train_data_dir = os.path.join(dataset_dir, 'train')
+    validation_data_dir = os.path.join(dataset_dir, 'test')
+    packed = is_packed_dataset(train_data_dir)
+
+    if packed:
+        _logger.info('Use packed dataset at %s', dataset_dir)
+        train_dataset = PackedDataset(train_data_dir)
+        validation_dataset = PackedDataset(validation_data_dir)
+        assert train_dataset.shape == (img_height, img_width, 3), \
+            'images of dataset have shape {}, but size is {}'.format(
+                train_dataset.shape, size)
+        nb_true_train_samples = int(np.sum(train_dataset.labels == 1))
+        nb_false_train_samples = int(np.sum(train_dataset.labels == 0))
+        nb_validation_samples = len(validation_dataset)
+    else:
+        dataset_files = find_dataset_files(dataset_dir)
+        nb_true_train_samples = len(dataset_files['true_train'])
+        nb_false_train_samples = len(dataset_files['false_train'])
+        nb_validation_samples = len(dataset_files['validation'])
     nb_train_samples = nb_true_train_samples + nb_false_train_samples
-    nb_validation_samples = len(dataset_files['validation'])
 
     class_weight = {
         0: 1.,
@@ -34,28 +98,54 @@ def train(output_model_file, dataset_dir, *, trainable_layers, batch_size,
     }
     _logger.info('Class weight: %s', class_weight)
 
-    # Build model using ResNet-50 as base input
-    base_model = build_resnet50_model(img_width, img_height)
-    freeze_layers(base_model, trainable_layers)
-    outputs = add_custom_layers(base_model)
-    model = Model(inputs=base_model.input, outputs=outputs)
-    compile_model(model)
+    if cache_embeddings:
+        if not packed:
+            train_dataset = ImageFiles(train_data_dir)
+            validation_dataset = ImageFiles(validation_data_dir)
+        model = train_on_embeddings(
+            train_dataset,
+            validation_dataset,
+            os.path.join(dataset_dir, EMBEDDINGS_DIRNAME),
+            manifest=trainset_manifest(dataset_dir),
+            class_weight=class_weight,
+            trainable_layers=trainable_layers,
+            batch_size=batch_size,
+            epochs=epochs,
+            size=size,
+            head=head,
+            dense_units=dense_units)
+        save_model(
+            model,
+            output_model_file,
+            metadata=model_metadata(
+                size=size,
+                trainable_layers=trainable_layers,
+                head=head,
+                dense_units=dense_units))
+        return
+
+    model = build_model(
+        size, trainable_layers, head=head, dense_units=dense_units)
 
     # Prepare data generators for training and test sets
     # Augment data by performing horizontal/vertical flips
-    train_datagen = ImageDataGenerator(
-        horizontal_flip=True,
-        vertical_flip=True,
-        preprocessing_function=applications.resnet50.preprocess_input)
-    test_datagen = ImageDataGenerator(
-        preprocessing_function=applications.resnet50.preprocess_input)
-
-    train_data_dir = os.path.join(dataset_dir, 'train')
-    train_generator = train_data_generator(train_datagen, train_data_dir,
-                                           img_height, img_width, batch_size)
-    validation_data_dir = os.path.join(dataset_dir, 'test')
-    validation_generator = validation_data_generator(
-        test_datagen, validation_data_dir, img_height, img_width, batch_size)
+    if packed:
+        train_generator = PackedSequence(
+            train_dataset, batch_size, augment=True, shuffle=True)
+        validation_generator = PackedSequence(validation_dataset, batch_size)
+    else:
+        train_datagen = ImageDataGenerator(
+            horizontal_flip=True,
+            vertical_flip=True,
+            preprocessing_function=applications.resnet50.preprocess_input)
+        test_datagen = ImageDataGenerator(
+            preprocessing_function=applications.resnet50.preprocess_input)
+
+        train_generator = train_data_generator(
+            train_datagen, train_data_dir, img_height, img_width, batch_size)
+        validation_generator = validation_data_generator(
+            test_datagen, validation_data_dir, img_height, img_width,
+            batch_size)
 
     # Start training model
     train_model(
@@ -70,13 +160,294 @@ def train(output_model_file, dataset_dir, *, trainable_layers, batch_size,
     _logger.info('Training completed')
 
     # Finally, save model to a file
-    save_model(model, output_model_file)
+    save_model(
+        model,
+        output_model_file,
+        metadata=model_metadata(
+            size=size,
+            trainable_layers=trainable_layers,
+            head=head,
+            dense_units=dense_units))
+
+
+def train_streaming(output_model_file,
+                    true_samples,
+                    false_samples,
+                    percentiles,
+                    *,
+                    trainable_layers,
+                    batch_size,
+                    epochs,
+                    size,
+                    test_size=0.25,
+                    balancing_multiplier=1,
+                    head='flatten',
+                    dense_units=None,
+                    seed=None):
+    """
+    Train a model reading images directly from windows of rasters
+
+    Samples are (raster, window) tuples, as returned by
+    +CnnTrainsetBuilder.partition+, so there is no need to build a trainset
+    first.  Samples are split into training and validation sets, and false
+    samples of the training set are balanced again on each epoch (see
+    +RasterWindowSequence+).
+
+    """
+    assert size >= 197, \
+        'image size must be at least 197x197, but was {size}x{size}'.format(size=size)
+
+    (t_train, f_train), (t_test, f_test) = split_samples(
+        true_samples, false_samples, test_size=test_size)
+
+    train_generator = RasterWindowSequence(
+        t_train,
+        f_train,
+        percentiles,
+        batch_size,
+        balancing_multiplier=balancing_multiplier,
+        augment=True,
+        seed=seed)
+    validation_generator = RasterWindowSequence(
+        t_test,
+        f_test,
+        percentiles,
+        batch_size,
+        balancing_multiplier=balancing_multiplier,
+        rebalance=False,
+        seed=seed)
+
+    class_weight = {0: 1., 1: round(balancing_multiplier)}
+    _logger.info('Class weight: %s', class_weight)
+
+    model = build_model(
+        size, trainable_layers, head=head, dense_units=dense_units)
+    train_model(
+        model,
+        train_generator=train_generator,
+        train_samples=len(train_generator.samples),
+        validation_generator=validation_generator,
+        validation_samples=len(validation_generator.samples),
+        class_weight=class_weight,
+        batch_size=batch_size,
+        epochs=epochs)
+    _logger.info('Training completed')
+
+    train_generator.close()
+    validation_generator.close()
+    save_model(
+        model,
+        output_model_file,
+        metadata=model_metadata(
+            size=size,
+            trainable_layers=trainable_layers,
+            head=head,
+            dense_units=dense_units))
+
+
+def train_on_embeddings(train_dataset,
+                        validation_dataset,
+                        cache_dir,
+                        *,
+                        class_weight,
+                        trainable_layers,
+                        batch_size,
+                        epochs,
+                        size,
+                        head='flatten',
+                        dense_units=None,
+                        manifest=None):
+    """
+    Train a model running only its trainable layers on each epoch
+
+    Frozen layers of ResNet-50 do not change while training, so their
+    activations are calculated once for each image of the training set (and
+    each of its flip variants, used for augmentation) and each image of the
+    validation set, and cached in +cache_dir+ (see +EmbeddingCache+).
+    Trainable layers and custom layers are then trained on the cached
+    activations.  Returns the full model, with all layers.
+
+    Activations are calculated in inference mode, so frozen batch
+    normalization layers use their moving statistics, as when the model is
+    used for detection.  This is intended, and it is the only difference
+    with +train+ without cache, where Keras normalizes activations of
+    frozen layers with the statistics of each batch while training.
+
+    Cached activations are reused while the model, the trainset +manifest+
+    (build parameters and digests of rasters) and the files of each dataset
+    (names, sizes and modification times) are the same.
+
+    """
+    base_model = build_resnet50_model(size, size)
+    freeze_layers(base_model, trainable_layers)
+    frozen_model, trainable_model = split_frozen_layers(
+        base_model, trainable_layers)
+    head_model = Model(
+        inputs=trainable_model.inputs,
+        outputs=add_custom_layers(
+            trainable_model, head=head, dense_units=dense_units))
+    compile_model(head_model)
+
+    def predict(images):
+        images = applications.resnet50.preprocess_input(
+            images.astype(np.float32))
+        outputs = frozen_model.predict(images, batch_size=batch_size)
+        return outputs if isinstance(outputs, list) else [outputs]
+
+    key = dict(
+        model='resnet50',
+        size=size,
+        trainable_layers=trainable_layers,
+        params=(manifest or {}).get('params'),
+        rasters=sorted(r['digest']
+                       for r in (manifest or {}).get('rasters', {}).values()))
+    train_cache = EmbeddingCache(
+        os.path.join(cache_dir, 'train'),
+        train_dataset,
+        predict,
+        dict(
+            key,
+            images=_names_digest(train_dataset),
+            files=_files_digest(train_dataset)),
+        variants=FLIP_VARIANTS,
+        batch_size=batch_size)
+    validation_cache = EmbeddingCache(
+        os.path.join(cache_dir, 'test'),
+        validation_dataset,
+        predict,
+        dict(
+            key,
+            images=_names_digest(validation_dataset),
+            files=_files_digest(validation_dataset)),
+        batch_size=batch_size)
+
+    train_model(
+        head_model,
+        train_generator=EmbeddingSequence(
+            train_cache,
+            train_dataset.labels,
+            batch_size,
+            augment=True,
+            shuffle=True),
+        train_samples=len(train_dataset),
+        validation_generator=EmbeddingSequence(
+            validation_cache, validation_dataset.labels, batch_size),
+        validation_samples=len(validation_dataset),
+        class_weight=class_weight,
+        batch_size=batch_size,
+        epochs=epochs)
+    _logger.info('Training completed')
 
+    # Layers are shared, so the full model has the trained weights.  Custom
+    # layers are called on the output of the base model again, so that the
+    # full model has the same (flat) layers as one built by +build_model+.
+    custom_layers = head_model.layers[len(trainable_model.layers):]
+    outputs = replay_layers(custom_layers,
+                            {trainable_model.output.name: base_model.output})
+    model = Model(inputs=base_model.input, outputs=outputs)
+    compile_model(model)
+    return model
+
+
+def split_frozen_layers(model, trainable_layers):
+    """
+    Split +model+ into a model of its frozen layers and a model of the rest
+
+    Layers are frozen as in +freeze_layers+.  Outputs of the frozen model
+    are the activations of frozen layers used by trainable layers (more than
+    one if a residual connection crosses the split), and they are the
+    inputs of the trainable model, whose output is the output of +model+.
+    Both models share layers (and weights) with +model+.
+
+    """
+    split = RESNET_50_LAYERS - trainable_layers
+    frozen_layers, layers = model.layers[:split], model.layers[split:]
+    frozen_names = set(l.get_output_at(0).name for l in frozen_layers)
+
+    boundary = []
+    for layer in layers:
+        for tensor in _as_list(layer.get_input_at(0)):
+            if (tensor.name in frozen_names and
+                    tensor.name not in [t.name for t in boundary]):
+                boundary.append(tensor)
+    if not layers:
+        boundary = [model.output]
+    frozen_model = Model(inputs=model.input, outputs=boundary)
+
+    inputs = [Input(shape=K.int_shape(t)[1:]) for t in boundary]
+    tensors = {t.name: i for t, i in zip(boundary, inputs)}
+    replay_layers(layers, tensors)
+    trainable_model = Model(inputs=inputs, outputs=tensors[model.output.name])
+
+    return frozen_model, trainable_model
+
+
+def replay_layers(layers, tensors):
+    """
+    Call +layers+ of a model again, on new input tensors
+
+    +layers+ must be in topological order (as in +Model.layers+).
+    +tensors+ maps names of the original input tensors of +layers+ to new
+    tensors, and is updated with the new output of each layer.  Layers are
+    shared, so they keep their weights.  Returns the new output of the last
+    layer.
+
+    """
+    output = None
+    for layer in layers:
+        args = [tensors[t.name] for t in _as_list(layer.get_input_at(0))]
+        output = layer(args if len(args) > 1 else args[0])
+        tensors[layer.get_output_at(0).name] = output
+    return output
+
+
+def _names_digest(dataset):
+    return hashlib.sha1('\n'.join(dataset.names()).encode()).hexdigest()
+
+
+def _files_digest(dataset):
+    """
+    Return a hash of paths, sizes and modification times of files of
+    +dataset+, so that it changes when images are written again, even with
+    the same names
+
+    """
+    digest = hashlib.sha1()
+    for path in dataset.files():
+        stat = os.stat(path)
+        digest.update('{}\t{}\t{}\n'.format(path, stat.st_size,
+                                             stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def _as_list(tensors):
+    return tensors if isinstance(tensors, list) else [tensors]
 
-def build_resnet50_model(img_width, img_height):
+
+def build_model(size,
+                trainable_layers,
+                head='flatten',
+                dense_units=None,
+                weights='imagenet'):
+    """
+    Build and compile a model using ResNet-50 as base input
+
+    +weights+ are the initial weights of ResNet-50: 'imagenet' for weights
+    pre-trained on ImageNet, or None for random weights.
+
+    """
+    base_model = build_resnet50_model(size, size, weights=weights)
+    freeze_layers(base_model, trainable_layers)
+    outputs = add_custom_layers(base_model, head=head, dense_units=dense_units)
+    model = Model(inputs=base_model.input, outputs=outputs)
+    compile_model(model)
+    return model
+
+
+def build_resnet50_model(img_width, img_height, weights='imagenet'):
     """Build a ResNet-50 model"""
     return applications.resnet50.ResNet50(
-        weights="imagenet",
+        weights=weights,
         include_top=False,
         input_shape=(img_width, img_height, 3))
 
@@ -121,6 +492,250 @@ def train_data_generator(train_datagen, train_data_dir, img_height, img_width,
     return train_generator
 
 
+class PackedSequence(Sequence):
+    """
+    Batches of images and labels of a packed dataset
+
+    Images are copied from the memory-mapped shards of +dataset+, so there
+    is no per-file overhead and no image decoding.  Sample order is
+    shuffled on each epoch if +shuffle+ is True.
+
+    Arguments:
+        dataset {PackedDataset} -- packed dataset
+        batch_size {int} -- number of images per batch
+        augment {bool} -- randomly flip images horizontally and vertically
+        shuffle {bool} -- shuffle samples on each epoch
+        seed {int} -- seed of the random number generator
+
+    """
+
+    def __init__(self,
+                 dataset,
+                 batch_size,
+                 augment=False,
+                 shuffle=False,
+                 seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.augment = augment
+        self.shuffle = shuffle
+
+        self._random = np.random.RandomState(seed)
+        self._indexes = np.arange(len(dataset))
+        if self.shuffle:
+            self._random.shuffle(self._indexes)
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+
+    def __getitem__(self, idx):
+        indexes = self._indexes[idx * self.batch_size:(idx + 1) *
+                                self.batch_size]
+        # Read in order, so that access to the mapped files is sequential
+        indexes = np.sort(indexes)
+        images = self.dataset.read(indexes).astype(np.float32)
+        if self.augment:
+            hflip = self._random.rand(len(images)) < 0.5
+            images[hflip] = images[hflip, :, ::-1]
+            vflip = self._random.rand(len(images)) < 0.5
+            images[vflip] = images[vflip, ::-1]
+        images = applications.resnet50.preprocess_input(images)
+        return images, self.dataset.labels[indexes].astype(np.float32)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._random.shuffle(self._indexes)
+
+
+class EmbeddingSequence(Sequence):
+    """
+    Batches of cached activations and labels of a dataset
+
+    Arguments:
+        cache {EmbeddingCache} -- cached activations of dataset images
+        labels {np.ndarray} -- labels of dataset images
+        batch_size {int} -- number of images per batch
+        augment {bool} -- use activations of randomly flipped images
+        shuffle {bool} -- shuffle samples on each epoch
+        seed {int} -- seed of the random number generator
+
+    """
+
+    def __init__(self,
+                 cache,
+                 labels,
+                 batch_size,
+                 augment=False,
+                 shuffle=False,
+                 seed=None):
+        self.cache = cache
+        self.labels = labels
+        self.batch_size = batch_size
+        self.augment = augment
+        self.shuffle = shuffle
+
+        self._random = np.random.RandomState(seed)
+        self._indexes = np.arange(len(labels))
+        if self.shuffle:
+            self._random.shuffle(self._indexes)
+
+    def __len__(self):
+        return int(np.ceil(len(self.labels) / self.batch_size))
+
+    def __getitem__(self, idx):
+        indexes = np.sort(self._indexes[idx * self.batch_size:(idx + 1) *
+                                        self.batch_size])
+        variants = None
+        if self.augment:
+            variants = self._random.randint(
+                0, self.cache.variants, size=len(indexes))
+        return (self.cache.read(indexes, variants),
+                self.labels[indexes].astype(np.float32))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._random.shuffle(self._indexes)
+
+
+class ImageFiles:
+    """
+    Images of a directory of JPEG samples, read as a +PackedDataset+
+
+    Arguments:
+        dirname {str} -- directory with 't' and 'f' subdirectories
+
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        true_files = sorted(find_true_samples(dirname))
+        false_files = sorted(find_false_samples(dirname))
+        self.paths = true_files + false_files
+        self.labels = np.array(
+            [1] * len(true_files) + [0] * len(false_files), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def names(self):
+        """Return a list of names of all images"""
+        return [os.path.relpath(f, self.dirname) for f in self.paths]
+
+    def files(self):
+        """Return a list of paths of all images"""
+        return self.paths
+
+    def read(self, indexes):
+        """Return an array with images at +indexes+"""
+        return np.array([imread(self.paths[i]) for i in indexes])
+
+
+class RasterWindowSequence(Sequence):
+    """
+    Batches of images read directly from windows of rasters
+
+    On each epoch, all true samples and a random selection of false samples
+    (+balancing_multiplier+ times the number of true samples) are used, so
+    that over several epochs the model sees every false sample.  Windows of
+    each batch are read in order from a +BlockCacheReader+ of each raster,
+    and their intensity is rescaled and converted to uint8 as when building
+    a trainset.
+
+    Arguments:
+        true_samples {list} -- list of (raster, window) of true samples
+        false_samples {list} -- list of (raster, window) of false samples
+        percentiles {dict} -- percentiles for rescaling intensity of each
+            raster, or None
+        batch_size {int} -- number of images per batch
+        balancing_multiplier {float} -- proportion of false samples w.r.t
+            true samples
+        augment {bool} -- randomly flip images horizontally and vertically
+        rebalance {bool} -- select new false samples on each epoch
+        seed {int} -- seed of the random number generator
+
+    """
+
+    def __init__(self,
+                 true_samples,
+                 false_samples,
+                 percentiles,
+                 batch_size,
+                 balancing_multiplier=1,
+                 augment=False,
+                 rebalance=True,
+                 seed=None):
+        self.true_samples = true_samples
+        self.false_samples = false_samples
+        self.percentiles = percentiles
+        self.batch_size = batch_size
+        self.balancing_multiplier = balancing_multiplier
+        self.augment = augment
+        self.rebalance = rebalance
+
+        self._random = np.random.RandomState(seed)
+        self._readers = {}
+        self._select_samples()
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / self.batch_size))
+
+    def __getitem__(self, idx):
+        batch = self.samples[idx * self.batch_size:(idx + 1) *
+                             self.batch_size]
+        images = [None] * len(batch)
+        # Read windows of each raster in order, for locality of blocks
+        order = sorted(
+            range(len(batch)),
+            key=lambda i: (batch[i][0], batch[i][1].row_off,
+                           batch[i][1].col_off))
+        for i in order:
+            raster, window, _ = batch[i]
+            images[i] = self._read(raster, window)
+        images = np.array(images, dtype=np.float32)
+
+        if self.augment:
+            hflip = self._random.rand(len(images)) < 0.5
+            images[hflip] = images[hflip, :, ::-1]
+            vflip = self._random.rand(len(images)) < 0.5
+            images[vflip] = images[vflip, ::-1]
+        images = applications.resnet50.preprocess_input(images)
+        labels = np.array([label for _, _, label in batch], dtype=np.float32)
+        return images, labels
+
+    def on_epoch_end(self):
+        if self.rebalance:
+            self._select_samples()
+
+    def close(self):
+        """Close all opened rasters"""
+        for reader in self._readers.values():
+            reader.src.close()
+        self._readers.clear()
+
+    def _select_samples(self):
+        n_false = min(
+            len(self.false_samples),
+            round(len(self.true_samples) * self.balancing_multiplier))
+        false_ids = self._random.choice(
+            len(self.false_samples), n_false, replace=False)
+        samples = [(r, w, 1) for r, w in self.true_samples]
+        samples.extend(
+            self.false_samples[i] + (0, ) for i in sorted(false_ids))
+        self._random.shuffle(samples)
+        self.samples = samples
+
+    def _read(self, raster, window):
+        # Rasters are opened lazily on each process
+        key = (os.getpid(), raster)
+        if key not in self._readers:
+            self._readers[key] = BlockCacheReader(rasterio.open(raster))
+        img = self._readers[key].read_window(window)
+        if self.percentiles and self.percentiles.get(raster):
+            img = exposure.rescale_intensity(
+                img, in_range=tuple(self.percentiles[raster]))
+        return img_as_ubyte(img)
+
+
 def compile_model(model):
     """Compile model by setting optimizer and loss function"""
     model.compile(
@@ -129,11 +744,30 @@ def compile_model(model):
         metrics=['accuracy'])
 
 
-def add_custom_layers(model):
-    """Adding custom Layers"""
+def add_custom_layers(model, head='flatten', dense_units=None):
+    """
+    Add custom layers on top of +model+
+
+    With the 'flatten' head, all activations of +model+ are flattened into a
+    dense layer.  With the 'gap' head, activations are averaged over the
+    spatial dimensions first (global average pooling), so that the dense
+    layer has far fewer weights, and the model is much smaller and faster.
+    +dense_units+ is the number of units of the dense layer (by default,
+    +DEFAULT_DENSE_UNITS+ of +head+).
+
+    """
+    if head not in HEADS:
+        raise ValueError('head must be one of {}, but was {}'.format(
+            HEADS, head))
+    if dense_units is None:
+        dense_units = DEFAULT_DENSE_UNITS[head]
+
     out = model.output
-    out = Flatten()(out)
-    out = Dense(1024, activation='relu')(out)
+    if head == 'gap':
+        out = GlobalAveragePooling2D()(out)
+    else:
+        out = Flatten()(out)
+    out = Dense(dense_units, activation='relu')(out)
     out = Dropout(0.5)(out)
     out = Dense(1, activation='sigmoid')(out)
     return out
@@ -176,6 +810,36 @@ def find_all_samples(dirname):
     return glob(os.path.join(dirname, '**', '*.jpg'))
 
 
-def save_model(model, outpath):
+def model_metadata(*, size, trainable_layers, head, dense_units):
+    """Return metadata of a model, as stored by +save_model+"""
+    return dict(
+        version=__version__,
+        size=size,
+        trainable_layers=trainable_layers,
+        head=head,
+        dense_units=dense_units or DEFAULT_DENSE_UNITS[head])
+
+
+def save_model(model, outpath, metadata=None):
+    """Save +model+ to HDF5 file +outpath+, with +metadata+ (a dict)"""
     model.save(outpath)
+    if metadata is not None:
+        with h5py.File(outpath, 'a') as f:
+            f.attrs[MODEL_METADATA_ATTR] = json.dumps(metadata)
     _logger.info('Model saved as %s', outpath)
+
+
+def read_model_metadata(path):
+    """
+    Return metadata of the model at +path+
+
+    Models saved without metadata have the original 'flatten' head.
+
+    """
+    with h5py.File(path, 'r') as f:
+        metadata = f.attrs.get(MODEL_METADATA_ATTR)
+    if metadata is None:
+        return dict(head='flatten', dense_units=DEFAULT_DENSE_UNITS['flatten'])
+    if isinstance(metadata, bytes):
+        metadata = metadata.decode()
+    return json.loads(metadata)
@@ -3,22 +3,41 @@ import json
 import logging
 import os
 from collections import namedtuple
-from functools import partial
+from functools import lru_cache, partial
 from glob import glob
+from itertools import chain, islice
 
+import numpy as np
 import pyproj
-import rasterio
 import rtree
 import fiona
 from rasterio.windows import Window
-from shapely.geometry import mapping
+from shapely.geometry import MultiPolygon, Polygon, mapping
 from shapely.ops import transform
 from fiona.crs import from_epsg
 
+from aplatam.stats import get_raster_info
+
 _logger = logging.getLogger(__name__)
 
 METADATA_FILENAME = 'metadata.json'
 
+WGS84_CRS = {'init': 'epsg:4326'}
+
+# Vector drivers by file extension, for +write_vector+
+VECTOR_DRIVERS = {
+    '.shp': 'ESRI Shapefile',
+    '.gpkg': 'GPKG',
+    '.geojson': 'GeoJSON',
+    '.json': 'GeoJSON',
+    '.geojsonl': 'GeoJSONSeq',
+    '.geojsons': 'GeoJSONSeq',
+    '.ndjson': 'GeoJSONSeq',
+}
+
+# Number of features written at once by +write_vector+
+WRITE_CHUNK_SIZE = 1000
+
 
 ShapeWithProps = namedtuple('ShapeWithProps', ['shape', 'props'])
 
@@ -46,17 +65,103 @@ def sliding_windows(size, step_size, width, height):
 
 def reproject_shape(shape, src_crs, dst_crs):
     """Reprojects a shape from some projection to another"""
-    project = partial(
-        pyproj.transform,
-        pyproj.Proj(init=src_crs['init']),
-        pyproj.Proj(init=dst_crs['init']))
+    project = partial(reproject_coords, src_crs=src_crs, dst_crs=dst_crs)
     return transform(project, shape)
 
 
+def reproject_shapes(shapes, src_crs, dst_crs):
+    """
+    Reproject a list of shapes from some projection to another
+
+    Coordinates of all polygons are gathered and transformed at once, with a
+    single call to +reproject_coords+.  Other types of shapes are
+    reprojected one by one with +reproject_shape+.
+
+    """
+    rings = []
+    for shape in shapes:
+        if shape.geom_type in ('Polygon', 'MultiPolygon'):
+            rings.extend(_polygon_rings(shape))
+    if not rings:
+        return [reproject_shape(s, src_crs, dst_crs) for s in shapes]
+
+    coords = np.concatenate([np.asarray(r.coords)[:, :2] for r in rings])
+    xs, ys = reproject_coords(
+        coords[:, 0], coords[:, 1], src_crs=src_crs, dst_crs=dst_crs)
+    coords = np.column_stack([xs, ys])
+
+    # Rebuild polygons, consuming transformed coordinates in the same order
+    offset = 0
+
+    def project_ring(ring):
+        nonlocal offset
+        count = len(ring.coords)
+        offset += count
+        return coords[offset - count:offset]
+
+    def project_polygon(polygon):
+        exterior = project_ring(polygon.exterior)
+        interiors = [project_ring(r) for r in polygon.interiors]
+        return Polygon(exterior, interiors)
+
+    res = []
+    for shape in shapes:
+        if shape.geom_type == 'Polygon':
+            res.append(project_polygon(shape))
+        elif shape.geom_type == 'MultiPolygon':
+            res.append(MultiPolygon([project_polygon(p) for p in shape.geoms]))
+        else:
+            res.append(reproject_shape(shape, src_crs, dst_crs))
+    return res
+
+
+def _polygon_rings(shape):
+    """Generate rings of a Polygon or MultiPolygon, in order"""
+    polygons = [shape] if shape.geom_type == 'Polygon' else shape.geoms
+    for polygon in polygons:
+        yield polygon.exterior
+        yield from polygon.interiors
+
+
+def reproject_coords(xs, ys, *, src_crs, dst_crs):
+    """
+    Reproject arrays of coordinates +xs+ and +ys+ from +src_crs+ to +dst_crs+
+
+    All coordinates are transformed in a single call, with projections cached
+    by CRS pair (see +get_projections+).
+
+    """
+    src_proj, dst_proj = get_projections(src_crs, dst_crs)
+    return pyproj.transform(src_proj, dst_proj, xs, ys)
+
+
+def get_projections(src_crs, dst_crs):
+    """Return a (cached) pair of projections for +src_crs+ and +dst_crs+"""
+    return _get_projections(crs_key(src_crs), crs_key(dst_crs))
+
+
+@lru_cache(maxsize=32)
+def _get_projections(src_key, dst_key):
+    return (pyproj.Proj(**json.loads(src_key)),
+            pyproj.Proj(**json.loads(dst_key)))
+
+
+def crs_key(crs):
+    """
+    Return a hashable key of a CRS dictionary (or rasterio CRS)
+
+    Keys of the same CRS are equal, regardless of the type of +crs+, so
+    they can be used for comparing CRSs.
+
+    """
+    if hasattr(crs, 'to_dict'):
+        crs = crs.to_dict()
+    return json.dumps(dict(crs), sort_keys=True)
+
+
 def get_raster_crs(raster_path):
     """Return CRS of +raster_path+"""
-    with rasterio.open(raster_path) as dataset:
-        return dataset.crs
+    return get_raster_info(raster_path)['crs']
 
 
 def read_metadata(input_dir):
@@ -78,38 +183,133 @@ def write_geojson(shapes, output_path):
     """
     Write a GeoJSON to +output_path+ with each shape in +shapes+ as a feature
 
-    Shapes must be in WGS84 projection
+    Shapes must be in WGS84 projection.  +shapes+ can be any iterable (e.g.
+    +Predictions.iter_shapes+), and features are written as shapes are
+    generated, so memory usage does not depend on the number of shapes.
+
+    """
+    with open(output_path, 'w') as dst:
+        dst.write('{"type": "FeatureCollection", "features": [')
+        for i, shape in enumerate(shapes):
+            if i > 0:
+                dst.write(',')
+            dst.write('\n')
+            dst.write(json.dumps(_feature(shape)))
+        dst.write('\n]}\n')
+    _logger.info('%s written', output_path)
+
+
+def write_ndjson(shapes, output_path):
+    """
+    Write a newline-delimited GeoJSON to +output_path+, one feature per line
+
+    See +write_geojson+.
 
     """
-    dicc = {'type': 'FeatureCollection', 'features': []}
-    for shape in shapes:
-        feat = {'type': 'Feature',
-                'geometry': mapping(shape.shape),
-                'properties': shape.props}
-        dicc['features'].append(feat)
     with open(output_path, 'w') as dst:
-        dst.write(json.dumps(dicc))
+        for shape in shapes:
+            dst.write(json.dumps(_feature(shape)))
+            dst.write('\n')
     _logger.info('%s written', output_path)
 
 
-def write_shapefile(shapes, output_path):
+def write_shapefile(shapes, output_path, properties=None):
     """
     Write a Shapefile to +output_path+ with each shape in +shapes+ as a feature
 
-    Shapes must be in WGS84 projection
+    See +write_vector+.  +properties+ is a dictionary of property names and
+    types (by default, "prob" and "prob_mean" floats).
+
+    """
+    if properties is None:
+        properties = {'prob': 'float', 'prob_mean': 'float'}
+    write_vector(
+        shapes, output_path, driver='ESRI Shapefile', properties=properties)
+
+
+def write_vector(shapes, output_path, driver=None, properties=None):
+    """
+    Write a vector file to +output_path+ with each shape in +shapes+ as a
+    feature
+
+    If +driver+ is None, format is guessed from the extension of
+    +output_path+ (see +VECTOR_DRIVERS+).  GeoJSON and newline-delimited
+    GeoJSON are written with +write_geojson+ and +write_ndjson+, and other
+    formats with Fiona, in chunks of +WRITE_CHUNK_SIZE+ features.
+
+    Shapes must be in WGS84 projection.  +shapes+ can be any iterable (e.g.
+    +Predictions.iter_shapes+), and features are written as shapes are
+    generated, so memory usage does not depend on the number of shapes.
+    +properties+ is a dictionary of property names and Fiona types.  If
+    None, it is inferred from the properties of the first shape.
 
     """
-    schema = {'geometry': 'MultiPolygon', 'properties': {}}
-    schema['properties']['prob'] = 'float'
-    schema['properties']['prob_mean'] = 'float'
-    kwargs = {'crs': from_epsg(4326), 'driver': 'ESRI Shapefile', 'schema': schema}
+    if driver is None:
+        driver = vector_driver(output_path)
+    if driver == 'GeoJSON':
+        return write_geojson(shapes, output_path)
+    if driver == 'GeoJSONSeq':
+        return write_ndjson(shapes, output_path)
+
+    shapes = iter(shapes)
+    first = next(shapes, None)
+    if properties is None:
+        props = first.props if first else {}
+        properties = {
+            name: 'int' if isinstance(value, int) else
+            'float' if isinstance(value, float) else 'str'
+            for name, value in props.items()
+        }
+    if first:
+        shapes = chain([first], shapes)
 
+    schema = {'geometry': 'MultiPolygon', 'properties': dict(properties)}
+    kwargs = {'crs': from_epsg(4326), 'driver': driver, 'schema': schema}
+
+    count = 0
     with fiona.open(output_path, 'w', **kwargs) as dst:
-        for shape in shapes:
-            feat = {'type': 'Feature',
-                    'geometry': mapping(shape.shape),
-                    'properties': shape.props}
-            dst.write(feat)
+        for chunk in _chunks(shapes, WRITE_CHUNK_SIZE):
+            dst.writerecords(_feature(s, multi=True) for s in chunk)
+            count += len(chunk)
+    _logger.info('%d features written to %s', count, output_path)
+
+
+def vector_driver(output_path):
+    """
+    Return the vector driver for +output_path+, given its extension
+
+    Paths without extension are written as Shapefiles (a directory of them).
+
+    """
+    ext = os.path.splitext(output_path)[1].lower()
+    if not ext:
+        return 'ESRI Shapefile'
+    if ext not in VECTOR_DRIVERS:
+        raise ValueError('Unknown vector format extension: {} (valid: {})'.
+                         format(ext, ', '.join(sorted(VECTOR_DRIVERS))))
+    return VECTOR_DRIVERS[ext]
+
+
+def _feature(shape, multi=False):
+    """Return a GeoJSON-like feature of a +ShapeWithProps+"""
+    geom = shape.shape
+    if multi and geom.geom_type == 'Polygon':
+        geom = MultiPolygon([geom])
+    return {
+        'type': 'Feature',
+        'geometry': mapping(geom),
+        'properties': shape.props
+    }
+
+
+def _chunks(iterable, size):
+    """Generate lists of up to +size+ items of +iterable+"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -0,0 +1,214 @@
+"""This module contains a block-aligned windowed reader for rasters"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.windows import Window
+
+_logger = logging.getLogger(__name__)
+
+# Minimum strip height, as a multiple of the window size
+STRIP_WINDOWS = 4
+
+# Default maximum number of blocks kept by +BlockCacheReader+
+DEFAULT_CACHE_BLOCKS = 512
+
+
+class StripReader:
+    """
+    Windowed reader that decodes a raster in block-aligned row strips
+
+    Instead of reading each band of each window separately, this reader
+    reads a strip of rows aligned to the internal block layout of the raster
+    (all bands at once) and yields windows as views into that strip.  When
+    windows overlap (i.e. step size is smaller than window size), each pixel
+    is decoded only once per strip instead of once per window.
+
+    Windows should be given in row-major order (as generated by
+    +sliding_windows+) to take advantage of strips; any other order works but
+    may read the same strip more than once.
+
+    Arguments:
+        src {rasterio.DatasetReader} -- opened raster dataset
+
+    Keyword Arguments:
+        bands {tuple(int)} -- band indexes to read (default: {(1, 2, 3)})
+        strip_height {int} -- minimum height in pixels of each strip.  If
+            None, use STRIP_WINDOWS times the height of the first window.
+            It is always rounded up to a multiple of the block height.
+            (default: {None})
+
+    """
+
+    def __init__(self, src, bands=(1, 2, 3), strip_height=None):
+        self.src = src
+        self.bands = list(bands)
+        self.strip_height = strip_height
+        self.block_height = src.block_shapes[0][0]
+
+        self._strip = None
+        self._strip_row_off = 0
+        self._strip_row_end = 0
+
+    def read_windows(self, windows):
+        """
+        Generate an image for each window in +windows+
+
+        Images are arrays of shape (height, width, bands), and are views into
+        the current strip, so they should be copied if they need to outlive
+        the next iteration.
+
+        """
+        for window in windows:
+            row_off, col_off = int(window.row_off), int(window.col_off)
+            height, width = int(window.height), int(window.width)
+            if not self._contains(row_off, height):
+                self._read_strip(row_off, height)
+            i = row_off - self._strip_row_off
+            yield self._strip[i:i + height, col_off:col_off + width]
+
+    def _contains(self, row_off, height):
+        return (self._strip is not None and row_off >= self._strip_row_off
+                and row_off + height <= self._strip_row_end)
+
+    def _read_strip(self, row_off, height):
+        """Read a block-aligned strip of rows that contains +row_off+"""
+        strip_height = self.strip_height or STRIP_WINDOWS * height
+        strip_height = max(strip_height, height)
+
+        start = (row_off // self.block_height) * self.block_height
+        end = row_off + strip_height
+        end = -(-end // self.block_height) * self.block_height
+        end = min(end, self.src.height)
+
+        _logger.debug('Read strip of rows %d-%d', start, end)
+        data = self.src.read(
+            self.bands, window=Window(0, start, self.src.width, end - start))
+
+        self._strip = np.moveaxis(data, 0, -1)
+        self._strip_row_off = start
+        self._strip_row_end = end
+
+
+def scan_raster(src, windows, bands=(1, 2, 3), strip_height=None):
+    """
+    Read all rows of +src+ once, in strips, and extract +windows+ on the way
+
+    Generates a tuple for each block-aligned strip of rows of the raster:
+    the strip data, an array of shape (bands, rows, cols), and a list of
+    images of +windows+ that end on that strip.  Each pixel is read exactly
+    once, so strips can be used for computing statistics of the raster
+    while extracting windows.  Rows of windows that span more than one strip
+    are kept until the window is complete.
+
+    Windows must be sorted by row.  Images are views into a buffer that is
+    reused, so they should be copied if they need to outlive the next
+    iteration.
+
+    """
+    bands = list(bands)
+    block_height = src.block_shapes[0][0]
+    strip_height = strip_height or block_height
+    strip_height = -(-strip_height // block_height) * block_height
+
+    windows = list(windows)
+    i = 0
+    buf, buf_row_off = None, 0
+    for start in range(0, src.height, strip_height):
+        end = min(start + strip_height, src.height)
+        data = src.read(bands, window=Window(0, start, src.width, end - start))
+        strip = np.moveaxis(data, 0, -1)
+
+        # Keep rows of previous strips that pending windows still need
+        keep_from = int(windows[i].row_off) if i < len(windows) else end
+        if buf is not None and keep_from < start:
+            buf = np.concatenate([buf[keep_from - buf_row_off:], strip])
+            buf_row_off = keep_from
+        else:
+            buf, buf_row_off = strip, start
+
+        images = []
+        while (i < len(windows)
+               and windows[i].row_off + windows[i].height <= end):
+            row_off = int(windows[i].row_off) - buf_row_off
+            col_off = int(windows[i].col_off)
+            images.append(buf[row_off:row_off + int(windows[i].height),
+                              col_off:col_off + int(windows[i].width)])
+            i += 1
+        yield data, images
+
+
+class BlockCacheReader:
+    """
+    Windowed reader with a cache of decoded blocks of a raster
+
+    Windows are assembled from the internal blocks of the raster, which are
+    read (all bands at once) and kept on a least-recently-used cache.  This
+    is useful for reading windows in random order, e.g. for training, as
+    overlapping and nearby windows are decoded only once while they stay in
+    the cache.
+
+    Arguments:
+        src {rasterio.DatasetReader} -- opened raster dataset
+
+    Keyword Arguments:
+        bands {tuple(int)} -- band indexes to read (default: {(1, 2, 3)})
+        max_blocks {int} -- maximum number of cached blocks
+            (default: {DEFAULT_CACHE_BLOCKS})
+
+    """
+
+    def __init__(self, src, bands=(1, 2, 3), max_blocks=DEFAULT_CACHE_BLOCKS):
+        self.src = src
+        self.bands = list(bands)
+        self.max_blocks = max_blocks
+        self.block_height, self.block_width = src.block_shapes[0]
+
+        self._blocks = OrderedDict()
+
+    def read_window(self, window):
+        """Return an image of +window+, of shape (height, width, bands)"""
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        img = np.empty((height, width, len(self.bands)),
+                       dtype=self.src.dtypes[self.bands[0] - 1])
+
+        rows = _block_range(row_off, height, self.block_height)
+        cols = _block_range(col_off, width, self.block_width)
+        for block_row in rows:
+            for block_col in cols:
+                block = self._block(block_row, block_col)
+                top = block_row * self.block_height
+                left = block_col * self.block_width
+                # Intersection of window and block, on raster coordinates
+                r0 = max(row_off, top)
+                r1 = min(row_off + height, top + block.shape[0])
+                c0 = max(col_off, left)
+                c1 = min(col_off + width, left + block.shape[1])
+                img[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = \
+                    block[r0 - top:r1 - top, c0 - left:c1 - left]
+        return img
+
+    def _block(self, block_row, block_col):
+        key = (block_row, block_col)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+
+        row_off = block_row * self.block_height
+        col_off = block_col * self.block_width
+        window = Window(col_off, row_off,
+                        min(self.block_width, self.src.width - col_off),
+                        min(self.block_height, self.src.height - row_off))
+        block = np.moveaxis(self.src.read(self.bands, window=window), 0, -1)
+
+        self._blocks[key] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+
+def _block_range(offset, length, block_size):
+    """Return range of blocks of +block_size+ that cover a range of pixels"""
+    return range(offset // block_size,
+                 (offset + length - 1) // block_size + 1)
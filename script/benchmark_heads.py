@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark heads of the classifier
+
+For each head, a model is built, saved and loaded again, and predictions
+are made on random images.  Reports number of parameters, size of the model
+file, save and load time, and prediction throughput (images per second).
+
+"""
+import logging
+import os
+import tempfile
+import time
+
+import keras
+import numpy as np
+
+from aplatam.train_classifier import (HEADS, build_model, model_metadata,
+                                      save_model)
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark_head(head, *, size, dense_units, batch_size, batches,
+                   trainable_layers):
+    model = build_model(
+        size, trainable_layers, head=head, dense_units=dense_units)
+    params = model.count_params()
+
+    with tempfile.TemporaryDirectory(prefix='aplatam_bench') as tmpdir:
+        path = os.path.join(tmpdir, 'model.h5')
+        start = time.time()
+        save_model(
+            model,
+            path,
+            metadata=model_metadata(
+                size=size,
+                trainable_layers=trainable_layers,
+                head=head,
+                dense_units=dense_units))
+        save_time = time.time() - start
+        file_size = os.path.getsize(path)
+
+        keras.backend.clear_session()
+        start = time.time()
+        model = keras.models.load_model(path)
+        load_time = time.time() - start
+
+    images = np.random.uniform(
+        0, 255, (batch_size, size, size, 3)).astype(np.float32)
+    # Warm up, so that graph setup is not measured
+    model.predict(images, batch_size=batch_size)
+    start = time.time()
+    for _ in range(batches):
+        model.predict(images, batch_size=batch_size)
+    throughput = batch_size * batches / (time.time() - start)
+    keras.backend.clear_session()
+
+    return dict(
+        head=head,
+        params=params,
+        size_mb=file_size / 2**20,
+        save_s=save_time,
+        load_s=load_time,
+        images_per_s=throughput)
+
+
+def benchmark(heads, **kwargs):
+    results = [benchmark_head(head, **kwargs) for head in heads]
+    print('{:<8} {:>12} {:>10} {:>8} {:>8} {:>10}'.format(
+        'head', 'params', 'size (MB)', 'save (s)', 'load (s)', 'images/s'))
+    for r in results:
+        print('{head:<8} {params:>12d} {size_mb:>10.1f} {save_s:>8.2f} '
+              '{load_s:>8.2f} {images_per_s:>10.1f}'.format(**r))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark heads of the classifier',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '--heads',
+        nargs='+',
+        choices=HEADS,
+        default=list(HEADS),
+        help='heads to benchmark')
+    parser.add_argument('--size', type=int, default=256, help='window size')
+    parser.add_argument(
+        '--dense-units',
+        type=int,
+        help='number of units of the dense layer (default depends on head)')
+    parser.add_argument(
+        '--batch-size', type=int, default=32, help='images per batch')
+    parser.add_argument(
+        '--batches', type=int, default=10, help='number of batches')
+    parser.add_argument(
+        '--trainable-layers',
+        type=int,
+        default=5,
+        help='number of trainable layers of ResNet-50')
+
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest='loglevel',
+        help='set loglevel to INFO',
+        action='store_const',
+        const=logging.INFO)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    benchmark(
+        args.heads,
+        size=args.size,
+        dense_units=args.dense_units,
+        batch_size=args.batch_size,
+        batches=args.batches,
+        trainable_layers=args.trainable_layers)
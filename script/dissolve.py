@@ -2,24 +2,35 @@
 """
 Dissolve overlapping tile polygons
 
+Input can be a vector file of windows, or a directory of predictions saved
+by detect (e.g. "output.pred/merged"), which is dissolved much faster as
+windows are known to be on a regular grid.
+
 """
-from tqdm import tqdm
 from shapely.geometry import shape
 import fiona
 import logging
 import os
 
-from aplatam.util import ShapeWithProps, write_geojson
-from aplatam.post_process import dissolve_overlapping_shapes
+from aplatam.predictions import Predictions
+from aplatam.util import ShapeWithProps, write_vector
+from aplatam.post_process import (apply_buffer, dissolve_overlapping_shapes,
+                                  dissolve_predictions)
 
 logger = logging.getLogger(__name__)
 
 
 def dissolve(in_path, out_path, buffer_size=None):
-    with fiona.open(in_path) as src:
-        shapes = [ShapeWithProps(shape(f['geometry']), props=f['properties']) for f in src]
-    shapes = dissolve_overlapping_shapes(shapes, buffer_size=None)
-    write_geojson(shapes, out_path)
+    if os.path.isdir(in_path):
+        predictions = Predictions.load(in_path)
+        shapes = dissolve_predictions(predictions)
+        if buffer_size:
+            shapes = apply_buffer(shapes, buffer_size)
+    else:
+        with fiona.open(in_path) as src:
+            shapes = [ShapeWithProps(shape(f['geometry']), props=f['properties']) for f in src]
+        shapes = dissolve_overlapping_shapes(shapes, buffer_size=buffer_size)
+    write_vector(shapes, out_path)
 
 
 if __name__ == '__main__':
@@ -31,7 +42,7 @@ if __name__ == '__main__':
 
     parser.add_argument(
         'input_vector',
-        help='input vector file')
+        help='input vector file, or directory of predictions')
     parser.add_argument(
         'output_vector',
         help='output vector file')
@@ -127,6 +127,7 @@ setup(
     # For an analysis of "install_requires" vs pip's requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[
+        'h5py',
         'rtree',
         'shapely',
         'scikit-image',
@@ -137,7 +138,6 @@ setup(
         'fiona',
         'rasterio',
         'tensorflow',
-        'dask-rasterio',
     ],  # Optional
 
     # List additional groups of dependencies here (e.g. development
@@ -190,7 +190,9 @@ setup(
     entry_points={  # Optional
         'console_scripts': [
             'ap_train=aplatam.console.train:run',
-            'ap_detect=aplatam.console.detect:run'
+            'ap_detect=aplatam.console.detect:run',
+            'ap_aggregate=aplatam.console.aggregate:run',
+            'ap_export=aplatam.console.export:run'
         ],
     },
 
@@ -0,0 +1,181 @@
+import json
+import os
+import tempfile
+
+import fiona
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box, mapping, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from aplatam.aggregate import (_covered_area_of_boxes, aggregate_blocks,
+                               partition_tiles, windows_index)
+from aplatam.stats import get_cache_dir
+
+CRS = {'init': 'epsg:32721'}
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch):
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_cache') as tmpdir:
+        monkeypatch.setenv('APLATAM_CACHE_DIR', tmpdir)
+        yield tmpdir
+
+
+def write_vector(path, shapes, properties):
+    schema = dict(
+        geometry='Polygon',
+        properties={name: 'float'
+                    for name in properties[0]})
+    with fiona.open(
+            path, 'w', driver='ESRI Shapefile', crs=CRS,
+            schema=schema) as dst:
+        for shape_, props in zip(shapes, properties):
+            dst.write(dict(geometry=mapping(shape_), properties=props))
+
+
+def brute_force(blocks, windows, probs, min_coverage, coverage='union'):
+    res = []
+    for i, block in enumerate(blocks):
+        ids = [
+            j for j, w in enumerate(windows)
+            if block.intersection(w).area > 0
+        ]
+        if not ids:
+            continue
+        union = unary_union([windows[j] for j in ids])
+        if coverage == 'block':
+            union = block.intersection(union)
+        value = union.area / block.area
+        if value > min_coverage:
+            res.append((i, value, np.mean([probs[j] for j in ids])))
+    return res
+
+
+@pytest.fixture
+def blocks_and_windows():
+    blocks = [
+        box(x, y, x + 10, y + 10) for x in range(0, 100, 12)
+        for y in range(0, 60, 12)
+    ]
+    blocks.append(Polygon([(0, 70), (30, 70), (15, 90)]))
+    windows, probs = [], []
+    rng = np.random.RandomState(42)
+    for r in range(0, 90, 4):
+        for c in range(0, 100, 4):
+            if rng.rand() < 0.7:
+                windows.append(box(c, r, c + 8, r + 8))
+                probs.append(float(rng.rand()))
+    return blocks, windows, probs
+
+
+@pytest.mark.parametrize('coverage', ['union', 'block'])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_aggregate_blocks(blocks_and_windows, workers, coverage):
+    blocks, windows, probs = blocks_and_windows
+    min_coverage = 3.0 if coverage == 'union' else 0.8
+    expected = brute_force(blocks, windows, probs, min_coverage, coverage)
+    assert expected and len(expected) < len(blocks)
+
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        blocks_file = os.path.join(tmpdir, 'blocks.shp')
+        windows_file = os.path.join(tmpdir, 'windows.shp')
+        output_file = os.path.join(tmpdir, 'output.shp')
+        write_vector(blocks_file, blocks,
+                     [dict(block_id=float(i)) for i in range(len(blocks))])
+        write_vector(windows_file, windows, [dict(prob=p) for p in probs])
+
+        aggregate_blocks(
+            blocks_file,
+            windows_file,
+            output_file,
+            min_coverage=min_coverage,
+            workers=workers,
+            blocks_per_tile=5,
+            coverage=coverage)
+
+        with fiona.open(output_file) as src:
+            features = list(src)
+
+    res = sorted(
+        (int(f['properties']['block_id']), f['properties']['coverage'],
+         f['properties']['prob']) for f in features)
+    assert [r[0] for r in res] == [e[0] for e in expected]
+    assert np.allclose([r[1:] for r in res], [e[1:] for e in expected])
+    for (i, _, _), feature in zip(res, sorted(
+            features, key=lambda f: f['properties']['block_id'])):
+        assert shape(feature['geometry']).equals(blocks[i])
+
+
+def test_covered_area_of_boxes():
+    block = Polygon([(0, 0), (10, 0), (5, 8)])
+    boxes = [box(1, 1, 4, 4), box(3, 2, 7, 6), box(-2, -2, 0.5, 0.5)]
+    bounds = np.array([b.bounds for b in boxes])
+    area = _covered_area_of_boxes(bounds, block=block, prepared_block=prep(block))
+    assert np.isclose(area, block.intersection(unary_union(boxes)).area)
+    area = _covered_area_of_boxes(bounds)
+    assert np.isclose(area, unary_union(boxes).area)
+
+
+def test_aggregate_blocks_with_string_ids():
+    blocks = [box(0, 0, 10, 10), box(20, 0, 30, 10), box(40, 0, 50, 10)]
+    collection = dict(
+        type='FeatureCollection',
+        features=[
+            dict(
+                type='Feature',
+                id='block-{}'.format(name),
+                properties=dict(name=name),
+                geometry=mapping(block))
+            for name, block in zip('abc', blocks)
+        ])
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        blocks_file = os.path.join(tmpdir, 'blocks.geojson')
+        windows_file = os.path.join(tmpdir, 'windows.geojson')
+        output_file = os.path.join(tmpdir, 'output.geojson')
+        with open(blocks_file, 'w') as dst:
+            json.dump(collection, dst)
+        with fiona.open(blocks_file) as src:
+            crs = src.crs
+        with fiona.open(
+                windows_file, 'w', driver='GeoJSON', crs=crs,
+                schema=dict(geometry='Polygon',
+                            properties=dict(prob='float'))) as dst:
+            for window in [box(0, 0, 10, 10), box(40, 0, 50, 10)]:
+                dst.write(dict(geometry=mapping(window),
+                               properties=dict(prob=0.9)))
+
+        aggregate_blocks(blocks_file, windows_file, output_file)
+
+        with fiona.open(output_file) as src:
+            names = sorted(f['properties']['name'] for f in src)
+    assert names == ['a', 'c']
+
+
+def test_partition_tiles():
+    bounds = np.array([(x, y, x + 1, y + 1) for x in range(10)
+                       for y in range(10)])
+    fids = np.arange(len(bounds))
+    tiles = partition_tiles(fids, bounds, 25)
+    assert len(tiles) == 4
+    assert sorted(np.concatenate(tiles)) == list(fids)
+    assert all(len(tile) == 25 for tile in tiles)
+    assert partition_tiles([], np.empty((0, 4)), 25) == []
+
+
+def test_windows_index_is_keyed_by_contents():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        windows_file = os.path.join(tmpdir, 'windows.shp')
+        write_vector(windows_file, [box(0, 0, 1, 1)], [dict(prob=0.5)])
+        with windows_index(windows_file) as index_path:
+            first_path = index_path
+        with windows_index(windows_file) as index_path:
+            assert index_path == first_path
+
+        write_vector(windows_file, [box(0, 0, 2, 2)], [dict(prob=0.5)])
+        with windows_index(windows_file) as index_path:
+            assert index_path != first_path
+
+    index_dir = os.path.join(get_cache_dir(), 'index')
+    assert len(os.listdir(index_dir)) == 4
@@ -1,10 +1,22 @@
 import glob
 import json
 import os
+import random
+import shutil
 import tempfile
 
+import fiona
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping
+from skimage.io import imread
+
 from aplatam import __version__
-from aplatam.build_trainset import CnnTrainsetBuilder
+from aplatam.build_trainset import CnnTrainsetBuilder, trainset_manifest
+from aplatam.packed_dataset import PackedDataset
+from aplatam.util import create_index, reproject_shapes
 
 
 def test_cnn_trainset_builder():
@@ -47,6 +59,373 @@ def test_cnn_trainset_builder_with_no_rescale_intensity():
         assert_trainset(tmpdir, builder, empty_dirs=True)
 
 
+@pytest.fixture
+def synthetic_dataset(request):
+    dtype = getattr(request, 'param', 'uint8')
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        raster = os.path.join(tmpdir, 'raster.tif')
+        rng = np.random.RandomState(0)
+        profile = dict(
+            driver='GTiff',
+            width=256,
+            height=256,
+            count=3,
+            dtype=dtype,
+            tiled=True,
+            blockxsize=64,
+            blockysize=64,
+            crs='epsg:32721',
+            transform=from_origin(0, 256, 1, 1))
+        with rasterio.open(raster, 'w', **profile) as dst:
+            if dtype == 'uint8':
+                dst.write(rng.randint(0, 255, (3, 256, 256)).astype(np.uint8))
+            else:
+                # Smooth image over the whole 16-bit range, so that JPEG
+                # compression is not lossy enough to hide wrong values
+                rows, cols = np.mgrid[0:256, 0:256]
+                data = np.array([rows * 256, cols * 256, (rows + cols) * 128])
+                dst.write(data.astype(dtype))
+
+        vector = os.path.join(tmpdir, 'shapes.geojson')
+        schema = dict(geometry='Polygon', properties={})
+        with fiona.open(
+                vector, 'w', driver='GeoJSON', crs={'init': 'epsg:32721'},
+                schema=schema) as dst:
+            for x, y in [(10, 10), (100, 150), (200, 60)]:
+                dst.write(
+                    dict(
+                        geometry=mapping(box(x, y, x + 20, y + 20)),
+                        properties={}))
+        yield tmpdir, raster, vector
+
+
+def test_cnn_trainset_builder_is_deterministic_with_workers(
+        synthetic_dataset, monkeypatch):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', '')
+
+    def build(workers):
+        random.seed(42)
+        builder = CnnTrainsetBuilder([raster],
+                                     vector,
+                                     size=32,
+                                     step_size=16,
+                                     workers=workers)
+        output_dir = os.path.join(tmpdir, 'trainset_{}'.format(workers))
+        builder.build(output_dir)
+        assert_trainset(output_dir, builder)
+        return sorted(
+            os.path.relpath(p, output_dir)
+            for p in glob.glob(os.path.join(output_dir, '*', '*', '*.jpg')))
+
+    files = build(workers=1)
+    assert files
+    assert build(workers=2) == files
+
+
+def test_cnn_trainset_builder_with_cached_histogram(synthetic_dataset,
+                                                    monkeypatch):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', os.path.join(tmpdir, 'cache'))
+
+    def build(name):
+        random.seed(42)
+        builder = CnnTrainsetBuilder([raster], vector, size=32, step_size=16)
+        output_dir = os.path.join(tmpdir, name)
+        builder.build(output_dir)
+        paths = sorted(
+            glob.glob(os.path.join(output_dir, '*', '*', '*.jpg')))
+        return [(os.path.relpath(p, output_dir), open(p, 'rb').read())
+                for p in paths]
+
+    # First build calculates histogram while reading samples, and second
+    # build reads samples from the raster, with the cached histogram.
+    scanned = build('scanned')
+    assert scanned
+    assert build('cached') == scanned
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_cnn_trainset_builder_with_packed_format(synthetic_dataset,
+                                                  monkeypatch, workers):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', '')
+
+    def build(output_format):
+        random.seed(42)
+        builder = CnnTrainsetBuilder([raster],
+                                     vector,
+                                     size=32,
+                                     step_size=16,
+                                     workers=workers,
+                                     output_format=output_format)
+        output_dir = os.path.join(tmpdir, output_format)
+        builder.build(output_dir)
+        return output_dir
+
+    jpeg_dir = build('jpeg')
+    packed_dir = build('packed')
+    for dirname in ('train', 'test'):
+        dataset = PackedDataset(os.path.join(packed_dir, dirname))
+        labels = dict(t=1, f=0)
+        expected = sorted(
+            (os.path.basename(p), labels[os.path.basename(os.path.dirname(p))])
+            for p in glob.glob(os.path.join(jpeg_dir, dirname, '*', '*.jpg')))
+        assert sorted(zip(dataset.names(), dataset.labels)) == expected
+        assert dataset.shape == (32, 32, 3)
+
+
+@pytest.mark.parametrize('synthetic_dataset', ['uint16'], indirect=True)
+@pytest.mark.parametrize('rescale_intensity', [True, False])
+def test_cnn_trainset_builder_packed_format_matches_jpeg(
+        synthetic_dataset, monkeypatch, rescale_intensity):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', '')
+
+    def build(output_format):
+        random.seed(42)
+        builder = CnnTrainsetBuilder([raster],
+                                     vector,
+                                     size=32,
+                                     step_size=16,
+                                     rescale_intensity=rescale_intensity,
+                                     output_format=output_format)
+        output_dir = os.path.join(tmpdir, output_format)
+        builder.build(output_dir)
+        return output_dir
+
+    jpeg_dir = build('jpeg')
+    packed_dir = build('packed')
+    count = 0
+    for dirname in ('train', 'test'):
+        dataset = PackedDataset(os.path.join(packed_dir, dirname))
+        images = dataset.read(np.arange(len(dataset)))
+        for name, img in zip(dataset.names(), images):
+            path, = glob.glob(os.path.join(jpeg_dir, dirname, '*', name))
+            expected = imread(path).astype(np.float64)
+            assert np.abs(img - expected).mean() < 2
+            count += 1
+    assert count
+
+
+@pytest.mark.parametrize('use_tmp_dir', [False, True])
+def test_cnn_trainset_builder_spill_file_location(synthetic_dataset,
+                                                  monkeypatch, use_tmp_dir):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', '')
+    output_dir = os.path.join(tmpdir, 'trainset')
+    tmp_dir = os.path.join(tmpdir, 'tmp') if use_tmp_dir else None
+    if tmp_dir:
+        os.makedirs(tmp_dir)
+
+    builder = CnnTrainsetBuilder([raster],
+                                 vector,
+                                 size=32,
+                                 step_size=16,
+                                 tmp_dir=tmp_dir)
+    spill_paths = []
+    scan_raster = builder._scan_raster
+
+    def _scan_raster(src, samples, spill_path):
+        spill_paths.append(spill_path)
+        return scan_raster(src, samples, spill_path)
+
+    monkeypatch.setattr(builder, '_scan_raster', _scan_raster)
+    builder.build(output_dir)
+
+    assert len(spill_paths) == 1
+    spill_dir = os.path.dirname(spill_paths[0])
+    assert os.path.dirname(spill_dir) == (tmp_dir or output_dir)
+    assert not os.path.exists(spill_dir)
+
+
+@pytest.mark.parametrize('min_overlap', [0, 0.25])
+def test_cnn_trainset_builder_partition_windows(synthetic_dataset,
+                                                min_overlap):
+    _, raster, vector = synthetic_dataset
+    builder = CnnTrainsetBuilder([raster],
+                                 vector,
+                                 size=32,
+                                 step_size=16,
+                                 min_overlap=min_overlap)
+    shapes, _ = builder._read_shapes()
+    with rasterio.open(raster) as src:
+        grid, mask = builder._sliding_windows(src)
+    mask[0, :] = False
+    matching, non_matching = builder._partition_windows(grid, mask, shapes)
+
+    expected_matching, expected_non_matching = [], []
+    for win in grid.windows(mask):
+        wbox = grid.window_box(win.row_off // 16, win.col_off // 16)
+        if not any(s.intersects(wbox) for s in shapes):
+            expected_non_matching.append(win)
+        elif sum(s.intersection(wbox).area
+                 for s in shapes) / wbox.area >= min_overlap:
+            expected_matching.append(win)
+    assert matching == expected_matching
+    assert non_matching == expected_non_matching
+    assert matching and non_matching
+
+
+def test_cnn_trainset_builder_shapes_in_raster(synthetic_dataset,
+                                               monkeypatch):
+    _, raster, vector = synthetic_dataset
+    builder = CnnTrainsetBuilder([raster],
+                                 vector,
+                                 size=32,
+                                 step_size=16,
+                                 buffer_size=2)
+    shapes, _ = builder._read_shapes()
+    # Shapes on WGS84, some of them outside of raster
+    src_crs, dst_crs = {'init': 'epsg:32721'}, {'init': 'epsg:4326'}
+    shapes = reproject_shapes(
+        shapes + [box(1000, 1000, 1010, 1010),
+                  box(250, 250, 270, 270)], src_crs, dst_crs)
+
+    builder._shapes_index = create_index(shapes)
+    builder._projected_shapes = {}
+    calls = []
+
+    def reproject(shapes, src_crs, dst_crs):
+        calls.append(len(shapes))
+        return reproject_shapes(shapes, src_crs, dst_crs)
+
+    monkeypatch.setattr('aplatam.build_trainset.reproject_shapes', reproject)
+
+    with rasterio.open(raster) as src:
+        for _ in range(2):
+            res = builder._shapes_in_raster(shapes, dst_crs, src.crs,
+                                            src.bounds)
+            raster_bbox = box(*src.bounds)
+            expected = [
+                s.buffer(2) for s in reproject_shapes(shapes, dst_crs, src_crs)
+            ]
+            expected = [s for s in expected if raster_bbox.contains(s)]
+            assert len(res) == len(expected) == 3
+            for shape_, expected_shape in zip(res, expected):
+                assert shape_.equals_exact(expected_shape, 1e-6)
+
+    # Shapes far from raster are not reprojected, and shapes are reprojected
+    # only once
+    assert calls == [4]
+
+
+def test_cnn_trainset_builder_is_incremental(synthetic_dataset, monkeypatch):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', os.path.join(tmpdir, 'cache'))
+    other_raster = os.path.join(tmpdir, 'other.tif')
+    shutil.copy(raster, other_raster)
+    output_dir = os.path.join(tmpdir, 'trainset')
+
+    def build(rasters, **kwargs):
+        builder = CnnTrainsetBuilder(
+            rasters, vector, size=32, step_size=16, **kwargs)
+        calls = []
+        build_raster = builder._build_raster
+
+        def _build_raster(raster, *args):
+            calls.append(raster)
+            return build_raster(raster, *args)
+
+        builder._build_raster = _build_raster
+        builder.build(output_dir)
+        files = sorted(
+            os.path.relpath(p, output_dir)
+            for p in glob.glob(os.path.join(output_dir, '*', '*', '*.jpg')))
+        return calls, files
+
+    calls, files = build([raster])
+    assert calls == [raster]
+    assert all(os.path.basename(f).startswith('raster__') for f in files)
+
+    # Only the new raster is processed
+    calls, new_files = build([raster, other_raster])
+    assert calls == [other_raster]
+    assert set(files) < set(new_files)
+    assert any(os.path.basename(f).startswith('other__') for f in new_files)
+
+    manifest = trainset_manifest(output_dir)
+    assert sorted(manifest['rasters']) == [
+        os.path.abspath(other_raster),
+        os.path.abspath(raster)
+    ]
+    assert sorted(t for entry in manifest['rasters'].values()
+                  for t in entry['tiles']) == new_files
+
+    # Tiles of removed rasters are deleted
+    calls, files = build([other_raster])
+    assert calls == []
+    assert files == [f for f in new_files if 'other__' in f]
+
+    # Changing parameters rebuilds all rasters
+    calls, files = build([other_raster], test_size=0.5)
+    assert calls == [other_raster]
+    assert files
+
+
+def test_cnn_trainset_builder_packed_is_not_rebuilt(synthetic_dataset,
+                                                    monkeypatch):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', os.path.join(tmpdir, 'cache'))
+    other_raster = os.path.join(tmpdir, 'other.tif')
+    shutil.copy(raster, other_raster)
+    output_dir = os.path.join(tmpdir, 'trainset')
+
+    def build(rasters, **kwargs):
+        builder = CnnTrainsetBuilder(
+            rasters,
+            vector,
+            size=32,
+            step_size=16,
+            output_format='packed',
+            **kwargs)
+        calls = []
+        build_raster = builder._build_raster
+
+        def _build_raster(raster, *args):
+            calls.append(raster)
+            return build_raster(raster, *args)
+
+        builder._build_raster = _build_raster
+        builder.build(output_dir)
+        return calls, sorted(
+            PackedDataset(os.path.join(output_dir, 'train')).names())
+
+    calls, names = build([raster], seed=1)
+    assert calls == [raster]
+    assert names
+
+    # Nothing changed, so packed datasets are kept as they are
+    calls, same_names = build([raster], seed=1)
+    assert calls == []
+    assert same_names == names
+
+    # A new raster rebuilds all rasters, as shards cannot be updated
+    calls, _ = build([raster, other_raster], seed=1)
+    assert calls == [raster, other_raster]
+
+    # Seed is one of the parameters of the build
+    calls, _ = build([raster, other_raster], seed=2)
+    assert calls == [raster, other_raster]
+    assert trainset_manifest(output_dir)['params']['seed'] == 2
+
+
+def test_cnn_trainset_builder_partition(synthetic_dataset, monkeypatch):
+    tmpdir, raster, vector = synthetic_dataset
+    monkeypatch.setenv('APLATAM_CACHE_DIR', '')
+    builder = CnnTrainsetBuilder([raster], vector, size=32, step_size=16)
+    true_samples, false_samples, percentiles = builder.partition()
+
+    shapes, _ = builder._read_shapes()
+    with rasterio.open(raster) as src:
+        grid, mask = builder._sliding_windows(src)
+        matching, non_matching = builder._partition_windows(grid, mask, shapes)
+    assert true_samples == [(raster, w) for w in matching]
+    assert false_samples == [(raster, w) for w in non_matching]
+    assert list(percentiles) == [raster]
+    assert len(percentiles[raster]) == 2
+
+
 def assert_trainset(tmpdir, builder, empty_dirs=False):
     metadata_path = os.path.join(tmpdir, 'metadata.json')
     assert os.path.exists(metadata_path)
@@ -0,0 +1,103 @@
+import os
+import tempfile
+
+from aplatam.checkpoint import CheckpointStore
+
+
+def test_checkpoint_store_records():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        assert not store.exists()
+        store.create(step_size=128)
+        assert store.exists()
+        assert store.read_params() == {'step_size': 128}
+
+        with store.writer() as writer:
+            writer.write_batch('b.tif', 0, 10, ['b0'])
+            writer.write_batch('a.tif', 10, 20, ['a1'])
+        with store.writer() as writer:
+            writer.write_batch('a.tif', 0, 10, ['a0'])
+            writer.write_raster('a.tif')
+
+        checkpoint = store.load()
+        assert checkpoint.done == {'a.tif'}
+        assert checkpoint.completed_ranges('a.tif') == [(0, 10), (10, 20)]
+        assert checkpoint.completed_ranges('c.tif') == []
+        assert checkpoint.results(['a.tif', 'b.tif']) == [['a0'], ['a1'],
+                                                           ['b0']]
+
+
+def test_checkpoint_store_ignores_truncated_record():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        with store.writer() as writer:
+            writer.write_batch('a.tif', 0, 10, ['a0'])
+            writer.write_batch('a.tif', 10, 20, ['a1'])
+            path = writer.path
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(size - 5)
+
+        checkpoint = store.load()
+        assert checkpoint.completed_ranges('a.tif') == [(0, 10)]
+
+
+def test_checkpoint_store_create_clears_records():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        with store.writer() as writer:
+            writer.write_raster('a.tif')
+        store.create()
+        assert store.load().done == set()
+
+
+def test_checkpoint_store_new_writer_removes_merged_results():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        os.makedirs(store.merged_path)
+        with store.writer():
+            pass
+        assert not os.path.exists(store.merged_path)
+
+
+def test_checkpoint_writer_flush_and_close():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        writer = store.writer()
+        writer.write_batch('a.tif', 0, 10, ['a0'])
+        writer.flush()
+        # Records are readable before the writer is closed
+        assert store.load().completed_ranges('a.tif') == [(0, 10)]
+        writer.close()
+        # Flushing a closed writer (e.g. on worker exit) does nothing
+        writer.flush()
+        assert store.load().completed_ranges('a.tif') == [(0, 10)]
+
+
+def test_checkpoint_store_discard():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_ckpt') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        with store.writer() as writer:
+            writer.write_batch('a.tif', 0, 10, ['a0'])
+            writer.write_batch('b.tif', 0, 10, ['b0'])
+            writer.write_raster('a.tif')
+            writer.write_raster('b.tif')
+        with store.writer() as writer:
+            writer.write_batch('a.tif', 10, 20, ['a1'])
+
+        checkpoint = store.load()
+        assert checkpoint.updated['a.tif'] >= checkpoint.updated['b.tif'] > 0
+
+        os.makedirs(store.merged_path)
+        store.discard(['a.tif'])
+        assert not os.path.exists(store.merged_path)
+        checkpoint = store.load()
+        assert checkpoint.done == {'b.tif'}
+        assert checkpoint.completed_ranges('a.tif') == []
+        assert 'a.tif' not in checkpoint.updated
+        assert checkpoint.results(['a.tif', 'b.tif']) == [['b0']]
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from mock import patch
+
+import aplatam.console.aggregate as ap_aggregate
+
+
+@patch('aplatam.console.aggregate.aggregate_blocks')
+def test_run_script_default_arguments(aggregate_mock_func):
+    with tempfile.TemporaryDirectory(prefix='ap_aggregate') as tmpdir:
+        output = os.path.join(tmpdir, 'blocks.shp')
+
+        ap_aggregate.main(['blocks.shp', 'windows.shp', output])
+
+        aggregate_mock_func.assert_called_once_with(
+            blocks_file='blocks.shp',
+            windows_file='windows.shp',
+            output_file=output,
+            min_coverage=0.8,
+            workers=1,
+            blocks_per_tile=1000,
+            coverage='union')
@@ -24,5 +24,13 @@ def test_run_script_default_arguments(train_mock_func):
             rescale_intensity=True,
             lower_cut=2,
             upper_cut=98,
+            stats_decimation=1,
+            preprocess_workers=2,
+            prefetch_batches=4,
+            workers=1,
+            resume=True,
+            dissolve=False,
+            probability_dir=None,
+            dense=False,
             step_size=None,
             threshold=0.3)
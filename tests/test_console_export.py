@@ -0,0 +1,17 @@
+from mock import patch
+
+import aplatam.console.export as ap_export
+
+
+@patch('aplatam.console.export.export_model')
+def test_run_script_default_arguments(export_mock_func):
+    ap_export.main(['model.h5', 'model.pb'])
+    export_mock_func.assert_called_once_with(
+        'model.h5', 'model.pb', quantize=None)
+
+
+@patch('aplatam.console.export.export_model')
+def test_run_script_with_quantize(export_mock_func):
+    ap_export.main(['model.h5', 'model.pb', '--quantize', 'int8'])
+    export_mock_func.assert_called_once_with(
+        'model.h5', 'model.pb', quantize='int8')
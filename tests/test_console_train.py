@@ -52,4 +52,7 @@ def test_run_script_default_arguments(train_mock_func):
             trainable_layers=5,
             batch_size=5,
             epochs=20,
-            size=256)
+            size=256,
+            head='flatten',
+            dense_units=None,
+            cache_embeddings=False)
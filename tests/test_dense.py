@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+from keras.applications.resnet50 import preprocess_input
+from keras.layers import (Activation, BatchNormalization, Conv2D, Dense,
+                          Dropout, Flatten, GlobalAveragePooling2D, Input,
+                          MaxPooling2D)
+from keras.models import Model
+
+from aplatam.dense import RESNET50_TOLERANCE, DenseModel
+from aplatam.train_classifier import build_model as build_resnet50_model
+from aplatam.util import sliding_windows
+
+SIZE = 16
+
+
+def build_model(head):
+    """Build a small convolutional classifier with no padding"""
+    inputs = Input(shape=(SIZE, SIZE, 3))
+    out = Conv2D(4, 3, activation='relu')(inputs)
+    out = MaxPooling2D(2)(out)
+    out = Conv2D(8, 3)(out)
+    out = BatchNormalization()(out)
+    out = Activation('relu')(out)
+    out = GlobalAveragePooling2D()(out) if head == 'gap' else Flatten()(out)
+    out = Dense(16, activation='relu')(out)
+    out = Dropout(0.5)(out)
+    out = Dense(1, activation='sigmoid')(out)
+    return Model(inputs=inputs, outputs=out)
+
+
+@pytest.mark.parametrize('head', ['flatten', 'gap'])
+def test_dense_model_matches_sliding_windows(head):
+    model = build_model(head)
+    dense_model = DenseModel(model, tile_pixels=40 * 24)
+    assert dense_model.stride == 2
+    assert dense_model.features_size == 5
+
+    rng = np.random.RandomState(0)
+    image = rng.uniform(-1, 1, (40, 48, 3)).astype(np.float32)
+    windows = list(sliding_windows(SIZE, 4, width=48, height=40))
+    offsets = [(w.row_off, w.col_off) for w in windows]
+
+    crops = np.array([image[r:r + SIZE, c:c + SIZE] for r, c in offsets])
+    expected = model.predict(crops)
+    # Small tiles, so that windows are split into several tiles
+    preds = dense_model.predict_windows(image, offsets)
+    assert preds.shape == expected.shape
+    assert np.allclose(preds, expected, atol=1e-5)
+
+
+def randomize(model, rng):
+    """Set kernels of +model+ to random weights from +rng+ and biases to 0"""
+    for layer in model.layers:
+        if isinstance(layer, (Conv2D, Dense)):
+            kernel, bias = layer.get_weights()
+            fan_in = np.prod(kernel.shape[:-1])
+            layer.set_weights([
+                rng.normal(0, np.sqrt(2 / fan_in),
+                           kernel.shape).astype(np.float32),
+                np.zeros_like(bias)
+            ])
+
+
+def calibrate(model, images):
+    """
+    Set statistics of batch normalization layers and the last dense layer of
+    +model+ to those of +images+, so that activations of a model with random
+    weights neither explode nor saturate
+
+    """
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            out = Model(model.input, layer.input).predict(images)
+            gamma, beta, _, _ = layer.get_weights()
+            layer.set_weights(
+                [gamma, beta,
+                 out.mean(axis=(0, 1, 2)),
+                 out.var(axis=(0, 1, 2))])
+    last = model.layers[-1]
+    features = Model(model.input, last.input).predict(images)
+    kernel, bias = last.get_weights()
+    logits = features.dot(kernel) + bias
+    last.set_weights([
+        kernel / logits.std(), (bias - logits.mean()) / logits.std()
+    ])
+
+
+@pytest.mark.parametrize('head', ['flatten', 'gap'])
+def test_dense_model_with_resnet50_matches_sliding_windows(head):
+    size = 224
+    model = build_resnet50_model(size, 5, head=head, weights=None)
+
+    rng = np.random.RandomState(0)
+    image = preprocess_input(
+        rng.uniform(0, 255, (288, 288, 3)).astype(np.float32))
+    windows = list(sliding_windows(size, 32, width=288, height=288))
+    offsets = [(w.row_off, w.col_off) for w in windows]
+    crops = np.array([image[r:r + size, c:c + size] for r, c in offsets])
+    randomize(model, rng)
+    calibrate(model, crops)
+
+    dense_model = DenseModel(model)
+    assert dense_model.stride == 32
+    expected = model.predict(crops)
+    preds = dense_model.predict_windows(image, offsets)
+    assert preds.shape == expected.shape
+    assert np.abs(preds - expected).max() <= RESNET50_TOLERANCE
+
+
+def test_dense_model_with_unaligned_windows():
+    dense_model = DenseModel(build_model('gap'))
+    image = np.zeros((20, 20, 3), dtype=np.float32)
+    with pytest.raises(ValueError):
+        dense_model.predict_windows(image, [(1, 0)])
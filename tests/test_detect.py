@@ -1,5 +1,10 @@
+import os
+import tempfile
+
+import pytest
 from mock import patch
 from aplatam.detect import *
+from aplatam.util import sliding_windows
 from shapely.geometry.multipolygon import MultiPolygon
 
 
@@ -15,3 +20,98 @@ def test_calculate_percentiles():
     low, high = calculate_percentiles(raster, block_size=1, lower_cut=2, upper_cut=98)
     assert round(low) == 0
     assert round(high) == 3404
+
+
+def test_load_predictions_merges_again_partial_merge():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        preds = Predictions.from_windows(
+            'a.tif', {'init': 'epsg:4326'}, [Window(0, 0, 2, 2)],
+            [(0, 0, 2, 2)], [0.9], size=2, step_size=1)
+        with store.writer() as writer:
+            writer.write_batch('a.tif', 0, 1, preds)
+            writer.write_raster('a.tif')
+        # Merge interrupted before writing metadata
+        os.makedirs(store.merged_path)
+
+        loaded = load_predictions(store, store.load(), ['a.tif'])
+        assert loaded.prob.tolist() == [pytest.approx(0.9)]
+        assert os.path.exists(os.path.join(store.merged_path, 'meta.json'))
+
+
+def test_discard_incomplete_probability_rasters():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        store.create()
+        paths = {
+            r: os.path.join(tmpdir, r)
+            for r in ('a.tif', 'b.tif', 'c.tif', 'd.tif')
+        }
+        with store.writer() as writer:
+            for raster in ('a.tif', 'b.tif', 'c.tif'):
+                writer.write_batch(raster, 0, 10, [raster])
+                writer.write_raster(raster)
+            # A raster without windows has no batches nor probability raster
+            writer.write_raster('d.tif')
+        for raster in ('a.tif', 'b.tif'):
+            open(paths[raster], 'w').close()
+        # Probability raster of b.tif was not flushed after its last batch
+        os.utime(paths['b.tif'], (0, 0))
+
+        checkpoint = discard_incomplete_probability_rasters(
+            store, store.load(), paths)
+        assert checkpoint.done == {'a.tif', 'd.tif'}
+        assert checkpoint.completed_ranges('b.tif') == []
+        assert checkpoint.completed_ranges('c.tif') == []
+        assert checkpoint.completed_ranges('a.tif') == [(0, 10)]
+
+
+def test_prepare_checkpoint_store_with_dense():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        store = CheckpointStore(os.path.join(tmpdir, 'out.pred'))
+        opts = dict(step_size=128, threshold=0.5)
+        prepare_checkpoint_store(
+            store, 'model.h5', resume=True, dense=False, **opts)
+        prepare_checkpoint_store(
+            store, 'model.h5', resume=True, dense=False, **opts)
+        with pytest.raises(RuntimeError):
+            prepare_checkpoint_store(
+                store, 'model.h5', resume=True, dense=True, **opts)
+        prepare_checkpoint_store(
+            store, 'model.h5', resume=False, dense=True, **opts)
+        assert store.read_params()['dense']
+
+        # Stores without the parameter were not dense
+        store.create(
+            model_file=os.path.abspath('model.h5'), step_size=128,
+            threshold=0.5)
+        prepare_checkpoint_store(
+            store, 'model.h5', resume=True, dense=False, **opts)
+
+
+def test_chunk_range():
+    windows = list(sliding_windows(size=2, step_size=1, width=3, height=6))
+    assert chunk_range(windows, (0, 2), 2, 1, height=6) == (0, 6)
+    assert chunk_range(windows, (1, 2), 2, 1, height=6) == (6, 10)
+
+
+def test_batch_ranges():
+    assert list(batch_ranges(0, 10, [], 4)) == [(0, 4), (4, 8), (8, 10)]
+    assert list(batch_ranges(2, 10, [(0, 3), (5, 6)], 4)) == [(3, 5), (6, 10)]
+    assert list(batch_ranges(0, 4, [(0, 4), (8, 12)], 4)) == []
+
+
+def test_band_ranges():
+    windows = list(sliding_windows(size=2, step_size=1, width=3, height=6))
+    # 2 windows per row, 5 rows, in bands of 2 rows
+    assert list(band_ranges(windows, 0, 10, [], 2)) == \
+        [(0, 4), (4, 8), (8, 10)]
+    assert list(band_ranges(windows, 1, 10, [(4, 5)], 2)) == \
+        [(1, 4), (5, 8), (8, 10)]
+
+
+def test_covering_window():
+    windows = list(sliding_windows(size=4, step_size=2, width=10, height=8))
+    assert covering_window(windows[1:4]) == Window(2, 0, 8, 4)
+    assert covering_window(windows[3:5]) == Window(0, 0, 10, 6)
@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from aplatam.embedding_cache import (FLIP_VARIANTS, EmbeddingCache,
+                                     flip_images)
+from aplatam.packed_dataset import PackedDataset, PackedDatasetWriter
+
+
+@pytest.fixture
+def dataset():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        path = os.path.join(tmpdir, 'train')
+        rng = np.random.RandomState(0)
+        with PackedDatasetWriter(path) as writer:
+            for i in range(10):
+                img = rng.randint(0, 256, size=(4, 4, 3)).astype(np.uint8)
+                writer.write(img, i % 2, '{}.jpg'.format(i))
+        yield tmpdir, PackedDataset(path)
+
+
+def predict(images):
+    images = images.astype(np.float32)
+    # Two outputs, one of them depends on orientation of images
+    return [images[:, :, :, 0], images.mean(axis=(1, 2))]
+
+
+def test_flip_images():
+    images = np.arange(2 * 3 * 3 * 1).reshape(2, 3, 3, 1)
+    assert np.array_equal(flip_images(images, 0), images)
+    assert np.array_equal(flip_images(images, 1), images[:, :, ::-1])
+    assert np.array_equal(flip_images(images, 2), images[:, ::-1])
+    assert np.array_equal(flip_images(images, 3), images[:, ::-1, ::-1])
+
+
+def test_embedding_cache(dataset):
+    tmpdir, dataset = dataset
+    path = os.path.join(tmpdir, 'embeddings')
+    cache = EmbeddingCache(
+        path,
+        dataset,
+        predict,
+        dict(model='test'),
+        variants=FLIP_VARIANTS,
+        batch_size=3)
+    assert len(cache) == 10
+
+    indexes = np.array([1, 4, 9])
+    variants = np.array([0, 1, 3])
+    res = cache.read(indexes, variants)
+    images = dataset.read(indexes)
+    for i, variant in enumerate(variants):
+        expected = predict(flip_images(images[i:i + 1], variant))
+        for out, exp in zip(res, expected):
+            assert out.dtype == np.float32
+            assert np.allclose(out[i], exp[0], rtol=1e-3)
+
+
+def test_embedding_cache_is_reused(dataset):
+    tmpdir, dataset = dataset
+    path = os.path.join(tmpdir, 'embeddings')
+    calls = []
+
+    def counting_predict(images):
+        calls.append(len(images))
+        return predict(images)
+
+    EmbeddingCache(path, dataset, counting_predict, dict(model='test'))
+    assert sum(calls) == 10
+    EmbeddingCache(path, dataset, counting_predict, dict(model='test'))
+    assert sum(calls) == 10
+    # A different model invalidates cache
+    EmbeddingCache(path, dataset, counting_predict, dict(model='other'))
+    assert sum(calls) == 20
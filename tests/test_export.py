@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from aplatam.export import (METADATA_NODE, FrozenGraphModel,
+                            _cast_weights_to_float16, _string_constant,
+                            is_exported_model)
+
+
+def build_graph(weights):
+    """Build a frozen graph of a tiny model on 4x4 images"""
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, (None, 4, 4, 3), name='input')
+        flat = tf.reshape(images, (-1, 48))
+        tf.sigmoid(tf.matmul(flat, tf.constant(weights)), name='output')
+    graph_def = graph.as_graph_def()
+    metadata = '{"size": 4, "input": "input", "output": "output"}'
+    graph_def.node.extend([_string_constant(METADATA_NODE, metadata)])
+    return graph_def
+
+
+def test_frozen_graph_model():
+    rng = np.random.RandomState(0)
+    weights = rng.normal(size=(48, 32)).astype(np.float32) / 48
+    images = rng.uniform(0, 1, (10, 4, 4, 3)).astype(np.float32)
+    expected = 1 / (1 + np.exp(-images.reshape(-1, 48).dot(weights)))
+
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        for quantize in (None, 'float16'):
+            graph_def = build_graph(weights)
+            if quantize:
+                graph_def = _cast_weights_to_float16(graph_def)
+                ops = [n.op for n in graph_def.node]
+                assert 'Cast' in ops
+            path = os.path.join(tmpdir, 'model.pb')
+            with open(path, 'wb') as dst:
+                dst.write(graph_def.SerializeToString())
+
+            model = FrozenGraphModel(path)
+            assert model.input_shape == (None, 4, 4, 3)
+            preds = model.predict(images, batch_size=3)
+            model.close()
+            assert preds.shape == (10, 32)
+            assert np.allclose(preds, expected, atol=1e-3)
+
+
+def test_is_exported_model():
+    assert is_exported_model('model.pb')
+    assert not is_exported_model('model.h5')
@@ -0,0 +1,126 @@
+import os
+import tempfile
+
+import fiona
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point, Polygon, box, mapping
+
+from aplatam.grid import WindowGrid, contour_window_mask
+from aplatam.util import sliding_windows
+
+
+@pytest.fixture(autouse=True)
+def stats_cache_dir(monkeypatch):
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_cache') as tmpdir:
+        monkeypatch.setenv('APLATAM_CACHE_DIR', tmpdir)
+        yield tmpdir
+
+
+@pytest.fixture
+def grid():
+    return WindowGrid(
+        from_origin(1000, 2000, 0.5, 0.5), 100, 70, size=12, step_size=8)
+
+
+def brute_force_mask(grid, shape):
+    mask = np.zeros(grid.shape, dtype=bool)
+    for r in range(grid.shape[0]):
+        for c in range(grid.shape[1]):
+            mask[r, c] = shape.intersects(grid.window_box(r, c))
+    return mask
+
+
+def test_windows_are_the_same_as_sliding_windows(grid):
+    expected = list(
+        sliding_windows(12, 8, width=grid.width, height=grid.height))
+    assert len(grid) == len(expected)
+    assert grid.windows() == expected
+
+
+def test_windows_with_mask(grid):
+    mask = np.zeros(grid.shape, dtype=bool)
+    mask[1, 2] = True
+    mask[3, 0] = True
+    windows = grid.windows(mask)
+    assert [(w.row_off, w.col_off) for w in windows] == [(8, 16), (24, 0)]
+
+
+def test_bounds(grid):
+    rows, cols = grid.cells()
+    bounds = grid.bounds(rows, cols)
+    with rasterio.open(
+            'grid.tif', 'w', driver='MEM', width=grid.width,
+            height=grid.height, count=1, dtype='uint8',
+            transform=grid.transform) as src:
+        expected = [src.window_bounds(w) for w in grid.windows()]
+    assert np.allclose(bounds, expected)
+
+
+@pytest.mark.parametrize('shape', [
+    Point(1020.3, 1980.1).buffer(7),
+    Polygon([(1003, 1999), (1040, 1990), (1010, 1970)]),
+    box(1012, 1990, 1018, 1996),
+    box(1004, 1996, 1004.1, 1996.1),
+    box(900, 1900, 1100, 2100),
+    box(0, 0, 10, 10),
+])
+def test_intersects(grid, shape):
+    assert np.array_equal(
+        grid.intersects(shape), brute_force_mask(grid, shape))
+
+
+def test_contour_window_mask_is_cached(grid):
+    contour = Point(1020, 1980).buffer(5)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raster = os.path.join(tmpdir, 'raster.tif')
+        with open(raster, 'w') as dst:
+            dst.write('raster')
+        contour_path = os.path.join(tmpdir, 'contour.geojson')
+        schema = dict(geometry='Polygon', properties={})
+        with fiona.open(contour_path, 'w', driver='GeoJSON',
+                        schema=schema) as dst:
+            dst.write(dict(geometry=mapping(contour), properties={}))
+
+        calls = []
+
+        def load_contour():
+            calls.append(1)
+            return contour
+
+        mask = contour_window_mask(raster, grid, contour_path, load_contour)
+        cached_mask = contour_window_mask(raster, grid, contour_path,
+                                          load_contour)
+
+    assert len(calls) == 1
+    assert np.array_equal(mask, brute_force_mask(grid, contour))
+    assert np.array_equal(cached_mask, mask)
+
+
+@pytest.mark.parametrize('shape', [
+    Point(1020.3, 1980.1).buffer(7),
+    Polygon([(1003, 1999), (1040, 1990), (1010, 1970)]),
+    box(1012, 1990, 1018, 1996),
+    box(900, 1900, 1100, 2100),
+])
+def test_coverage(grid, shape):
+    expected = np.zeros(grid.shape)
+    for r in range(grid.shape[0]):
+        for c in range(grid.shape[1]):
+            wbox = grid.window_box(r, c)
+            expected[r, c] = shape.intersection(wbox).area / wbox.area
+    coverage = grid.coverage(shape)
+    assert np.allclose(coverage, expected, atol=0.1)
+
+
+def test_coverage_with_too_many_cells(grid, monkeypatch):
+    shape = box(1012, 1990, 1018, 1996)
+    monkeypatch.setattr('aplatam.grid.MAX_CELLS', 1)
+    mask = np.zeros(grid.shape, dtype=bool)
+    mask[0, 1] = True
+    coverage = grid.coverage(shape, mask=mask)
+    wbox = grid.window_box(0, 1)
+    assert coverage[0, 1] == shape.intersection(wbox).area / wbox.area
+    assert coverage.sum() == coverage[0, 1]
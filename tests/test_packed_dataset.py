@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from aplatam.packed_dataset import (PackedDataset, PackedDatasetWriter,
+                                    is_packed_dataset)
+
+
+def random_images(count, shape=(8, 8, 3)):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, size=(count, ) + shape).astype(np.uint8)
+
+
+def test_write_and_read_packed_dataset():
+    images = random_images(10)
+    labels = [i % 2 for i in range(10)]
+    names = ['{}.jpg'.format(i) for i in range(10)]
+
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        path = os.path.join(tmpdir, 'train')
+        with PackedDatasetWriter(path, shard_size=4) as writer:
+            for img, label, name in zip(images, labels, names):
+                writer.write(img, label, name)
+
+        assert is_packed_dataset(path)
+        assert not is_packed_dataset(tmpdir)
+        assert len(writer.shards) == 3
+
+        dataset = PackedDataset(path)
+        assert len(dataset) == 10
+        assert dataset.shape == (8, 8, 3)
+        assert list(dataset.labels) == labels
+        assert dataset.names() == names
+        assert np.array_equal(dataset.read(np.arange(10)), images)
+        # Indexes across shards, in any order
+        indexes = [9, 0, 5, 3, 4]
+        assert np.array_equal(dataset.read(indexes), images[indexes])
+
+
+def test_write_empty_packed_dataset():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        with PackedDatasetWriter(tmpdir):
+            pass
+        dataset = PackedDataset(tmpdir)
+        assert len(dataset) == 0
+        assert dataset.read([]).shape == (0, )
+
+
+def test_unfinished_packed_dataset_is_not_read():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        with PackedDatasetWriter(tmpdir) as writer:
+            writer.write(random_images(1)[0], 1, 'a.jpg')
+        assert is_packed_dataset(tmpdir)
+        writer = PackedDatasetWriter(tmpdir)
+        assert not is_packed_dataset(tmpdir)
+        writer.close()
+        assert is_packed_dataset(tmpdir)
+
+
+def test_write_packed_dataset_with_wrong_type():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        writer = PackedDatasetWriter(tmpdir)
+        with pytest.raises(ValueError):
+            writer.write(np.full((8, 8, 3), 300, dtype=np.uint16), 1, 'a.jpg')
+        writer.close()
+
+
+def test_write_packed_dataset_with_different_shapes():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        writer = PackedDatasetWriter(tmpdir)
+        writer.write(random_images(1)[0], 1, 'a.jpg')
+        with pytest.raises(ValueError):
+            writer.write(random_images(1, shape=(4, 4, 3))[0], 1, 'b.jpg')
+        writer.close()
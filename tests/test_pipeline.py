@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from aplatam.pipeline import BatchPipeline, StageTimer
+
+
+def slow_square(x):
+    time.sleep(0.001 * (x % 3))
+    return x * x
+
+
+def test_batch_pipeline_keeps_order():
+    pipeline = BatchPipeline(range(50), slow_square, workers=4, queue_size=2)
+    assert list(pipeline) == [x * x for x in range(50)]
+
+
+def test_batch_pipeline_empty():
+    assert list(BatchPipeline([], slow_square)) == []
+
+
+def test_batch_pipeline_reads_on_a_single_thread():
+    threads = set()
+
+    def batches():
+        for i in range(10):
+            threads.add(threading.current_thread())
+            yield i
+
+    list(BatchPipeline(batches(), slow_square, workers=3))
+    assert len(threads) == 1
+
+
+def test_batch_pipeline_raises_errors_from_workers():
+    def fail(x):
+        if x == 5:
+            raise ValueError('bad batch')
+        return x
+
+    with pytest.raises(ValueError):
+        list(BatchPipeline(range(10), fail, workers=2))
+
+
+def test_batch_pipeline_timings():
+    timer = StageTimer()
+    list(BatchPipeline(range(10), slow_square, timer=timer))
+    assert set(timer.totals) == {'read', 'preprocess', 'wait'}
@@ -1,5 +1,9 @@
+import numpy as np
+import pytest
 from mock import patch
+from rasterio.windows import Window
 from aplatam.post_process import *
+from aplatam.predictions import Predictions
 from shapely.geometry import box, mapping
 
 
@@ -33,3 +37,128 @@ def test_filter_features_by_mean_prob():
     res = filter_features_by_mean_prob(shapes, 4, 0.5)
     assert [{'prob': 0.15, 'prob_mean': 0.6799999999999999},
             {'prob': 0.1, 'prob_mean': 0.58}] == [r.props for r in res]
+
+
+def grid_predictions(probs, size=1, step_size=1, raster='a.tif', x_off=0):
+    probs = np.array(probs)
+    rows, cols = np.nonzero(~np.isnan(probs))
+    windows = [Window(c * step_size, r * step_size, size, size)
+               for r, c in zip(rows, cols)]
+    bounds = [(x_off + w.col_off, w.row_off, x_off + w.col_off + size,
+               w.row_off + size) for w in windows]
+    return Predictions.from_windows(
+        raster, {'init': 'epsg:4326'}, windows, bounds, probs[rows, cols],
+        size=size, step_size=step_size)
+
+
+def test_filter_predictions_by_mean_prob():
+    preds = grid_predictions([
+        [0.75, 0.5, 0.5],
+        [0.15, 0.9, 0.1],
+        [0.75, 0.5, 0.5],
+    ])
+
+    res = filter_predictions_by_mean_prob(preds, 4, 0.5)
+    assert res.prob.tolist() == pytest.approx([0.15, 0.1])
+    assert res.prob_mean.tolist() == pytest.approx([0.68, 0.58])
+
+
+def test_filter_predictions_by_mean_prob_matches_shapes_filter():
+    probs = np.random.RandomState(42).rand(12, 15)
+    probs[probs < 0.3] = np.nan
+    preds = grid_predictions(probs, size=4, step_size=2)
+    shapes = [ShapeWithProps(s.shape, s.props) for s in
+              preds.iter_shapes(dst_crs={'init': 'epsg:4326'})]
+
+    expected = filter_features_by_mean_prob(shapes, 3, 0.5)
+    res = filter_predictions_by_mean_prob(preds, 3, 0.5)
+    assert res.prob_mean.tolist() == pytest.approx(
+        [s.props['prob_mean'] for s in expected])
+
+
+def test_filter_predictions_by_mean_prob_across_rasters():
+    # Two adjacent tiles of a mosaic, windows of the last column of the
+    # first tile touch windows of the first column of the second one
+    rng = np.random.RandomState(0)
+    probs_a, probs_b = rng.rand(6, 5), rng.rand(6, 4)
+    probs_a[probs_a < 0.2] = np.nan
+    probs_b[probs_b < 0.2] = np.nan
+    preds = Predictions.concatenate([
+        grid_predictions(probs_a, size=4, step_size=2, raster='a.tif'),
+        grid_predictions(
+            probs_b, size=4, step_size=2, raster='b.tif', x_off=12),
+    ])
+    shapes = [ShapeWithProps(s.shape, s.props) for s in
+              preds.iter_shapes(dst_crs={'init': 'epsg:4326'})]
+
+    expected = filter_features_by_mean_prob(shapes, 3, 0.5)
+    res = filter_predictions_by_mean_prob(preds, 3, 0.5)
+    assert res.prob_mean.tolist() == pytest.approx(
+        [s.props['prob_mean'] for s in expected])
+    assert set(res.raster_id.tolist()) == {0, 1}
+
+
+def test_filter_predictions_by_mean_prob_less_neighbours():
+    preds = grid_predictions([[0.9, np.nan, np.nan, 0.8]])
+    res = filter_predictions_by_mean_prob(preds, 1, 0.0)
+    assert len(res) == 0
+
+
+def test_dissolve_overlapping_shapes():
+    shapes = [
+        ShapeWithProps(box(0, 0, 2, 2), dict(prob=0.5)),
+        ShapeWithProps(box(1, 1, 3, 3), dict(prob=0.7)),
+        ShapeWithProps(box(5, 5, 6, 6), dict(prob=0.9)),
+    ]
+    res = sorted(dissolve_overlapping_shapes(shapes), key=lambda s: s.shape.area)
+    assert len(res) == 2
+    assert res[0].shape.equals(box(5, 5, 6, 6))
+    assert res[1].shape.equals(unary_union([box(0, 0, 2, 2), box(1, 1, 3, 3)]))
+    assert res[1].props == dict(prob=0.6, prob_max=0.7, windows=2)
+
+
+@pytest.mark.parametrize('north_up', [False, True])
+@pytest.mark.parametrize('size,step_size', [(1, 1), (4, 2), (6, 4)])
+def test_dissolve_predictions(size, step_size, north_up):
+    nan = np.nan
+    preds = grid_predictions([
+        [0.5, 0.7, nan, nan, nan],
+        [nan, 0.6, nan, nan, 0.9],
+        [nan, nan, nan, nan, 0.8],
+        [0.4, nan, nan, nan, nan],
+    ], size=size, step_size=step_size)
+    if north_up:
+        preds = preds.with_column('miny', -preds.maxy).with_column(
+            'maxy', -preds.miny)
+    assert_dissolved_as_shapes(preds)
+
+
+@pytest.mark.parametrize('size,step_size', [(1, 1), (2, 2), (4, 2)])
+def test_dissolve_predictions_diagonal_windows(size, step_size):
+    nan = np.nan
+    preds = grid_predictions([
+        [0.5, nan, nan, nan],
+        [nan, 0.6, nan, 0.9],
+        [nan, nan, 0.7, nan],
+    ], size=size, step_size=step_size)
+    res = assert_dissolved_as_shapes(preds)
+    if size == step_size:
+        assert len(res) == 1
+        assert res[0].props['windows'] == 4
+
+
+def assert_dissolved_as_shapes(preds):
+    shapes = [box(*b) for b in preds.bounds]
+
+    res = dissolve_predictions(preds)
+    expected = dissolve_overlapping_shapes(
+        [ShapeWithProps(s, dict(prob=float(p))) for s, p in zip(shapes, preds.prob)])
+
+    assert len(res) == len(expected)
+    for exp in expected:
+        match = [r for r in res if r.shape.equals(exp.shape)]
+        assert len(match) == 1
+        assert match[0].props['windows'] == exp.props['windows']
+        assert np.isclose(match[0].props['prob'], exp.props['prob'])
+        assert np.isclose(match[0].props['prob_max'], exp.props['prob_max'])
+    return res
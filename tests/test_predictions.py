@@ -0,0 +1,104 @@
+import os
+import tempfile
+
+import numpy as np
+from rasterio.windows import Window
+from shapely.geometry import box
+
+from aplatam.predictions import Predictions, is_saved_predictions
+from aplatam.util import WGS84_CRS, reproject_shape
+
+UTM_CRS = {'init': 'epsg:32721'}
+
+
+def some_predictions(raster='a.tif', probs=(0.5, 0.75)):
+    windows = [Window(0, 0, 10, 10), Window(5, 10, 10, 10)][:len(probs)]
+    bounds = [(0, -10, 10, 0), (5, -20, 15, -10)][:len(probs)]
+    return Predictions.from_windows(
+        raster, UTM_CRS, windows, bounds, probs, size=10, step_size=5)
+
+
+def test_predictions_from_windows():
+    preds = some_predictions()
+    assert len(preds) == 2
+    assert preds.prob.dtype == np.float32
+    assert list(preds.row) == [0, 2]
+    assert list(preds.col) == [0, 1]
+    assert preds.bounds.tolist() == [[0, -10, 10, 0], [5, -20, 15, -10]]
+
+
+def test_predictions_concatenate_remaps_rasters():
+    preds = Predictions.concatenate([
+        some_predictions('a.tif'),
+        some_predictions('b.tif', probs=(0.9, )),
+        some_predictions('a.tif', probs=(0.6, )),
+    ])
+    assert preds.rasters == ['a.tif', 'b.tif']
+    assert list(preds.raster_id) == [0, 0, 1, 0]
+    assert len(preds.select_rasters(['b.tif'])) == 1
+
+
+def test_predictions_concatenate_empty():
+    assert len(Predictions.concatenate([])) == 0
+
+
+def test_predictions_subset_and_columns():
+    preds = some_predictions()
+    subset = preds[preds.prob > 0.6]
+    assert len(subset) == 1
+    subset = subset.with_column('prob_mean', [0.3])
+    assert subset.prop_names == ['prob', 'prob_mean']
+
+
+def test_predictions_iter_shapes():
+    preds = some_predictions()
+    shapes = list(preds.iter_shapes(dst_crs=UTM_CRS))
+    assert shapes[0].shape.bounds == (0, -10, 10, 0)
+    assert shapes[1].props == {'prob': 0.75}
+
+
+def test_predictions_iter_shapes_reprojects_in_batches():
+    preds = Predictions.concatenate([
+        some_predictions('a.tif'),
+        Predictions.from_windows(
+            'b.tif', {'init': 'epsg:32720'}, [Window(0, 0, 10, 10)],
+            [(500000, 6000000, 500010, 6000010)], [0.9],
+            size=10, step_size=5),
+    ])
+    shapes = list(preds.iter_shapes(chunk_size=2))
+    assert len(shapes) == 3
+    for shape, (i, bounds) in zip(shapes, enumerate(preds.bounds)):
+        crs = preds.crss[preds.raster_id[i]]
+        expected = reproject_shape(box(*bounds), crs, WGS84_CRS)
+        assert np.allclose(shape.shape.exterior.coords,
+                           expected.exterior.coords)
+
+
+def test_predictions_save_and_load():
+    preds = some_predictions()
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_preds') as tmpdir:
+        preds.save(tmpdir)
+        loaded = Predictions.load(tmpdir)
+        assert isinstance(loaded.prob, np.memmap)
+        assert loaded.rasters == preds.rasters
+        assert loaded.crss == preds.crss
+        assert (loaded.size, loaded.step_size) == (10, 5)
+        for name in preds.columns:
+            assert np.array_equal(loaded.columns[name], preds.columns[name])
+
+
+def test_predictions_save_replaces_partial_directory():
+    preds = some_predictions()
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_preds') as tmpdir:
+        path = os.path.join(tmpdir, 'merged')
+        # A directory left by an interrupted save, without metadata
+        os.makedirs(path)
+        with open(os.path.join(path, 'prob.npy'), 'wb') as dst:
+            dst.write(b'\x93NUMPY')
+        assert not is_saved_predictions(path)
+
+        preds.save(path)
+        assert is_saved_predictions(path)
+        assert sorted(os.listdir(tmpdir)) == ['merged']
+        loaded = Predictions.load(path)
+        assert np.array_equal(loaded.prob, preds.prob)
@@ -0,0 +1,104 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from aplatam.grid import WindowGrid
+from aplatam.probability_raster import (MTIME_TOLERANCE, NODATA,
+                                        is_probability_raster_current,
+                                        open_probability_raster,
+                                        probability_raster_path,
+                                        read_probability_raster)
+
+TRANSFORM = from_origin(1000, 2000, 0.5, 0.5)
+
+
+@pytest.fixture
+def raster():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        path = os.path.join(tmpdir, 'raster.tif')
+        profile = dict(
+            driver='GTiff',
+            width=100,
+            height=70,
+            count=3,
+            dtype='uint8',
+            crs='epsg:32721',
+            transform=TRANSFORM)
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(np.zeros((3, 70, 100), dtype=np.uint8))
+        yield path
+
+
+def test_write_and_read_probability_raster(raster):
+    grid = WindowGrid(TRANSFORM, 100, 70, size=12, step_size=8)
+    rows, cols = grid.cells()
+    probs = np.linspace(0, 1, len(rows), dtype=np.float32)
+    # Leave last window unpredicted
+    probs[-1] = NODATA
+
+    path = os.path.join(os.path.dirname(raster), 'probs', 'raster.tif')
+    with open_probability_raster(
+            path, raster, size=12, step_size=8) as writer:
+        for start in range(0, len(rows) - 1, 7):
+            end = min(start + 7, len(rows) - 1)
+            writer.write(rows[start:end], cols[start:end], probs[start:end])
+
+    with rasterio.open(path) as src:
+        assert src.shape == grid.shape
+        assert src.overviews(1) == [2, 4]
+        data = src.read(1)
+        # Pixels are centered on the center of windows
+        x, y = src.xy(0, 0)
+        assert (x, y) == TRANSFORM * (6, 6)
+    assert np.array_equal(data.ravel(), probs)
+
+    preds = read_probability_raster(path, threshold=0.5)
+    expected = (probs >= 0.5) & (probs != NODATA)
+    assert len(preds) == expected.sum()
+    assert preds.rasters == [raster]
+    assert np.allclose(preds.prob, probs[expected])
+    assert np.allclose(preds.bounds,
+                       grid.bounds(rows[expected], cols[expected]))
+
+
+def test_resume_probability_raster(raster):
+    path = os.path.join(os.path.dirname(raster), 'raster.prob.tif')
+    with open_probability_raster(path, raster, size=10, step_size=10) as w:
+        w.write(np.array([0]), np.array([0]), np.array([0.25]))
+    with open_probability_raster(
+            path, raster, size=10, step_size=10, resume=True) as w:
+        w.write(np.array([1]), np.array([1]), np.array([0.75]))
+
+    with rasterio.open(path) as src:
+        data = src.read(1)
+    assert data[0, 0] == 0.25
+    assert data[1, 1] == 0.75
+    assert (data == NODATA).sum() == data.size - 2
+
+
+def test_probability_raster_of_raster_smaller_than_window(raster):
+    path = os.path.join(os.path.dirname(raster), 'raster.prob.tif')
+    assert open_probability_raster(
+        path, raster, size=80, step_size=10) is None
+    assert not os.path.exists(path)
+
+
+def test_is_probability_raster_current(raster):
+    path = os.path.join(os.path.dirname(raster), 'raster.prob.tif')
+    assert not is_probability_raster_current(path, 0)
+    with open_probability_raster(path, raster, size=10, step_size=10):
+        pass
+    mtime = os.path.getmtime(path)
+    assert is_probability_raster_current(path, 0)
+    assert is_probability_raster_current(path, mtime)
+    assert not is_probability_raster_current(
+        path, mtime + MTIME_TOLERANCE + 1)
+
+
+def test_probability_raster_path():
+    assert probability_raster_path('out', 'data', 'data/a/b.tif') == \
+        os.path.join('out', 'a', 'b.tif')
@@ -0,0 +1,123 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from mock import patch
+
+from aplatam.stats import (RasterStatsCache, calculate_histogram,
+                           calculate_percentiles, get_raster_info)
+
+
+def create_raster(path, data):
+    count, height, width = data.shape
+    profile = dict(
+        driver='GTiff',
+        width=width,
+        height=height,
+        count=count,
+        dtype=data.dtype.name,
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+        crs='epsg:32721',
+        transform=from_origin(0, 0, 1, 1))
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data)
+
+
+@pytest.fixture(autouse=True)
+def stats_cache_dir(monkeypatch):
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_cache') as tmpdir:
+        monkeypatch.setenv('APLATAM_CACHE_DIR', tmpdir)
+        yield tmpdir
+
+
+@pytest.fixture
+def uint16_raster():
+    data = np.random.RandomState(0).randint(
+        0, 5000, size=(4, 70, 50)).astype(np.uint16)
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_stats') as tmpdir:
+        path = os.path.join(tmpdir, 'raster.tif')
+        create_raster(path, data)
+        yield path, data
+
+
+@pytest.fixture
+def float_raster():
+    data = np.random.RandomState(0).normal(size=(3, 70, 50)).astype('float32')
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_stats') as tmpdir:
+        path = os.path.join(tmpdir, 'raster.tif')
+        create_raster(path, data)
+        yield path, data
+
+
+def test_calculate_percentiles_is_exact_for_integer_rasters(uint16_raster):
+    path, data = uint16_raster
+    expected = np.percentile(data[:3], (2, 98))
+    res = calculate_percentiles(path, lower_cut=2, upper_cut=98)
+    assert res == pytest.approx(expected)
+
+
+def test_calculate_percentiles_of_float_rasters(float_raster):
+    path, data = float_raster
+    expected = np.percentile(data, (2, 98))
+    res = calculate_percentiles(path, lower_cut=2, upper_cut=98)
+    assert res == pytest.approx(expected, abs=1e-3)
+
+
+def test_calculate_histogram_counts_all_pixels(uint16_raster):
+    path, _ = uint16_raster
+    with rasterio.open(path) as src:
+        hist = calculate_histogram(src, block_size=2)
+    assert hist.counts.shape == (3, 65536)
+    assert hist.counts.sum() == 3 * 70 * 50
+
+
+def test_calculate_histogram_with_decimation(uint16_raster):
+    path, data = uint16_raster
+    with rasterio.open(path) as src:
+        hist = calculate_histogram(src, decimation=2, block_stride=2)
+    assert 0 < hist.counts.sum() < 3 * 70 * 50
+    low, high = hist.percentiles((2, 98))
+    assert low == pytest.approx(np.percentile(data[:3], 2), abs=100)
+    assert high == pytest.approx(np.percentile(data[:3], 98), abs=100)
+
+
+def test_calculate_percentiles_reuses_cached_histogram(uint16_raster):
+    path, data = uint16_raster
+    calculate_percentiles(path, lower_cut=2, upper_cut=98)
+    with patch('aplatam.stats.calculate_histogram') as mock_func:
+        assert calculate_percentiles(path, lower_cut=2, upper_cut=98) == \
+            pytest.approx(np.percentile(data[:3], (2, 98)))
+        assert calculate_percentiles(path, lower_cut=5, upper_cut=95) == \
+            pytest.approx(np.percentile(data[:3], (5, 95)))
+        mock_func.assert_not_called()
+
+
+def test_stats_cache_is_invalidated_when_raster_changes(uint16_raster):
+    path, data = uint16_raster
+    calculate_percentiles(path, lower_cut=2, upper_cut=98)
+    create_raster(path, data // 2)
+    os.utime(path, ns=(0, 0))
+    assert calculate_percentiles(path, lower_cut=2, upper_cut=98) == \
+        pytest.approx(np.percentile(data[:3] // 2, (2, 98)))
+
+
+def test_get_raster_info(uint16_raster):
+    path, _ = uint16_raster
+    info = get_raster_info(path)
+    assert info['count'] == 4
+    assert info['crs'] == rasterio.crs.CRS.from_epsg(32721)
+    assert info['bounds'] == [0, -70, 50, 0]
+
+
+def test_stats_cache_disabled(uint16_raster):
+    path, data = uint16_raster
+    cache = RasterStatsCache(None)
+    assert cache.percentiles(path, lower_cut=2, upper_cut=98) == \
+        pytest.approx(np.percentile(data[:3], (2, 98)))
+    assert cache.info(path)['count'] == 4
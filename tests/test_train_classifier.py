@@ -1,5 +1,16 @@
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
 from mock import patch
+from rasterio.transform import from_origin
+from skimage.io import imsave
+
+from aplatam.packed_dataset import PackedDatasetWriter
 from aplatam.train_classifier import *
+from aplatam.train_classifier import _files_digest
+from aplatam.util import sliding_windows
 
 
 DATASET_DIR = '/tmp/dataset'
@@ -60,3 +71,171 @@ def test_train(find_dataset_files_mock, validation_data_gen_mock, train_data_gen
         batch_size=20,
         epochs=10,
         size=256)
+
+
+@pytest.fixture
+def raster(request):
+    dtype = getattr(request, 'param', 'uint8')
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        path = os.path.join(tmpdir, 'raster.tif')
+        rng = np.random.RandomState(0)
+        profile = dict(
+            driver='GTiff',
+            width=64,
+            height=64,
+            count=3,
+            dtype=dtype,
+            tiled=True,
+            blockxsize=16,
+            blockysize=16,
+            crs='epsg:32721',
+            transform=from_origin(0, 64, 1, 1))
+        with rasterio.open(path, 'w', **profile) as dst:
+            if dtype == 'uint8':
+                dst.write(rng.randint(0, 255, (3, 64, 64)).astype(np.uint8))
+            else:
+                dst.write(rng.randint(0, 4096, (3, 64, 64)).astype(dtype))
+        yield path
+
+
+def test_raster_window_sequence(raster):
+    windows = list(sliding_windows(16, 8, width=64, height=64))
+    true_samples = [(raster, w) for w in windows[:5]]
+    false_samples = [(raster, w) for w in windows[5:]]
+    seq = RasterWindowSequence(
+        true_samples,
+        false_samples,
+        None,
+        batch_size=4,
+        balancing_multiplier=2,
+        seed=0)
+
+    assert len(seq.samples) == 15
+    assert len(seq) == 4
+    images, labels = seq[0]
+    assert images.shape == (4, 16, 16, 3)
+    assert labels.shape == (4, )
+
+    # All true samples, and a new selection of false samples on each epoch
+    first_samples = seq.samples
+    seq.on_epoch_end()
+    assert seq.samples != first_samples
+    for samples in (first_samples, seq.samples):
+        assert sorted(
+            (s[1].row_off, s[1].col_off) for s in samples if s[2] == 1) == \
+            sorted((w.row_off, w.col_off) for _, w in true_samples)
+    seq.close()
+
+
+@pytest.mark.parametrize('raster', ['uint16'], indirect=True)
+@pytest.mark.parametrize('rescale', [True, False])
+def test_raster_window_sequence_uint16(raster, rescale):
+    windows = list(sliding_windows(16, 8, width=64, height=64))
+    percentiles = {raster: (100, 3000)} if rescale else None
+    seq = RasterWindowSequence(
+        [(raster, w) for w in windows[:5]],
+        [(raster, w) for w in windows[5:]],
+        percentiles,
+        batch_size=4)
+
+    # Images are uint8, as when building a trainset
+    with rasterio.open(raster) as src:
+        data = np.transpose(src.read(window=windows[0]), [1, 2, 0])
+    if rescale:
+        data = exposure.rescale_intensity(data, in_range=(100, 3000))
+    img = seq._read(raster, windows[0])
+    assert img.dtype == np.uint8
+    assert np.array_equal(img, img_as_ubyte(data))
+    if rescale:
+        assert img.max() == 255
+    seq.close()
+
+
+def test_embedding_sequence():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        dataset_path = os.path.join(tmpdir, 'train')
+        with PackedDatasetWriter(dataset_path) as writer:
+            for i in range(10):
+                img = np.full((4, 4, 3), i, dtype=np.uint8)
+                writer.write(img, i % 2, '{}.jpg'.format(i))
+        dataset = PackedDataset(dataset_path)
+
+        def predict(images):
+            return [images[:, 0, :, 0].astype(np.float32)]
+
+        cache = EmbeddingCache(
+            os.path.join(tmpdir, 'embeddings'),
+            dataset,
+            predict, {},
+            variants=FLIP_VARIANTS)
+        seq = EmbeddingSequence(
+            cache, dataset.labels, batch_size=4, augment=True, shuffle=True)
+
+        assert len(seq) == 3
+        seen = []
+        for i in range(len(seq)):
+            (activations, ), labels = seq[i]
+            assert activations.shape == (len(labels), 4)
+            # Each image has constant value, equal to its index
+            indexes = activations[:, 0].astype(np.int64)
+            assert np.array_equal(labels, indexes % 2)
+            seen.extend(indexes)
+        assert sorted(seen) == list(range(10))
+
+
+def test_add_custom_layers_with_unknown_head():
+    with pytest.raises(ValueError):
+        add_custom_layers(None, head='foo')
+
+
+def test_save_and_read_model_metadata():
+    class FakeModel:
+        def save(self, path):
+            with h5py.File(path, 'w') as f:
+                f.attrs['keras_version'] = '2.1.0'
+
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+        path = os.path.join(tmpdir, 'model.h5')
+        FakeModel().save(path)
+        # Models saved without metadata have the original head
+        assert read_model_metadata(path)['head'] == 'flatten'
+
+        metadata = model_metadata(
+            size=256, trainable_layers=5, head='gap', dense_units=None)
+        save_model(FakeModel(), path, metadata=metadata)
+        res = read_model_metadata(path)
+        assert res == metadata
+        assert res['dense_units'] == DEFAULT_DENSE_UNITS['gap']
+
+
+@pytest.mark.parametrize('output_format', ['jpeg', 'packed'])
+def test_files_digest_changes_with_images(output_format):
+    with tempfile.TemporaryDirectory(prefix='aplatam_test') as tmpdir:
+
+        def write(value):
+            if output_format == 'packed':
+                with PackedDatasetWriter(tmpdir) as writer:
+                    for i in range(4):
+                        img = np.full((4, 4, 3), value, dtype=np.uint8)
+                        writer.write(img, i % 2, '{}.jpg'.format(i))
+                dataset = PackedDataset(tmpdir)
+            else:
+                for i in range(4):
+                    img_dir = os.path.join(tmpdir, 't' if i % 2 else 'f')
+                    os.makedirs(img_dir, exist_ok=True)
+                    imsave(
+                        os.path.join(img_dir, '{}.jpg'.format(i)),
+                        np.full((4, 4, 3), value, dtype=np.uint8))
+                dataset = ImageFiles(tmpdir)
+            # Make sure modification times differ, even on coarse clocks
+            for path in dataset.files():
+                os.utime(path, (value, value))
+            return dataset
+
+        first = write(10)
+        names, digest = first.names(), _files_digest(first)
+        assert _files_digest(first) == digest
+        # Same names, different pixels
+        second = write(200)
+        assert second.names() == names
+        assert _files_digest(second) != digest
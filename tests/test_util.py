@@ -3,12 +3,15 @@ import json
 import os
 import tempfile
 
+import fiona
+import pytest
 from mock import patch
 from rasterio.windows import Window
-from shapely.geometry import Point
+from shapely.geometry import MultiPolygon, Point, box
 
 from aplatam.util import (ShapeWithProps, all_raster_files, read_metadata,
-                          sliding_windows, write_geojson)
+                          reproject_shape, reproject_shapes, sliding_windows,
+                          write_geojson, write_vector)
 
 TIF_FILES = ['data/test/20161215.full.tif']
 POINT = Point(0.0, 0.0)
@@ -98,3 +101,61 @@ def test_write_geojson():
         data_path = os.path.join(tmpdir, 'metadata.json')
         write_geojson(shapes, data_path)
         assert os.path.exists(data_path)
+
+
+def test_write_geojson_is_valid_json():
+    shapes = (ShapeWithProps(shape=box(i, 0, i + 1, 1), props={'prob': 0.5})
+              for i in range(3))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'shapes.geojson')
+        write_geojson(shapes, path)
+        with open(path) as src:
+            data = json.load(src)
+    assert data['type'] == 'FeatureCollection'
+    assert len(data['features']) == 3
+    assert data['features'][2]['properties'] == {'prob': 0.5}
+
+
+@pytest.mark.parametrize('ext', ['.shp', '.gpkg', '.geojson', '.ndjson'])
+def test_write_vector(ext):
+    shapes = [
+        ShapeWithProps(
+            shape=box(i, 0, i + 1, 1), props={
+                'prob': i / 10,
+                'windows': i
+            }) for i in range(2500)
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'shapes' + ext)
+        write_vector(iter(shapes), path)
+        with fiona.open(path) as src:
+            features = list(src)
+    assert len(features) == len(shapes)
+    assert features[42]['properties']['prob'] == 4.2
+    assert features[42]['properties']['windows'] == 42
+
+
+def test_write_vector_unknown_extension():
+    with pytest.raises(ValueError):
+        write_vector([], 'shapes.foo')
+
+
+def test_reproject_shapes():
+    polygon_with_hole = box(500000, 6000000, 500100, 6000100).difference(
+        box(500010, 6000010, 500020, 6000020))
+    shapes = [
+        box(500000, 6000000, 500010, 6000010),
+        polygon_with_hole,
+        MultiPolygon([
+            box(501000, 6001000, 501010, 6001010),
+            box(502000, 6002000, 502010, 6002010)
+        ]),
+        Point(500000, 6000000),
+    ]
+    src_crs, dst_crs = {'init': 'epsg:32721'}, {'init': 'epsg:4326'}
+    res = reproject_shapes(shapes, src_crs, dst_crs)
+    assert len(res) == len(shapes)
+    for shape, expected in zip(res, shapes):
+        expected = reproject_shape(expected, src_crs, dst_crs)
+        assert shape.geom_type == expected.geom_type
+        assert shape.equals_exact(expected, 1e-9)
@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from aplatam.util import sliding_windows
+from aplatam.window_reader import BlockCacheReader, StripReader, scan_raster
+
+
+@pytest.fixture
+def tiled_raster():
+    with tempfile.TemporaryDirectory(prefix='aplatam_test_reader') as tmpdir:
+        path = os.path.join(tmpdir, 'raster.tif')
+        data = np.arange(4 * 100 * 90, dtype=np.uint16).reshape(4, 100, 90)
+        profile = dict(
+            driver='GTiff',
+            width=90,
+            height=100,
+            count=4,
+            dtype='uint16',
+            tiled=True,
+            blockxsize=16,
+            blockysize=16,
+            crs='epsg:32721',
+            transform=from_origin(0, 0, 1, 1))
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(data)
+        yield path
+
+
+def test_strip_reader_read_windows(tiled_raster):
+    with rasterio.open(tiled_raster) as src:
+        windows = list(
+            sliding_windows(20, 10, width=src.width, height=src.height))
+        reader = StripReader(src)
+        imgs = list(img.copy() for img in reader.read_windows(windows))
+
+        assert len(imgs) == len(windows)
+        for window, img in zip(windows, imgs):
+            expected = np.dstack(
+                [src.read(b, window=window) for b in range(1, 4)])
+            assert img.shape == (20, 20, 3)
+            assert np.array_equal(img, expected)
+
+
+def test_strip_reader_yields_views_of_strip(tiled_raster):
+    with rasterio.open(tiled_raster) as src:
+        windows = list(
+            sliding_windows(20, 10, width=src.width, height=src.height))
+        reader = StripReader(src, strip_height=40)
+        imgs = reader.read_windows(windows)
+        first, second = next(imgs), next(imgs)
+        assert np.shares_memory(first, second)
+
+
+@pytest.mark.parametrize('strip_height', [None, 30, 200])
+def test_scan_raster(tiled_raster, strip_height):
+    with rasterio.open(tiled_raster) as src:
+        windows = list(
+            sliding_windows(20, 10, width=src.width, height=src.height))
+        # Skip some windows
+        windows = windows[::3]
+        strips, imgs = [], []
+        for data, images in scan_raster(
+                src, windows, strip_height=strip_height):
+            strips.append(data)
+            imgs.extend(img.copy() for img in images)
+
+        # Every row is read exactly once
+        assert np.array_equal(
+            np.concatenate(strips, axis=1), src.read((1, 2, 3)))
+        assert len(imgs) == len(windows)
+        for window, img in zip(windows, imgs):
+            expected = np.dstack(
+                [src.read(b, window=window) for b in range(1, 4)])
+            assert np.array_equal(img, expected)
+
+
+def test_block_cache_reader(tiled_raster):
+    with rasterio.open(tiled_raster) as src:
+        windows = list(
+            sliding_windows(20, 10, width=src.width, height=src.height))
+        rng = np.random.RandomState(0)
+        rng.shuffle(windows)
+        reader = BlockCacheReader(src, max_blocks=4)
+        for window in windows:
+            img = reader.read_window(window)
+            expected = np.dstack(
+                [src.read(b, window=window) for b in range(1, 4)])
+            assert np.array_equal(img, expected)
+        assert len(reader._blocks) == 4